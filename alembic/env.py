@@ -9,6 +9,10 @@ from sqlalchemy.engine import URL
 from app import config as app_config
 from app.db.models.base import Base
 from app.db.models.plan import Plan
+from app.db.models.plan_area_result import PlanAreaResult
+from app.db.models.plan_chunk import PlanChunk
+from app.db.models.plan_feature import PlanFeature
+from app.db.models.plan_report import PlanReport
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
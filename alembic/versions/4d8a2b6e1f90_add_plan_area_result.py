@@ -0,0 +1,65 @@
+"""Add plan_area_result
+
+Revision ID: 4d8a2b6e1f90
+Revises: 9c1e4f2a7b3d
+Create Date: 2024-05-27 13:42:08.104215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '4d8a2b6e1f90'
+down_revision: Union[str, None] = '9c1e4f2a7b3d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('plan_area_result',
+    sa.Column('plan_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('feature_index', sa.Integer(), nullable=False),
+    sa.Column('feature', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.ForeignKeyConstraint(['plan_id'], ['plan.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('plan_id', 'feature_index')
+    )
+
+    # Move the calculated areas of the existing plans into the table
+    op.execute(
+        """
+        INSERT INTO plan_area_result (plan_id, feature_index, feature)
+        SELECT plan.id, areas.idx - 1, areas.feature
+        FROM plan,
+            jsonb_array_elements(plan.report_areas->'features')
+                WITH ORDINALITY AS areas(feature, idx)
+        WHERE jsonb_typeof(plan.report_areas->'features') = 'array'
+        """
+    )
+
+    op.drop_column('plan', 'report_areas')
+
+
+def downgrade() -> None:
+    op.add_column('plan', sa.Column('report_areas', postgresql.JSONB(astext_type=sa.Text()), autoincrement=False, nullable=True))
+
+    op.execute(
+        """
+        UPDATE plan
+        SET report_areas = jsonb_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(
+                (
+                    SELECT jsonb_agg(feature ORDER BY feature_index)
+                    FROM plan_area_result
+                    WHERE plan_area_result.plan_id = plan.id
+                ),
+                '[]'::jsonb
+            )
+        )
+        """
+    )
+
+    op.drop_table('plan_area_result')
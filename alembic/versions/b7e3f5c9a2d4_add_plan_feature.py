@@ -0,0 +1,56 @@
+"""Add plan_feature
+
+Revision ID: b7e3f5c9a2d4
+Revises: 4d8a2b6e1f90
+Create Date: 2024-06-03 09:18:27.640512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from app.db.models.plan_feature import Geometry
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e3f5c9a2d4'
+down_revision: Union[str, None] = '4d8a2b6e1f90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+
+    op.create_table('plan_feature',
+    sa.Column('plan_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('feature_index', sa.Integer(), nullable=False),
+    sa.Column('properties', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('geometry', Geometry(srid=3067), nullable=False),
+    sa.ForeignKeyConstraint(['plan_id'], ['plan.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('plan_id', 'feature_index')
+    )
+    op.create_index('ix_plan_feature_geometry', 'plan_feature', ['geometry'], unique=False, postgresql_using='gist')
+
+    # Split the data of the existing plans into the table
+    op.execute(
+        """
+        INSERT INTO plan_feature (plan_id, feature_index, properties, geometry)
+        SELECT plan.id, features.idx - 1, features.feature->'properties',
+            ST_Transform(
+                ST_SetSRID(ST_GeomFromGeoJSON(features.feature->'geometry'), 4326),
+                3067
+            )
+        FROM plan,
+            jsonb_array_elements(plan.data->'features')
+                WITH ORDINALITY AS features(feature, idx)
+        WHERE jsonb_typeof(plan.data->'features') = 'array'
+            AND jsonb_typeof(features.feature->'geometry') = 'object'
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_plan_feature_geometry', table_name='plan_feature', postgresql_using='gist')
+    op.drop_table('plan_feature')
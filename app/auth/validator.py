@@ -1,11 +1,13 @@
 from os import environ as env
+import asyncio
+import hashlib
 import time
-from typing import Dict
+from typing import Any, Dict, Optional
 
 from authlib.oauth2.rfc7662 import IntrospectTokenValidator
-import requests
-from requests.auth import HTTPBasicAuth
+import httpx
 from app import config
+from app.utils.ttl_cache import TTLCache
 
 global_settings = config.get_settings()
 
@@ -13,9 +15,37 @@ zitadel_domain = global_settings.zitadel_domain
 zitadel_client_id = global_settings.zitadel_client_id
 zitade_client_secret = global_settings.zitadel_client_secret
 
+# Introspection results by token hash
+token_cache = TTLCache(
+    global_settings.auth_cache_ttl, global_settings.auth_cache_max_entries
+)
+# Introspections in flight by token hash, concurrent requests with the same
+# token wait for the same one
+in_flight_introspections: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
 
-class ValidatorError(Exception):
+# Created on first use, so that it belongs to the running event loop
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+
+    return http_client
 
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+class ValidatorError(Exception):
     def __init__(self, error: Dict[str, str], status_code: int):
         super().__init__()
         self.error = error
@@ -27,17 +57,44 @@ class ValidatorError(Exception):
 
 
 class ZitadelIntrospectTokenValidator(IntrospectTokenValidator):
-    def introspect_token(self, token_string):
+    async def introspect_token(self, token_string):
+        token_key = hashlib.sha256(token_string.encode("utf-8")).hexdigest()
+        token = token_cache.get(token_key)
+        if token is not None:
+            return token
+
+        introspection = in_flight_introspections.get(token_key)
+        if introspection is None:
+            introspection = asyncio.ensure_future(
+                self.fetch_introspection(token_string, token_key)
+            )
+            in_flight_introspections[token_key] = introspection
+            introspection.add_done_callback(
+                lambda _: in_flight_introspections.pop(token_key, None)
+            )
+
+        # Shielded, so a cancelled request doesn't cancel it for the others
+        return await asyncio.shield(introspection)
+
+    async def fetch_introspection(self, token_string, token_key):
         url = f"{zitadel_domain}/oauth/v2/introspect"
         data = {
             "token": token_string,
             "token_type_hint": "access_token",
             "scope": "openid",
         }
-        auth = HTTPBasicAuth(zitadel_client_id, zitade_client_secret)
-        resp = requests.post(url, data=data, auth=auth)
+        auth = httpx.BasicAuth(zitadel_client_id, zitade_client_secret)
+        resp = await get_http_client().post(url, data=data, auth=auth)
         resp.raise_for_status()
-        return resp.json()
+        token = resp.json()
+
+        # Cached until the token expires, for at most the configured ttl
+        ttl = global_settings.auth_cache_ttl
+        if token.get("active") and token.get("exp"):
+            ttl = min(ttl, token["exp"] - time.time())
+        token_cache.set(token_key, token, ttl)
+
+        return token
 
     def match_token_scopes(self, token, or_scopes):
         if or_scopes is None:
@@ -79,6 +136,6 @@ class ZitadelIntrospectTokenValidator(IntrospectTokenValidator):
         #         401,
         #     )
 
-    def __call__(self, *args, **kwargs):
-        res = self.introspect_token(*args, **kwargs)
+    async def __call__(self, *args, **kwargs):
+        res = await self.introspect_token(*args, **kwargs)
         return res
@@ -1,25 +1,34 @@
-import asyncio
-import tempfile
 import pandas as pd
-import rioxarray as rxr
 import geopandas as gpd
 import xarray as xr
 import numpy as np
+from numpy.typing import NDArray
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import Any, Dict, TypedDict, List
+from typing import Any, Dict, Optional, TypedDict, List, Tuple
 import json
 from warnings import simplefilter
 
-from app.calculator.utils import get_bm_curve_values_for_years_mabp, get_overlap_mask
+from app import config
+from app.calculator.utils import (
+    current_year,
+    get_bm_curve_mabp_sum,
+    get_shared_overlap_masks,
+    get_unique_ids,
+    read_raster_from_bytes,
+    split_into_tiles,
+    year_offset,
+)
+from app.db.connection import get_bounded_async_context_gis_db
+from app.utils.process_pool import run_cpu_bound
 from app.db.gis import (
-    fetch_bio_carbon_for_regions,
-    fetch_ground_carbon_for_regions,
-    fetch_rasters_for_regions,
+    fetch_layers_for_regions,
     fetch_variables_for_ids,
+    fetch_zonal_sums_for_regions,
 )
+from app.types.general import CalculationBackend
 from app.utils.data_loader import (
-    get_bm_curve_df,
+    get_bm_curve_index,
     get_area_multipliers_df,
 )
 from app.utils.logger import get_logger
@@ -33,6 +42,13 @@ sqm_to_ha = 1 / 10_000  # 1 hectare is 10,000 square meters
 crs = "3067"
 zoning_col = "zoning_code"
 c_to_co2 = 44 / 12
+# Buffer for fetching every pixel that touches a geometry, a bit over the
+# diagonal of a 16 m pixel
+pixel_buffer = 22.7
+
+global_settings = config.get_settings()
+
+LayerRast = Optional[xr.DataArray]
 
 
 class CalculationResult(TypedDict):
@@ -41,13 +57,211 @@ class CalculationResult(TypedDict):
     metadata: Dict[str, str]
 
 
+class FeatureSums(TypedDict):
+    # Overlap weighted sums of the layer pixels of a feature
+    bio_carbon: float
+    ground_carbon: float
+    bm_curve_mabp: float
+    bm_curve_found: bool
+
+
+def get_empty_feature_sums() -> FeatureSums:
+    return {
+        "bio_carbon": 0.0,
+        "ground_carbon": 0.0,
+        "bm_curve_mabp": 0.0,
+        "bm_curve_found": False,
+    }
+
+
+def add_feature_sums(sums: FeatureSums, other: FeatureSums) -> FeatureSums:
+    return {
+        "bio_carbon": sums["bio_carbon"] + other["bio_carbon"],
+        "ground_carbon": sums["ground_carbon"] + other["ground_carbon"],
+        "bm_curve_mabp": sums["bm_curve_mabp"] + other["bm_curve_mabp"],
+        "bm_curve_found": sums["bm_curve_found"] or other["bm_curve_found"],
+    }
+
+
+def sum_layers(
+    geometries: List[Any],
+    rasts: List[LayerRast],
+    variables_dict: Dict[int, Dict[str, Any]],
+    bio_carbon_rasts: List[LayerRast],
+    ground_carbon_rasts: List[LayerRast],
+    simplify_calcs: bool = False,
+) -> List[FeatureSums]:
+    """
+    Mask the layer rasts of each geometry with its overlap and sum them up.
+    A layer without data for a geometry adds nothing to its sums.
+    """
+    bm_curve_index = get_bm_curve_index()
+
+    feature_sums = []
+    for idx, geometry in enumerate(geometries):
+        feature_rasts = [
+            rasts[idx],
+            bio_carbon_rasts[idx],
+            ground_carbon_rasts[idx],
+        ]
+        # The layers are clipped with the same geometry, so they are masked
+        # together to share the mask between aligned grids
+        layer_idxs = [i for i, rast in enumerate(feature_rasts) if rast is not None]
+        masks: List[Optional[xr.DataArray]] = [None] * len(feature_rasts)
+        shared_masks = get_shared_overlap_masks(
+            [feature_rasts[i] for i in layer_idxs], geometry, simplify_calcs
+        )
+        for i, overlap_mask in zip(layer_idxs, shared_masks):
+            masks[i] = overlap_mask
+
+        rast, bio_carbon_rast, ground_carbon_rast = feature_rasts
+        rast_mask, bio_carbon_mask, ground_carbon_mask = masks
+
+        sums = get_empty_feature_sums()
+        if rast is not None:
+            mabp_sum, was_found = get_bm_curve_mabp_sum(
+                rast.values, bm_curve_index, variables_dict, rast_mask.values
+            )
+            sums["bm_curve_mabp"] = mabp_sum
+            sums["bm_curve_found"] = was_found
+        if bio_carbon_rast is not None:
+            sums["bio_carbon"] = (bio_carbon_rast * bio_carbon_mask).sum().values.item()
+        if ground_carbon_rast is not None:
+            sums["ground_carbon"] = (
+                (ground_carbon_rast * ground_carbon_mask).sum().values.item()
+            )
+
+        feature_sums.append(sums)
+
+    return feature_sums
+
+
+def get_bm_curve_values_for_years(
+    feature_sums: List[FeatureSums], years: List[int]
+) -> NDArray[np.float64]:
+    """
+    The biomass curve growth of each feature for each year, as a features x years
+    array. Features without a curve or any growth get zeros.
+    """
+    mabps = np.array([sums["bm_curve_mabp"] for sums in feature_sums])
+    year_diffs = np.array(years) - current_year + year_offset
+
+    vals = mabps[:, np.newaxis] * year_diffs[np.newaxis, :]
+    is_found = np.array([sums["bm_curve_found"] for sums in feature_sums], dtype=bool)
+    vals[~(is_found & (vals.sum(axis=1) > 0))] = 0
+
+    return vals
+
+
+def get_area_multipliers(
+    zoning_codes: pd.Series,
+) -> Tuple[NDArray[np.float64], NDArray[np.float64]]:
+    """
+    The bio and ground carbon multipliers of the planned scenario for each
+    zoning code. Unknown codes get 0, and for duplicate codes the first row is
+    used.
+    """
+    area_multipliers_df = get_area_multipliers_df()
+    area_multipliers_df = area_multipliers_df[
+        ~area_multipliers_df.index.duplicated(keep="first")
+    ]
+    multipliers = area_multipliers_df[
+        ["Kasvillisuuden hiiltä säästyy", "Maaperän hiiltä säästyy"]
+    ].reindex(zoning_codes.to_numpy(), fill_value=0)
+
+    return (
+        multipliers["Kasvillisuuden hiiltä säästyy"].to_numpy(dtype=np.float64),
+        multipliers["Maaperän hiiltä säästyy"].to_numpy(dtype=np.float64),
+    )
+
+
+def is_sum_col(col: str) -> bool:
+    return "nochange" in col or "planned" in col
+
+
+def get_area_sums(areas: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Sum the result columns over the features of an area feature collection.
+    """
+    sums: Dict[str, float] = {}
+    for feature in areas["features"]:
+        for col, val in feature["properties"].items():
+            if is_sum_col(col) and val is not None:
+                sums[col] = sums.get(col, 0.0) + val
+
+    return sums
+
+
+def get_total_geometry(zone: gpd.GeoDataFrame):
+    """
+    The union of the plan geometries in EPSG:3067, which the totals are for.
+    """
+    zone = zone.to_crs(f"EPSG:{crs}")
+    is_valid = zone.geometry.is_valid
+    # Fixing the geometries made invalid by the reprojection with buffer(0)
+    zone.loc[~is_valid, "geometry"] = zone.loc[~is_valid, "geometry"].buffer(0)
+
+    return zone.geometry.unary_union
+
+
+def get_totals_from_sums(sums: Dict[str, float], geometry) -> Dict[str, Any]:
+    """
+    The plan totals from the summed result columns of its areas and the union
+    of their geometries in EPSG:3067.
+    """
+    agg_results: Dict[str, Any] = {**sums}
+    agg_results["geometry"] = geometry
+    summed_gdf = gpd.GeoDataFrame([agg_results], geometry="geometry")
+    summed_gdf["area"] = summed_gdf["geometry"].area
+
+    # The per hectare values are derived from the totals, not summed
+    for col in sums:
+        if "_total_" in col:
+            new_col = col.replace("_total_", "_ha_")
+            summed_gdf[new_col] = summed_gdf[col] / (summed_gdf["area"] * sqm_to_ha)
+
+    summed_gdf.set_crs(epsg=3067, inplace=True)
+
+    return {
+        "totals": summed_gdf.to_crs(epsg=4326).to_json(),
+        "metadata": {"timestamp": datetime.utcnow()},
+    }
+
+
+def is_simplified_calculation(zone: gpd.GeoDataFrame) -> bool:
+    # In the simplified mode, the plans over the threshold are calculated with
+    # whole pixels
+    return (
+        global_settings.calc_large_area_mode == "simplified"
+        and zone.area.sum() > global_settings.calc_large_area_threshold
+    )
+
+
+def get_simplified_features(zone: gpd.GeoDataFrame) -> List[bool]:
+    # The same for each feature by its own area, as when the plans were
+    # calculated feature by feature, so it doesn't depend on the batch the
+    # feature is calculated in
+    return [
+        global_settings.calc_large_area_mode == "simplified"
+        and area > global_settings.calc_large_area_threshold
+        for area in zone.area
+    ]
+
+
 class CarbonCalculator:
-    def __init__(self, data, sort_col="id"):
+    def __init__(
+        self,
+        data,
+        sort_col="id",
+        backend: Optional[str] = None,
+        input_crs: str = "4326",
+        simplify_calcs: Optional[bool] = None,
+    ):
         zone = gpd.GeoDataFrame.from_features(data["features"])
         if sort_col and sort_col in zone.columns:
             zone = zone.sort_values(by=sort_col)
         zone.set_geometry("geometry", inplace=True)
-        zone.set_crs("EPSG:4326", inplace=True)
+        zone.set_crs(f"EPSG:{input_crs}", inplace=True)
         zone = zone.to_crs(f"EPSG:{crs}")
 
         zone["is_valid"] = zone["geometry"].is_valid
@@ -63,16 +277,27 @@ class CarbonCalculator:
                 "Geometries are not valid, even after trying to fix them with buffer(0)"
             )
 
-        self.simplify_calcs = False
-        # Simplify calculations for large areas
-        if zone.area.sum() > 50000:
-            self.simplify_calcs = True
+        # Simplify calculations for large areas, unless told otherwise, e.g. for
+        # a part of a larger plan
+        if simplify_calcs is None:
+            simplify_calcs = is_simplified_calculation(zone)
+        self.simplify_calcs = simplify_calcs
+        if global_settings.calc_large_area_mode == "simplified":
+            zone["is_tiled"] = False
+        else:
+            # Features larger than a tile are calculated tile by tile, which
+            # keeps the memory use bounded and the edge coverage precise
+            bounds = zone.geometry.bounds
+            zone["is_tiled"] = (
+                (bounds["maxx"] - bounds["minx"]) > global_settings.calc_tile_size
+            ) | ((bounds["maxy"] - bounds["miny"]) > global_settings.calc_tile_size)
 
         if not self.simplify_calcs:
-            zone["buffered_geometry"] = zone.geometry.buffer(22.7)
+            zone["buffered_geometry"] = zone.geometry.buffer(pixel_buffer)
 
         self.zone: gpd.GeoDataFrame = zone
         self.zone_raster = None
+        self.backend = CalculationBackend(backend or global_settings.calc_backend)
 
     # def rasterize_zone(self):
     #     if self.zone_raster != None:
@@ -95,31 +320,26 @@ class CarbonCalculator:
 
     #     return zone
 
-    async def get_rasts(
-        self, db_session, wkt_list: List[str], crs: str
-    ) -> List[xr.DataArray]:
-        rasts = await fetch_rasters_for_regions(db_session, wkt_list, crs)
-        sorted_rasts = sorted(rasts, key=lambda x: x[1])
-
-        rast_das = []
-        for rast in sorted_rasts:
-            try:
-                with tempfile.NamedTemporaryFile(
-                    suffix=".tiff", delete=True
-                ) as tmpfile:
-                    await asyncio.to_thread(tmpfile.write, rast[0][0])
-                    tmpfile.flush()
-
-                    # Use rioxarray to directly open the temporary raster file
-                    rast_da: xr.DataArray = rxr.open_rasterio(
-                        tmpfile.name, masked=True
-                    ).isel(band=0)
-
-                    rast_das.append(rast_da)
-            except Exception as e:
-                print(e)
-
-        return rast_das
+    async def get_layer_rasts(
+        self, db_session, wkts: List[str], crs: str
+    ) -> Tuple[List[LayerRast], List[LayerRast], List[LayerRast]]:
+        rows = await fetch_layers_for_regions(db_session, wkts, crs)
+        sorted_rows = sorted(rows, key=lambda x: x[-1])
+
+        # Segment, bio carbon and ground carbon rasts, with None for the
+        # geometries that have no data in the layer
+        layer_rasts: Tuple[List[LayerRast], ...] = ([], [], [])
+        for row in sorted_rows:
+            for rast_das, rast in zip(layer_rasts, row[:3]):
+                rast_da = None
+                if rast is not None:
+                    try:
+                        rast_da = read_raster_from_bytes(rast)
+                    except Exception as e:
+                        print(e)
+                rast_das.append(rast_da)
+
+        return layer_rasts
 
     async def get_variables(self, db_session, ids: List[str]):
         variable_rows, col_names = await fetch_variables_for_ids(db_session, ids)
@@ -131,55 +351,28 @@ class CarbonCalculator:
 
         return variables_dict
 
-    async def get_bio_carbon(
-        self, db_session, wkts: List[str], crs: str
-    ) -> List[xr.DataArray]:
-        rasts = await fetch_bio_carbon_for_regions(db_session, wkts, crs)
-        sorted_rasts = sorted(rasts, key=lambda x: x[1])
-
-        rast_das = []
-        for rast in sorted_rasts:
-            try:
-                with tempfile.NamedTemporaryFile(
-                    suffix=".tiff", delete=True
-                ) as tmpfile:
-                    await asyncio.to_thread(tmpfile.write, rast[0][0])
-                    tmpfile.flush()
-
-                    # Use rioxarray to directly open the temporary raster file
-                    rast_da = rxr.open_rasterio(tmpfile.name, masked=True).isel(band=0)
-                    rast_da.where(rast_da < 32766)
-
-                    rast_das.append(rast_da)
-            except Exception as e:
-                print(e)
-
-        return rast_das
-
-    async def get_ground_carbon(
-        self, db_session, wkts: List[str], crs: str
-    ) -> List[xr.DataArray]:
-        rasts = await fetch_ground_carbon_for_regions(db_session, wkts, crs)
-        sorted_rasts = sorted(rasts, key=lambda x: x[1])
-
-        rast_das = []
-        for rast in sorted_rasts:
-            try:
-                with tempfile.NamedTemporaryFile(
-                    suffix=".tiff", delete=True
-                ) as tmpfile:
-                    await asyncio.to_thread(tmpfile.write, rast[0][0])
-                    tmpfile.flush()
-
-                    # Use rioxarray to directly open the temporary raster file
-                    rast_da = rxr.open_rasterio(tmpfile.name, masked=True).isel(band=0)
-                    rast_da.where(rast_da < 32766)
-
-                    rast_das.append(rast_da)
-            except Exception as e:
-                print(e)
+    async def fetch_layers(
+        self, wkt_list: List[str], db_session: Optional[AsyncSession] = None
+    ) -> Tuple[
+        List[LayerRast],
+        Dict[int, Dict[str, Any]],
+        List[LayerRast],
+        List[LayerRast],
+    ]:
+        if db_session is None:
+            async with get_bounded_async_context_gis_db() as session:
+                return await self.fetch_layers(wkt_list, session)
+
+        # All layers are clipped in one query, the variables depend on the
+        # segment ids found in it
+        rasts, bio_carbon_rasts, ground_carbon_rasts = await self.get_layer_rasts(
+            db_session, wkt_list, crs
+        )
+        variables_dict = await self.get_variables(
+            db_session, get_unique_ids([rast for rast in rasts if rast is not None])
+        )
 
-        return rast_das
+        return rasts, variables_dict, bio_carbon_rasts, ground_carbon_rasts
 
     # def dummy_combine_data(
     #     self,
@@ -208,196 +401,178 @@ class CarbonCalculator:
     #     return variables_ds
 
     async def calculate_totals(self):
-        sum_cols = [
-            col for col in self.zone.columns if "nochange" in col or "planned" in col
-        ]
+        return await run_cpu_bound(self.get_totals)
 
+    def get_totals(self):
+        sum_cols = [col for col in self.zone.columns if is_sum_col(col)]
         sum_result = self.zone[sum_cols].sum()
 
-        # Merge the results
-        # agg_results = {**sum_result.to_dict(), **weighted_averages}
-        agg_results = {**sum_result.to_dict()}
-        agg_results["geometry"] = self.zone.geometry.unary_union
-        summed_gdf = gpd.GeoDataFrame([agg_results], geometry="geometry")
-        summed_gdf["area"] = summed_gdf["geometry"].area
-
-        for col in sum_cols:
-            new_col = col.replace("_total_", "_ha_")
-            summed_gdf[new_col] = summed_gdf[col] / (summed_gdf["area"] * sqm_to_ha)
-
-        summed_gdf.set_crs(epsg=3067, inplace=True)
-
-        return {
-            "totals": summed_gdf.to_crs(epsg=4326).to_json(),
-            "metadata": {"timestamp": datetime.utcnow()},
-        }
-
-    async def calculate(self, db_session: AsyncSession) -> CalculationResult:
-        bm_curves_df = get_bm_curve_df()
-        area_multipliers_df = get_area_multipliers_df()
-        area_multipliers_bio = []
-        area_multipliers_ground = []
-
-        for index, row in self.zone.iterrows():
-            code = row[zoning_col]
-
-            multiplier_bio = 0
-            multiplier_ground = 0
-            if code in area_multipliers_df.index:
-                multiplier_bio = area_multipliers_df.loc[code][
-                    "Kasvillisuuden hiiltä säästyy"
-                ]
-                if isinstance(multiplier_bio, pd.Series):
-                    multiplier_bio = multiplier_bio.iloc[0]
-
-                multiplier_ground = area_multipliers_df.loc[code][
-                    "Maaperän hiiltä säästyy"
-                ]
-                if isinstance(multiplier_ground, pd.Series):
-                    multiplier_ground = multiplier_ground.iloc[0]
-
-            area_multipliers_bio.append(multiplier_bio)
-            area_multipliers_ground.append(multiplier_ground)
-
-        wkt_list = []
-        if self.simplify_calcs:
-            wkt_list = self.zone.geometry.to_wkt().tolist()
-        else:
-            wkt_list = self.zone.buffered_geometry.to_wkt().tolist()
-
-        rasts = await self.get_rasts(db_session, wkt_list=wkt_list, crs=crs)
+        return get_totals_from_sums(
+            sum_result.to_dict(), self.zone.geometry.unary_union
+        )
 
-        i = 0
-        rast_overlaps = []
-        for rast in rasts:
-            overlap_mask = get_overlap_mask(
-                rast, self.zone.iloc[i].geometry, self.simplify_calcs
+    async def calculate(
+        self, db_session: Optional[AsyncSession] = None
+    ) -> CalculationResult:
+        feature_sums = await self.get_feature_sums(db_session)
+
+        return await run_cpu_bound(self.calculate_areas, feature_sums)
+
+    async def get_feature_sums(
+        self, db_session: Optional[AsyncSession] = None
+    ) -> List[FeatureSums]:
+        if self.backend == CalculationBackend.ZONAL:
+            return await self.get_zonal_feature_sums(db_session)
+
+        feature_sums: List[Optional[FeatureSums]] = [None] * len(self.zone)
+
+        untiled_idxs = np.flatnonzero(~self.zone["is_tiled"].to_numpy())
+        if len(untiled_idxs) > 0:
+            untiled_zone = self.zone.iloc[untiled_idxs]
+            wkt_list = []
+            if self.simplify_calcs:
+                wkt_list = untiled_zone.geometry.to_wkt().tolist()
+            else:
+                wkt_list = untiled_zone.buffered_geometry.to_wkt().tolist()
+
+            layers = await self.fetch_layers(wkt_list, db_session)
+
+            # Masking and summing is CPU bound, so it's kept off the event loop
+            sums = await run_cpu_bound(
+                sum_layers,
+                untiled_zone.geometry.tolist(),
+                *layers,
+                self.simplify_calcs,
             )
-            rast = rast.where(overlap_mask != 0, np.nan)
-            rast_overlaps.append(overlap_mask)
-            i += 1
+            for idx, layer_sums in zip(untiled_idxs, sums):
+                feature_sums[idx] = layer_sums
 
-        uniq_vals = np.array([])
-        for data_array in rasts:
-            uniq_vals = np.concatenate([uniq_vals, np.unique(data_array)])
+        for idx in np.flatnonzero(self.zone["is_tiled"].to_numpy()):
+            feature_sums[idx] = await self.get_tiled_feature_sums(
+                self.zone.geometry.iloc[idx], db_session
+            )
 
-        uniq_vals = np.unique(uniq_vals[~np.isnan(uniq_vals)])
+        return feature_sums
+
+    async def get_tiled_feature_sums(
+        self, geometry, db_session: Optional[AsyncSession] = None
+    ) -> FeatureSums:
+        # Each pixel's coverage is split between the tiles it touches, so the
+        # tile sums add up to the sums of the whole geometry. Tiles are
+        # processed one at a time to bound the memory use by the tile size.
+        feature_sums = get_empty_feature_sums()
+        for tile_geometry in split_into_tiles(geometry, global_settings.calc_tile_size):
+            layers = await self.fetch_layers(
+                [tile_geometry.buffer(pixel_buffer).wkt], db_session
+            )
+            tile_sums = await run_cpu_bound(sum_layers, [tile_geometry], *layers)
+            feature_sums = add_feature_sums(feature_sums, tile_sums[0])
 
-        uniq_ids_list = [int(val) for val in uniq_vals]
+        return feature_sums
 
-        variables_dict = await self.get_variables(db_session, uniq_ids_list)
+    async def get_zonal_feature_sums(
+        self, db_session: Optional[AsyncSession] = None
+    ) -> List[FeatureSums]:
+        if db_session is None:
+            async with get_bounded_async_context_gis_db() as session:
+                return await self.get_zonal_feature_sums(session)
 
-        bio_carbon_rasts = await self.get_bio_carbon(db_session, wkt_list, crs=crs)
-        ground_carbon_rasts = await self.get_ground_carbon(
-            db_session, wkt_list, crs=crs
+        rows = await fetch_zonal_sums_for_regions(
+            db_session, self.zone.geometry.to_wkt().tolist(), crs, pixel_buffer
+        )
+        sorted_rows = sorted(rows, key=lambda x: x[-1])
+
+        segment_ids = set()
+        for row in sorted_rows:
+            segment_ids.update(row[0] or [])
+        variables_dict = await self.get_variables(db_session, list(segment_ids))
+        bm_curve_index = get_bm_curve_index()
+
+        feature_sums = []
+        for ids, weights, bio_carbon_sum, ground_carbon_sum, _ in sorted_rows:
+            sums = get_empty_feature_sums()
+            if ids:
+                # The histogram works as a raster of one pixel per segment id,
+                # weighted by the summed pixel coverage
+                mabp_sum, was_found = get_bm_curve_mabp_sum(
+                    np.array(ids, dtype=np.float64),
+                    bm_curve_index,
+                    variables_dict,
+                    np.array(weights, dtype=np.float64),
+                )
+                sums["bm_curve_mabp"] = mabp_sum
+                sums["bm_curve_found"] = was_found
+            if bio_carbon_sum is not None:
+                sums["bio_carbon"] = float(bio_carbon_sum)
+            if ground_carbon_sum is not None:
+                sums["ground_carbon"] = float(ground_carbon_sum)
+
+            feature_sums.append(sums)
+
+        return feature_sums
+
+    def calculate_areas(self, feature_sums: List[FeatureSums]) -> CalculationResult:
+        multipliers_bio, multipliers_ground = get_area_multipliers(
+            self.zone[zoning_col]
         )
-
-        bio_carbon_masks = []
-        i = 0
-        for rast in bio_carbon_rasts:
-            overlap_mask = get_overlap_mask(
-                rast, self.zone.iloc[i].geometry, self.simplify_calcs
-            )
-            rast = rast.where(overlap_mask != 0, np.nan)
-            bio_carbon_masks.append(overlap_mask)
-            i += 1
-
-        ground_carbon_masks = []
-        i = 0
-        for rast in ground_carbon_rasts:
-            overlap_mask = get_overlap_mask(
-                rast, self.zone.iloc[i].geometry, self.simplify_calcs
-            )
-            rast = rast.where(overlap_mask != 0, np.nan)
-            ground_carbon_masks.append(overlap_mask)
-            i += 1
 
         calcs_df = self.zone[["id", "geometry", zoning_col]].copy()
         calcs_df["area"] = self.zone.geometry.area
         calcs_df.set_crs(epsg=3067, inplace=True)
         calcs_df.set_geometry("geometry", inplace=True)
 
-        sum_cols = []
         current_year = datetime.now().year
         years_int = [current_year] + list(range(2030, 2100, 5))
         years = [str(year) for year in years_int]
 
-        bm_curve_values, bm_curve_masks = await get_bm_curve_values_for_years_mabp(
-            rasts, years, bm_curves_df, variables_dict, rast_overlaps
+        # The multipliers of the planned scenario apply from the next year on
+        is_future_year = np.array(years_int) != current_year
+
+        bio_carbon = np.array([sums["bio_carbon"] for sums in feature_sums])
+        ground_carbon = np.array([sums["ground_carbon"] for sums in feature_sums])
+
+        # features x years arrays for each layer and scenario
+        bio_nochange = (
+            bio_carbon[:, np.newaxis] * grid_to_ha * c_to_co2
+            + get_bm_curve_values_for_years(feature_sums, years_int) * grid_to_ha
+        )
+        bio_planned = np.where(
+            is_future_year, bio_nochange * multipliers_bio[:, np.newaxis], bio_nochange
+        )
+        ground_nochange = np.repeat(
+            ground_carbon[:, np.newaxis] * grid_to_ha * c_to_co2, len(years), axis=1
+        )
+        ground_planned = np.where(
+            is_future_year,
+            ground_nochange * multipliers_ground[:, np.newaxis],
+            ground_nochange,
         )
 
-        # generate bio carbon values
-        base_col = "bio_carbon_total"
-        bio_masks_no_curve_vals = []
-        base_vals = []
-        base_vals_no_bm_curve = []
-        for index, rast in enumerate(bio_carbon_rasts):
-            rast_masked = rast * bio_carbon_masks[index]
-
-            sum = rast_masked.sum().values.item()
-            base_vals.append(sum * grid_to_ha * c_to_co2)
-
-            # sum_no_bm_curve_val = sum
-            # if (bm_curve_masks[index] is not None):
-            #     sum_no_bm_curve_val = (rast_masked * ~bm_curve_masks[index]).sum().values.item()
-            # base_vals_no_bm_curve.append(sum_no_bm_curve_val)
-
-        for suffix in ["nochange", "planned"]:
-            use_multiplier = False
-            if suffix == "planned":
-                use_multiplier = True
-
-            for year in years:
-                vals = []
-
-                for idx, year_dict in enumerate(bm_curve_values):
-                    val = base_vals[idx]
-                    if year_dict is not None:
-                        val += year_dict[year] * grid_to_ha
-                    if use_multiplier and year != str(current_year):
-                        vals.append(val * area_multipliers_bio[idx])
-                    else:
-                        vals.append(val)
-
-                col = f"{base_col}_{suffix}_{year}"
-                sum_cols.append(col)
-                calcs_df[col] = vals
-
-        # generate ground carbon values
-        base_col = "ground_carbon_total"
-        base_vals = []
-        for index, rast in enumerate(ground_carbon_rasts):
-            rast_masked = rast * ground_carbon_masks[index]
-
-            sum = rast_masked.sum().values.item()
-            base_vals.append(sum * grid_to_ha * c_to_co2)
-
-            # if (bm_curve_masks[index] is not None):
-            #     sum_no_bm_curve_val = (rast_masked * ~bm_curve_masks[index]).sum().values.item()
-            # base_vals_no_bm_curve.append(sum_no_bm_curve_val)
-
-        for suffix in ["nochange", "planned"]:
-            use_multiplier = False
-            if suffix == "planned":
-                use_multiplier = True
-
-            for year in years:
-                vals = []
-
-                for idx, base_val in enumerate(base_vals):
-                    val = base_val
-                    if use_multiplier and year != str(current_year):
-                        vals.append(val * area_multipliers_ground[idx])
-                    else:
-                        vals.append(val)
-
-                col = f"{base_col}_{suffix}_{year}"
-                sum_cols.append(col)
-                calcs_df[col] = vals
-
-        for col in sum_cols:
-            new_col = col.replace("_total_", "_ha_")
-            calcs_df[new_col] = calcs_df[col] / (calcs_df["area"] * sqm_to_ha)
+        sum_cols = [
+            f"{base_col}_{suffix}_{year}"
+            for base_col in ["bio_carbon_total", "ground_carbon_total"]
+            for suffix in ["nochange", "planned"]
+            for year in years
+        ]
+        ha_cols = [col.replace("_total_", "_ha_") for col in sum_cols]
+
+        totals = np.concatenate(
+            [bio_nochange, bio_planned, ground_nochange, ground_planned], axis=1
+        )
+        per_ha = totals / (calcs_df["area"].to_numpy() * sqm_to_ha)[:, np.newaxis]
+
+        calcs_df = gpd.GeoDataFrame(
+            pd.concat(
+                [
+                    calcs_df,
+                    pd.DataFrame(totals, columns=sum_cols, index=calcs_df.index),
+                    pd.DataFrame(per_ha, columns=ha_cols, index=calcs_df.index),
+                ],
+                axis=1,
+            ),
+            geometry="geometry",
+            crs=calcs_df.crs,
+        )
 
         # all_columns = all_columns + total_columns
 
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import geopandas as gpd
+import shapely
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from app import config
+from app.calculator.calculator import (
+    CalculationResult,
+    CarbonCalculator,
+    crs,
+    get_simplified_features,
+    zoning_col,
+)
+from app.db.gis import bio_carbon_table, ground_carbon_table, segment_table
+from app.types.general import CalculationBackend
+from app.utils.data_loader import get_static_inputs_version
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+global_settings = config.get_settings()
+
+# Bump when the calculation changes in a way that changes its results
+calc_version = "1"
+# Geometries are compared at centimeter precision
+key_precision = 0.01
+
+key_prefix = "calc_cache"
+entries_key = f"{key_prefix}:entries"
+hits_key = f"{key_prefix}:hits"
+misses_key = f"{key_prefix}:misses"
+
+# Created on first use, so that it belongs to the running event loop
+redis_client = None
+
+
+def get_redis_client() -> aioredis.Redis:
+    global redis_client
+    if redis_client is None:
+        redis_client = aioredis.from_url(global_settings.redis_url)
+
+    return redis_client
+
+
+def is_cache_enabled() -> bool:
+    return global_settings.calc_cache_max_entries > 0
+
+
+def get_calc_settings_version(simplify_calcs: bool, backend: Optional[str]) -> str:
+    # The settings that change how the areas are calculated, and so their results
+    backend = CalculationBackend(backend or global_settings.calc_backend).value
+    if global_settings.calc_large_area_mode == "simplified":
+        mode_settings = [
+            str(global_settings.calc_large_area_threshold),
+            str(simplify_calcs),
+        ]
+    else:
+        mode_settings = [str(global_settings.calc_tile_size)]
+
+    return "|".join([global_settings.calc_large_area_mode, *mode_settings, backend])
+
+
+def get_feature_zone(
+    features: List[Dict[str, Any]], input_crs: str = "4326"
+) -> gpd.GeoDataFrame:
+    zone = gpd.GeoDataFrame.from_features(features, crs=f"EPSG:{input_crs}")
+
+    return zone.to_crs(f"EPSG:{crs}")
+
+
+def get_feature_cache_keys(
+    features: List[Dict[str, Any]],
+    input_crs: str = "4326",
+    backend: Optional[str] = None,
+) -> List[str]:
+    """
+    Cache keys for the area results of GeoJSON features. The key is a hash of
+    the normalized EPSG:3067 geometry, the zoning code, the calculation settings
+    and the versions of the static inputs and the GIS layers, so the same area
+    gets the same key in any plan calculated the same way.
+    """
+    zone = get_feature_zone(features, input_crs)
+    geometries = shapely.normalize(
+        shapely.set_precision(zone.geometry.to_numpy(), key_precision)
+    )
+    simplified = get_simplified_features(zone)
+
+    versions = {
+        simplify_calcs: "|".join(
+            [
+                calc_version,
+                get_static_inputs_version(),
+                global_settings.gis_data_version,
+                segment_table,
+                bio_carbon_table,
+                ground_carbon_table,
+                get_calc_settings_version(simplify_calcs, backend),
+                # The results are calculated for the years from the current one on
+                str(datetime.now().year),
+            ]
+        )
+        for simplify_calcs in set(simplified)
+    }
+
+    keys = []
+    for feature, geometry, simplify_calcs in zip(features, geometries, simplified):
+        key_hash = hashlib.sha256(versions[simplify_calcs].encode("utf-8"))
+        key_hash.update(shapely.to_wkb(geometry))
+        key_hash.update(
+            json.dumps(feature["properties"].get(zoning_col)).encode("utf-8")
+        )
+        keys.append(f"{key_prefix}:{key_hash.hexdigest()}")
+
+    return keys
+
+
+async def get_cached_features(keys: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Get the cached area result features of the keys, with None for the misses.
+    """
+    if not keys or not is_cache_enabled():
+        return [None] * len(keys)
+
+    try:
+        client = get_redis_client()
+        values = await client.mget(keys)
+        cached = [json.loads(value) if value else None for value in values]
+
+        hit_keys = [key for key, value in zip(keys, cached) if value is not None]
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.incrby(hits_key, len(hit_keys))
+            pipe.incrby(misses_key, len(keys) - len(hit_keys))
+            if hit_keys:
+                # Recently used entries are the last to be evicted
+                pipe.zadd(entries_key, {key: time.time() for key in hit_keys})
+            await pipe.execute()
+
+        return cached
+    except RedisError as ex:
+        logger.exception(ex)
+        return [None] * len(keys)
+
+
+async def set_cached_features(keys: List[str], features: List[Dict[str, Any]]):
+    if not keys or not is_cache_enabled():
+        return
+
+    try:
+        client = get_redis_client()
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.mset(
+                {key: json.dumps(feature) for key, feature in zip(keys, features)}
+            )
+            pipe.zadd(entries_key, {key: time.time() for key in keys})
+            pipe.zcard(entries_key)
+            entry_count = (await pipe.execute())[-1]
+
+        # The least recently used entries over the max are evicted
+        overflow = entry_count - global_settings.calc_cache_max_entries
+        if overflow > 0:
+            evicted = await client.zpopmin(entries_key, overflow)
+            if evicted:
+                await client.delete(*[key for key, _ in evicted])
+    except RedisError as ex:
+        logger.exception(ex)
+
+
+async def calculate_with_cache(
+    features: List[Dict[str, Any]],
+    backend: Optional[str] = None,
+    input_crs: str = "4326",
+) -> CalculationResult:
+    """
+    Calculate the areas of the features, in their order. Cached results are
+    reused and only the rest are calculated and then cached.
+    """
+    keys = get_feature_cache_keys(features, input_crs, backend)
+    cached = await get_cached_features(keys)
+
+    missing_idxs = [idx for idx, feature in enumerate(cached) if feature is None]
+    if missing_idxs:
+        # Each missing feature is calculated the way its key tells, so the
+        # features to simplify are calculated apart from the others
+        simplified = get_simplified_features(
+            get_feature_zone([features[idx] for idx in missing_idxs], input_crs)
+        )
+        for simplify_calcs in sorted(set(simplified)):
+            group_idxs = [
+                idx
+                for idx, is_simplified in zip(missing_idxs, simplified)
+                if is_simplified == simplify_calcs
+            ]
+            cc = CarbonCalculator(
+                {
+                    "type": "FeatureCollection",
+                    "features": [features[idx] for idx in group_idxs],
+                },
+                sort_col=None,
+                backend=backend,
+                input_crs=input_crs,
+                simplify_calcs=simplify_calcs,
+            )
+            calc_data = await cc.calculate()
+            for idx, feature in zip(
+                group_idxs, json.loads(calc_data["areas"])["features"]
+            ):
+                cached[idx] = feature
+
+        await set_cached_features(
+            [keys[idx] for idx in missing_idxs], [cached[idx] for idx in missing_idxs]
+        )
+
+    areas = []
+    for idx, (feature, area) in enumerate(zip(features, cached)):
+        # A cached result may come from another plan, with another id
+        area["id"] = str(idx)
+        area["properties"]["id"] = feature["properties"].get("id")
+        areas.append(area)
+
+    return {
+        "areas": json.dumps({"type": "FeatureCollection", "features": areas}),
+        "metadata": {"timestamp": datetime.utcnow()},
+    }
+
+
+async def get_cache_stats() -> Dict[str, int]:
+    client = get_redis_client()
+    hits, misses = await client.mget([hits_key, misses_key])
+
+    return {
+        "hits": int(hits or 0),
+        "misses": int(misses or 0),
+        "entries": await client.zcard(entries_key),
+    }
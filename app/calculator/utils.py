@@ -1,100 +1,205 @@
 import datetime
-from shapely.geometry import box
+import struct
+import shapely
 import numpy as np
 import pandas as pd
 import rioxarray as rxr
 import rasterio as rio
+from rasterio.transform import Affine
+from rasterio.io import MemoryFile
 import xarray as xr
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from numpy.typing import NDArray
 
+from app.utils.data_loader import bm_curve_key_cols
+
 variables_base_year = 2021
 current_year = datetime.datetime.now().year
 year_offset = current_year - variables_base_year
-keys_to_use = set(
-    [
-        "Region",
-        "Maingroup",
-        "Soiltype",
-        "Drainage",
-        "Fertility",
-        "Species",
-        "Structure",
-        "Regime",
-    ]
-)
 biomass_to_carbon_multiplier = 0.5
 
+tiff_signatures = {b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"}
+# Endianness, version, band count, 6 georeference doubles, srid, width, height
+wkb_raster_header_size = 1 + 2 + 2 + 6 * 8 + 4 + 2 + 2
+# PostGIS pixel types, the sub-byte types are stored as one byte per pixel
+wkb_pixel_types = {
+    0: np.uint8,  # 1BB
+    1: np.uint8,  # 2BUI
+    2: np.uint8,  # 4BUI
+    3: np.int8,  # 8BSI
+    4: np.uint8,  # 8BUI
+    5: np.int16,  # 16BSI
+    6: np.uint16,  # 16BUI
+    7: np.int32,  # 32BSI
+    8: np.uint32,  # 32BUI
+    10: np.float32,  # 32BF
+    11: np.float64,  # 64BF
+}
+
 
-async def get_bm_curve_values_for_years_mabp(
-    rasts: List[xr.DataArray],
-    years: List[str],
-    bm_curve_df: pd.DataFrame,
+def get_bm_curve_mabp_sum(
+    rast_values: NDArray[np.floating],
+    bm_curve_index: Dict[Tuple, float],
     variables_dict: dict[int, dict[str, int]],
-    rast_overlap_masks: Optional[List[xr.DataArray]] = None,
-) -> Tuple[List[Optional[dict[str, float]]], List[Optional[NDArray[np.bool_]]]]:
-    masks: List[Optional[NDArray[np.bool_] or None]] = []
-    vals: List[Optional[dict[str, float]]] = []
-    year_dict_base: dict[str, float] = {year: 0 for year in years}
-
-    for idx, rast in enumerate(rasts):
-        mask = ~np.isnan(rast.values)  # Mask for non-NaN values
-        year_dict = year_dict_base.copy()
-        was_found = False
-        try:
-            if np.any(mask):
-                for (x, y), value in np.ndenumerate(rast.values):
-                    if mask[x, y]:
-                        variables = variables_dict.get(int(value))
-                        overlap_multiplier = 1
-                        if rast_overlap_masks is not None:
-                            overlap_multiplier = rast_overlap_masks[idx][x][
-                                y
-                            ].values.item()
-
-                        if variables is not None:
-                            filtered_variables = {k: variables[k] for k in keys_to_use}
-                            condition = pd.Series([True] * len(bm_curve_df))
-                            for key, value in filtered_variables.items():
-                                condition = condition & (bm_curve_df[key] == value)
-
-                            matching_row = bm_curve_df[condition]
-                            # TODO: add a shortlist of matching rows to speed up the search
-
-                            if len(matching_row) > 0:
-                                was_found = True
-                                for year in years:
-                                    year_diff = int(year) - current_year + year_offset
-                                    mabp = float(matching_row.iloc[0]["Mabp"])
-                                    year_dict[year] += (
-                                        overlap_multiplier * mabp * year_diff
-                                    )
-            else:
-                print("No non-NaN values to iterate over.")
-        except Exception as e:
-            print(e)
-            continue
+    overlap_values: Optional[NDArray[np.floating]] = None,
+) -> Tuple[float, bool]:
+    """
+    Sum the Mabp of the biomass curve matching each pixel of a segment id raster,
+    weighted by the pixel overlap. Returns the sum and whether any pixel had a
+    matching curve.
+    """
+    mask = ~np.isnan(rast_values)  # Mask for non-NaN values
+    if not np.any(mask):
+        return 0.0, False
 
-        if was_found and (np.sum(list(year_dict.values())) > 0):
-            vals.append(year_dict)
-            masks.append(mask)
-        else:
-            vals.append(None)
-            masks.append(None)
+    # Curves are looked up once per segment id instead of once per pixel
+    ids, inverse = np.unique(rast_values[mask], return_inverse=True)
+    id_mabps = np.full(len(ids), np.nan)
+    for id_idx, id_value in enumerate(ids):
+        variables = variables_dict.get(int(id_value))
+        if variables is not None:
+            key = tuple(variables[k] for k in bm_curve_key_cols)
+            id_mabps[id_idx] = bm_curve_index.get(key, np.nan)
 
-    return vals, masks
+    pixel_mabps = id_mabps[inverse.ravel()]
+    pixel_found = ~np.isnan(pixel_mabps)
+    if not np.any(pixel_found):
+        return 0.0, False
 
+    pixel_weights = np.ones(len(pixel_mabps))
+    if overlap_values is not None:
+        pixel_weights = overlap_values[mask]
 
-def create_pixel_box(affine_transform, row, col, width, height):
+    mabp_sum = np.sum(pixel_weights[pixel_found] * pixel_mabps[pixel_found])
+
+    return float(mabp_sum), True
+
+
+def read_raster_from_bytes(raster_bytes: bytes) -> xr.DataArray:
     """
-    Create a box (rectangle) for the pixel at (row, col) with given width and height.
+    Decode a single band raster straight from memory, without a temporary file.
+    The raster can be either a GeoTIFF or a PostGIS WKB raster.
     """
+    if bytes(raster_bytes[:4]) not in tiff_signatures:
+        return read_raster_from_wkb(raster_bytes)
+
+    with MemoryFile(raster_bytes) as memfile:
+        with memfile.open() as dataset:
+            # Load the values before the in-memory dataset is closed
+            return rxr.open_rasterio(dataset, masked=True).isel(band=0).load()
+
+
+def read_raster_from_wkb(raster_bytes: bytes) -> xr.DataArray:
+    """
+    Decode the first band of a PostGIS WKB raster (ST_AsBinary) like
+    rioxarray.open_rasterio(masked=True) would, with nodata values as NaN.
+    The pixels are decoded straight from the buffer, with no temporary file,
+    and copied once when they are converted to floats.
+    """
+    endian = "<" if raster_bytes[0] == 1 else ">"
+    (
+        _version,
+        band_count,
+        scale_x,
+        scale_y,
+        ip_x,
+        ip_y,
+        skew_x,
+        skew_y,
+        srid,
+        width,
+        height,
+    ) = struct.unpack_from(f"{endian}HHddddddiHH", raster_bytes, 1)
+
+    if band_count < 1:
+        raise ValueError("The WKB raster has no bands")
+    if skew_x != 0 or skew_y != 0:
+        raise ValueError("Skewed WKB rasters are not supported")
+
+    offset = wkb_raster_header_size
+    band_flags = raster_bytes[offset]
+    if band_flags & 0x80:
+        raise ValueError("Out-db WKB raster bands are not supported")
+
+    dtype = np.dtype(wkb_pixel_types[band_flags & 0x0F]).newbyteorder(endian)
+    offset += 1
+    nodata = np.frombuffer(raster_bytes, dtype=dtype, count=1, offset=offset)[0]
+    offset += dtype.itemsize
+    pixels = np.frombuffer(
+        raster_bytes, dtype=dtype, count=width * height, offset=offset
+    ).reshape(height, width)
+
+    values = pixels.astype(np.result_type(dtype, np.float32))
+    if band_flags & 0x40:  # Has a nodata value
+        values[pixels == nodata] = np.nan
+
+    data_array = xr.DataArray(
+        values,
+        dims=("y", "x"),
+        coords={
+            "x": ip_x + scale_x * (np.arange(width) + 0.5),
+            "y": ip_y + scale_y * (np.arange(height) + 0.5),
+        },
+    )
+    if srid > 0:
+        data_array.rio.write_crs(f"EPSG:{srid}", inplace=True)
+    data_array.rio.write_transform(
+        Affine(scale_x, skew_x, ip_x, skew_y, scale_y, ip_y), inplace=True
+    )
+
+    return data_array
+
+
+def get_unique_ids(rasts: List[xr.DataArray]) -> List[int]:
+    uniq_vals = np.array([])
+    for data_array in rasts:
+        uniq_vals = np.concatenate([uniq_vals, np.unique(data_array)])
+
+    uniq_vals = np.unique(uniq_vals[~np.isnan(uniq_vals)])
+
+    return [int(val) for val in uniq_vals]
+
+
+def get_pixel_coverage(
+    affine_transform, rows: NDArray[np.int_], cols: NDArray[np.int_], geometry
+) -> NDArray[np.float64]:
+    """
+    Calculate the fraction of each pixel at (rows[i], cols[i]) that is covered by
+    the geometry. All pixels are handled in bulk with shapely 2 array operations.
+    """
+    pixel_width = affine_transform.a  # Cell width
+    pixel_height = (
+        -affine_transform.e
+    )  # Cell height (negative due to north-up convention)
+
     # Transform pixel coordinates to geographical coordinates
-    geo_x, geo_y = rio.transform.xy(affine_transform, row, col, offset="center")
-    return box(
-        geo_x - width / 2, geo_y - height / 2, geo_x + width / 2, geo_y + height / 2
+    geo_x, geo_y = rio.transform.xy(affine_transform, rows, cols, offset="center")
+    geo_x = np.asarray(geo_x, dtype=np.float64)
+    geo_y = np.asarray(geo_y, dtype=np.float64)
+
+    pixel_boxes = shapely.box(
+        geo_x - pixel_width / 2,
+        geo_y - pixel_height / 2,
+        geo_x + pixel_width / 2,
+        geo_y + pixel_height / 2,
     )
 
+    coverage = np.zeros(len(pixel_boxes), dtype=np.float64)
+
+    shapely.prepare(geometry)
+    # Pixels fully inside the geometry are covered completely and pixels that
+    # don't touch it not at all, so only the edge pixels need an intersection.
+    is_inside = shapely.contains_properly(geometry, pixel_boxes)
+    is_edge = ~is_inside & shapely.intersects(geometry, pixel_boxes)
+
+    coverage[is_inside] = 1
+    if np.any(is_edge):
+        edge_boxes = pixel_boxes[is_edge]
+        intersections = shapely.intersection(edge_boxes, geometry)
+        coverage[is_edge] = shapely.area(intersections) / shapely.area(edge_boxes)
+
+    return coverage
+
 
 def get_simplified_mask(data_array: xr.DataArray, geometry):
     new_data_array = xr.where(data_array > 0, 1, 0)
@@ -108,39 +213,104 @@ def get_overlap_mask(data_array: xr.DataArray, geometry, simplify_calcs=False):
     affine_transform = rio.transform.from_bounds(
         *data_array.rio.bounds(), data_array.rio.width, data_array.rio.height
     )
-    pixel_width = affine_transform.a  # Cell width
-    pixel_height = (
-        -affine_transform.e
-    )  # Cell height (negative due to north-up convention)
 
-    overlap_percentages = xr.DataArray(
-        np.zeros_like(data_array.values),
+    values = data_array.values
+    overlap_percentages = np.zeros_like(values)
+
+    # Only pixels with a value are considered, the rest stay at 0
+    rows, cols = np.nonzero(~np.isnan(values))
+    if len(rows) > 0:
+        overlap_percentages[rows, cols] = get_pixel_coverage(
+            affine_transform, rows, cols, geometry
+        )
+
+    return xr.DataArray(
+        overlap_percentages,
         dims=data_array.dims,
-        # coords={dim: data_array.coords[dim] for dim in data_array.dims},
         coords=data_array.coords,
     )
 
-    for row in range(data_array.rio.height):
-        for col in range(data_array.rio.width):
-            # Check if the value is not NaN
-            pixel_value = data_array.values[row, col]
-            if not np.isnan(pixel_value):
-                # Create a box for the pixel
-                try:
-                    pixel_box = create_pixel_box(
-                        affine_transform, row, col, pixel_width, pixel_height
-                    )
-                    intersection = pixel_box.intersection(geometry)
-
-                    if not intersection.is_empty:
-                        # Calculate the percentage overlap
-                        overlap_percentage = intersection.area / pixel_box.area
-                    else:
-                        overlap_percentage = 0
-                except Exception as e:
-                    print(f"An error occurred during intersection: {e}")
-                    overlap_percentage = 0
-
-                overlap_percentages[row, col] = overlap_percentage
-
-    return overlap_percentages
+
+def is_same_grid(data_array: xr.DataArray, other: xr.DataArray) -> bool:
+    return data_array.rio.shape == other.rio.shape and (
+        data_array.rio.transform().almost_equals(other.rio.transform())
+    )
+
+
+def get_shared_overlap_masks(
+    data_arrays: List[xr.DataArray], geometry, simplify_calcs=False
+) -> List[xr.DataArray]:
+    """
+    Get the overlap mask of each data array with the geometry. Data arrays on
+    the same grid share one mask, computed for every pixel that has a value in
+    any of them.
+    """
+    if simplify_calcs:
+        return [get_simplified_mask(data_array, geometry) for data_array in data_arrays]
+
+    masks: List[Optional[xr.DataArray]] = [None] * len(data_arrays)
+    for i, data_array in enumerate(data_arrays):
+        if masks[i] is not None:
+            continue
+
+        grid_idxs = [
+            j
+            for j in range(i, len(data_arrays))
+            if masks[j] is None and is_same_grid(data_array, data_arrays[j])
+        ]
+        has_value = np.any(
+            [~np.isnan(data_arrays[j].values) for j in grid_idxs], axis=0
+        )
+        overlap_mask = get_overlap_mask(
+            data_array.copy(data=np.where(has_value, 1.0, np.nan)), geometry
+        )
+
+        for j in grid_idxs:
+            # Use the coordinates of each data array, so that xarray doesn't
+            # drop pixels when aligning almost equal coordinates
+            masks[j] = xr.DataArray(
+                overlap_mask.values,
+                dims=data_arrays[j].dims,
+                coords=data_arrays[j].coords,
+            )
+
+    return masks
+
+
+def split_into_tiles(geometry, tile_size: float) -> List:
+    """
+    Split the geometry along a grid of tile_size squares anchored at the origin,
+    so that neighbouring features share the same tile edges. Returns the
+    polygonal parts of the geometry in each tile.
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    xs = np.arange(np.floor(minx / tile_size), np.ceil(maxx / tile_size))
+    ys = np.arange(np.floor(miny / tile_size), np.ceil(maxy / tile_size))
+    grid_x, grid_y = np.meshgrid(xs * tile_size, ys * tile_size)
+    tiles = shapely.box(
+        grid_x.ravel(),
+        grid_y.ravel(),
+        grid_x.ravel() + tile_size,
+        grid_y.ravel() + tile_size,
+    )
+
+    shapely.prepare(geometry)
+    tiles = tiles[shapely.intersects(geometry, tiles)]
+    parts = shapely.intersection(tiles, geometry)
+
+    # Only the areas of the parts count, lines and points on the tile edges
+    # are dropped
+    tile_geometries = []
+    for part in parts:
+        if isinstance(part, shapely.GeometryCollection):
+            part = shapely.union_all(
+                [
+                    geom
+                    for geom in part.geoms
+                    if isinstance(geom, (shapely.Polygon, shapely.MultiPolygon))
+                ]
+            )
+        if part.area > 0:
+            tile_geometries.append(part)
+
+    return tile_geometries
@@ -32,7 +32,30 @@ class Settings(BaseSettings):
     data_pg_url: (URL):
     zitadel_client_id: (str):
     zitadel_client_secret: (str):
+    gis_max_concurrent_queries: (int):
+    db_pool_size: (int):
+    db_max_overflow: (int):
+    db_pool_timeout: (float):
+    db_pool_recycle: (int):
+    db_pool_pre_ping: (bool):
+    gis_raster_format: (str):
+    gis_raster_compression: (str):
+    saq_concurrency: (int):
+    calc_process_workers: (int):
+    calc_large_area_mode: (str):
+    calc_large_area_threshold: (float):
+    calc_tile_size: (float):
+    calc_backend: (str):
+    calc_batch_max_features: (int):
+    calc_batch_target_area: (float):
+    calc_chunk_size: (int):
+    calc_cache_max_entries: (int):
+    gis_data_version: (str):
+    calc_status_cache_ttl: (float):
+    max_upload_size: (int):
     zitadel_domain: (str):
+    auth_cache_ttl: (float):
+    auth_cache_max_entries: (int):
     Returns:
     instance of Settings
     """
@@ -59,10 +82,87 @@ class Settings(BaseSettings):
         database=env_vars["STATE_PG_DB"],
     )
 
+    # Max number of GIS queries run at the same time by one process. Keep it
+    # within the pool size of pgbouncer-gis.
+    gis_max_concurrent_queries: int = int(
+        env_vars.get("GIS_MAX_CONCURRENT_QUERIES", "3")
+    )
+
+    # Connections kept open per engine and process, and the extra ones opened
+    # under load. With a pool size of 0 a connection is opened per session.
+    db_pool_size: int = int(env_vars.get("DB_POOL_SIZE", "5"))
+    db_max_overflow: int = int(env_vars.get("DB_MAX_OVERFLOW", "5"))
+    # Seconds to wait for a connection before giving up
+    db_pool_timeout: float = float(env_vars.get("DB_POOL_TIMEOUT", "30"))
+    # Seconds after which a connection is replaced, -1 to keep them
+    db_pool_recycle: int = int(env_vars.get("DB_POOL_RECYCLE", "1800"))
+    db_pool_pre_ping: bool = env_vars.get("DB_POOL_PRE_PING", "true").lower() == "true"
+
+    # How clipped rasters are transferred from the GIS DB: "tiff" for GeoTIFFs
+    # with gis_raster_compression (e.g. DEFLATE9, LZW or NONE), or "wkb" for the
+    # uncompressed raw pixels. LAN deployments can skip the compression.
+    gis_raster_format: str = env_vars.get("GIS_RASTER_FORMAT", "tiff").lower()
+    gis_raster_compression: str = env_vars.get("GIS_RASTER_COMPRESSION", "DEFLATE9")
+
+    # Number of jobs a SAQ worker runs at the same time on its event loop (I/O),
+    # and the number of processes that run the CPU bound calculation stages
+    # for those jobs. With 0 processes the calculations run on the event loop.
+    saq_concurrency: int = int(env_vars.get("SAQ_CONCURRENCY", "10"))
+    calc_process_workers: int = int(env_vars.get("CALC_PROCESS_WORKERS", "1"))
+
+    # How features larger than calc_tile_size (m) are calculated: "tiled" splits
+    # them into tiles that are fetched and summed one at a time, "simplified"
+    # uses whole pixels for the plans over calc_large_area_threshold (m2).
+    calc_large_area_mode: str = env_vars.get("CALC_LARGE_AREA_MODE", "tiled").lower()
+    calc_large_area_threshold: float = float(
+        env_vars.get("CALC_LARGE_AREA_THRESHOLD", "50000")
+    )
+    calc_tile_size: float = float(env_vars.get("CALC_TILE_SIZE", "2048"))
+
+    # Default backend for the layer sums, "raster" sums the clipped rasters in
+    # the worker and "zonal" computes the sums in PostGIS. Can be overridden
+    # per calculation with the backend query parameter.
+    calc_backend: str = env_vars.get("CALC_BACKEND", "raster").lower()
+
+    # A calculate_piece job calculates up to calc_batch_max_features features
+    # at once, as long as their area stays under calc_batch_target_area (m2).
+    # Set the max features to 1 to calculate one feature per job.
+    calc_batch_max_features: int = int(env_vars.get("CALC_BATCH_MAX_FEATURES", "200"))
+    calc_batch_target_area: float = float(
+        env_vars.get("CALC_BATCH_TARGET_AREA", "5000000")
+    )
+
+    # Number of features per calculate_chunk job. With a chunk size set, the
+    # chunks of a plan are calculated in parallel by the workers. With 0 the
+    # features are calculated in sequence by the calculate_piece jobs.
+    calc_chunk_size: int = int(env_vars.get("CALC_CHUNK_SIZE", "0"))
+
+    # Max number of area results cached in Redis, the least recently used are
+    # evicted over it. 0 disables the cache.
+    calc_cache_max_entries: int = int(env_vars.get("CALC_CACHE_MAX_ENTRIES", "100000"))
+
+    # Version of the GIS layers, part of the cache keys of the area results.
+    # Change it whenever the layers are reloaded, so that the results cached
+    # from the old layers are not reused.
+    gis_data_version: str = env_vars.get("GIS_DATA_VERSION", "1")
+
+    # Seconds the GET /calculation responses of the unfinished calculations are
+    # cached for in each API process, 0 disables the cache.
+    calc_status_cache_ttl: float = float(env_vars.get("CALC_STATUS_CACHE_TTL", "2"))
+
+    # Max size (bytes) of an uploaded plan file
+    max_upload_size: int = int(env_vars.get("MAX_UPLOAD_SIZE", str(100 * 1024 * 1024)))
+
     zitadel_domain: str = os.getenv("ZITADEL_DOMAIN") or ""
     zitadel_client_id: str = os.getenv("ZITADEL_CLIENT_ID") or ""
     zitadel_client_secret: str = os.getenv("ZITADEL_CLIENT_SECRET") or ""
 
+    # Token introspection results are cached until the token expires, but for
+    # at most auth_cache_ttl seconds so that revoked tokens stop working. 0
+    # disables the cache.
+    auth_cache_ttl: float = float(env_vars.get("AUTH_CACHE_TTL", "60"))
+    auth_cache_max_entries: int = int(env_vars.get("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
 
 @lru_cache
 def get_settings():
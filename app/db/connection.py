@@ -1,13 +1,22 @@
+import asyncio
 from collections.abc import AsyncGenerator
 from doctest import debug
 from http.client import HTTPException
 
 from fastapi.encoders import jsonable_encoder
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.engine import URL
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from contextlib import asynccontextmanager
-from sqlalchemy.pool import NullPool
-from typing import Callable, AsyncGenerator
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from typing import Any, Callable, AsyncGenerator, Dict
+from uuid import uuid4
+import time
 
 from app import config
 from app.utils.logger import get_logger
@@ -19,21 +28,89 @@ gis_url = global_settings.gis_pg_url
 state_url = global_settings.state_pg_url
 debug = global_settings.is_debug
 
-gis_engine = create_async_engine(
-    gis_url,
-    future=True,
-    echo=False,
-    poolclass=NullPool,
-    json_serializer=jsonable_encoder,
-)
-
-state_engine = create_async_engine(
-    state_url,
-    future=True,
-    echo=False,
-    poolclass=NullPool,
-    json_serializer=jsonable_encoder,
-)
+# Checkout counts and wait times (s) of the pools, by the engine name
+pool_metrics: Dict[str, Dict[str, float]] = {}
+
+
+def get_pool_metrics(name: str) -> Dict[str, float]:
+    return pool_metrics.setdefault(
+        name,
+        {"checkouts": 0, "timeouts": 0, "wait_time_total": 0.0, "wait_time_max": 0.0},
+    )
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool that records how many connections are checked out and
+    how long the checkouts wait for a free connection, by the pool_name given
+    to create_async_engine.
+    """
+
+    # A named argument, as create_engine only passes on the arguments that it
+    # finds in the signature of the pool class
+    def __init__(self, creator, pool_name: str = "default", **kwargs):
+        super().__init__(creator, **kwargs)
+        self.pool_name = pool_name
+
+    def recreate(self) -> "InstrumentedAsyncQueuePool":
+        # The engine recreates the pool e.g. after a disconnect, and the new
+        # pool has to keep recording under the same name
+        pool = super().recreate()
+        pool.pool_name = self.pool_name
+
+        return pool
+
+    def _do_get(self):
+        metrics = get_pool_metrics(self.pool_name)
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            metrics["timeouts"] += 1
+            raise
+
+        wait_time = time.perf_counter() - start
+        metrics["checkouts"] += 1
+        metrics["wait_time_total"] += wait_time
+        metrics["wait_time_max"] = max(metrics["wait_time_max"], wait_time)
+
+        return connection
+
+
+def create_engine(url: URL, name: str) -> AsyncEngine:
+    pool_args: Dict[str, Any] = {"poolclass": NullPool}
+    if global_settings.db_pool_size > 0:
+        pool_args = {
+            "poolclass": InstrumentedAsyncQueuePool,
+            "pool_size": global_settings.db_pool_size,
+            "max_overflow": global_settings.db_max_overflow,
+            "pool_timeout": global_settings.db_pool_timeout,
+            "pool_recycle": global_settings.db_pool_recycle,
+            "pool_pre_ping": global_settings.db_pool_pre_ping,
+            "pool_logging_name": name,
+            "pool_name": name,
+        }
+
+    return create_async_engine(
+        url,
+        future=True,
+        echo=False,
+        json_serializer=jsonable_encoder,
+        # pgbouncer in transaction mode can run the next transaction on another
+        # server connection, where a prepared statement doesn't exist. So the
+        # statements aren't cached, and their names are unique.
+        connect_args={
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        },
+        **pool_args,
+    )
+
+
+gis_engine = create_engine(gis_url, "gis")
+
+state_engine = create_engine(state_url, "state")
 
 # expire_on_commit=False will prevent attributes from being expired
 # after commit.
@@ -45,6 +122,9 @@ StateAsyncSessionLocal = async_sessionmaker(
     state_engine, autoflush=False, expire_on_commit=False
 )
 
+# Created on first use, so that it belongs to the running event loop
+gis_query_semaphore = None
+
 
 @asynccontextmanager
 async def base_async_db_context(
@@ -94,3 +174,44 @@ async def get_async_context_gis_db() -> AsyncGenerator:
         GisAsyncSessionLocal, f"ASYNC Pool: {gis_engine.pool.status()}"
     ) as session:
         yield session
+
+
+@asynccontextmanager
+async def get_bounded_async_context_gis_db() -> AsyncGenerator:
+    """
+    Like get_async_context_gis_db, but waits until fewer than
+    gis_max_concurrent_queries sessions are open in this process. Use it for
+    queries that are run concurrently.
+    """
+    global gis_query_semaphore
+    if gis_query_semaphore is None:
+        gis_query_semaphore = asyncio.Semaphore(
+            global_settings.gis_max_concurrent_queries
+        )
+
+    async with gis_query_semaphore:
+        async with get_async_context_gis_db() as session:
+            yield session
+
+
+def get_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    The state of the connection pools of this process and their checkout metrics.
+    """
+    stats = {}
+    for name, engine in [("gis", gis_engine), ("state", state_engine)]:
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            stats[name] = {"pooled": False}
+            continue
+
+        stats[name] = {
+            "pooled": True,
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            **get_pool_metrics(name),
+        }
+
+    return stats
@@ -3,10 +3,40 @@ from sqlalchemy.sql import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 
+from app import config
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+global_settings = config.get_settings()
+
+segment_table = "luke_mvmisegmentit_id_kokomaa"
+bio_carbon_table = "hiilikartta_kasvillisuudenhiili_2021_tcha"
+ground_carbon_table = "hiilikartta_maaperanhiili_2023_tcha"
+
+
+def get_raster_encoding(rast_sql: str) -> str:
+    """
+    SQL for encoding a raster for transfer, as configured with GIS_RASTER_FORMAT.
+    Binds the :compression parameter, see get_raster_encoding_params.
+    """
+    if global_settings.gis_raster_format == "wkb":
+        return f"ST_AsBinary({rast_sql})"
+
+    return f"ST_AsTIFF({rast_sql}, :compression)"
+
+
+def get_raster_encoding_params() -> dict:
+    if global_settings.gis_raster_format == "wkb":
+        return {}
+
+    compression = global_settings.gis_raster_compression
+    # ST_AsTIFF skips the compression with an empty string
+    if compression.upper() == "NONE":
+        compression = ""
+
+    return {"compression": compression}
+
 
 async def fetch_variables_for_ids(db_session: AsyncSession, ids: List[str]):
     try:
@@ -28,141 +58,155 @@ async def fetch_variables_for_ids(db_session: AsyncSession, ids: List[str]):
         logger.exception(ex)
 
 
-async def fetch_rasters_for_regions(
-    db_session: AsyncSession, wkts: List[str], crs: str
-):
+async def fetch_layers_for_regions(db_session: AsyncSession, wkts: List[str], crs: str):
+    """
+    Clip the segment, bio carbon and ground carbon rasters with each geometry in
+    a single query. Returns one row per geometry, in the order of the WKTs, with
+    an encoded raster for each layer (NULL if the layer has no data for the
+    geometry).
+    """
     crs_int = int(crs)
 
     try:
-        # Prepare the WKT geometries as a string to use in the SQL query
         wkt_list_str = ",".join([f"('{wkt}')" for wkt in wkts])
 
-        statement = text(
-            f"""
-            WITH rasters AS (
-                SELECT 
-                    wkt,
-                    ST_Union(rast) as union_rast,
-                    ST_SetSRID(
-                        ST_GeomFromText(wkt), 
-                        :crs
-                    ) as geom,
-                    idx as order_num
-                FROM luke_mvmisegmentit_id_kokomaa,
-                    unnest(array[{wkt_list_str}]) WITH ORDINALITY as indexed_wkt(wkt, idx)
-                WHERE ST_Intersects(
-                    rast, 
-                    ST_SetSRID(
-                        ST_GeomFromText(wkt), 
-                        :crs
-                    )
-                )
-                GROUP BY wkt, idx
-            )
-            SELECT 
-                array_agg(ST_AsTIFF(ST_Clip(union_rast, geom), 'DEFLATE9')) as tiffs,
-                order_num
-            FROM rasters
-            GROUP BY wkt, order_num;
-            """
+        # Each geometry is parsed once and then used to clip every layer
+        layer_selects = ",\n".join(
+            [
+                f"""
+                (
+                    SELECT {get_raster_encoding("ST_Clip(ST_Union(rast), geoms.geom)")}
+                    FROM {table}
+                    WHERE ST_Intersects(rast, geoms.geom)
+                ) as {layer}_rast"""
+                for layer, table in [
+                    ("segment", segment_table),
+                    ("bio_carbon", bio_carbon_table),
+                    ("ground_carbon", ground_carbon_table),
+                ]
+            ]
         )
 
-        result = await db_session.execute(statement, {"crs": crs_int})
-
-        # Fetching all rows, each row containing a raster for a WKT geometry
-        return result.fetchall()
-    except SQLAlchemyError as ex:
-        logger.exception(ex)
-
-
-async def fetch_bio_carbon_for_regions(
-    db_session: AsyncSession, wkts: List[str], crs: str
-):
-    crs_int = int(crs)
-
-    try:
-        wkt_list_str = ",".join([f"('{wkt}')" for wkt in wkts])
-
         statement = text(
             f"""
-            WITH rasters AS (
-                SELECT 
-                    wkt,
-                    ST_Union(rast) as union_rast,
-                    ST_SetSRID(
-                        ST_GeomFromText(wkt), 
-                        :crs
-                    ) as geom,
+            WITH geoms AS (
+                SELECT
+                    ST_SetSRID(ST_GeomFromText(wkt), :crs) as geom,
                     idx as order_num
-                FROM hiilikartta_kasvillisuudenhiili_2021_tcha,
-                    unnest(array[{wkt_list_str}]) WITH ORDINALITY as indexed_wkt(wkt, idx)
-                WHERE ST_Intersects(
-                    rast,
-                    ST_SetSRID(
-                        ST_GeomFromText(wkt), 
-                        :crs
-                    )
-                )
-                GROUP BY wkt, idx
+                FROM unnest(array[{wkt_list_str}]) WITH ORDINALITY as indexed_wkt(wkt, idx)
             )
-            SELECT 
-                array_agg(ST_AsTIFF(ST_Clip(union_rast, geom), 'DEFLATE9')) as tiffs,
+            SELECT {layer_selects},
                 order_num
-            FROM rasters
-            GROUP BY wkt, order_num;
+            FROM geoms
+            ORDER BY order_num;
             """
         )
 
-        result = await db_session.execute(statement, {"crs": crs_int})
+        result = await db_session.execute(
+            statement, {"crs": crs_int, **get_raster_encoding_params()}
+        )
 
         return result.fetchall()
-
     except SQLAlchemyError as ex:
         logger.exception(ex)
+        raise
 
 
-async def fetch_ground_carbon_for_regions(
-    db_session: AsyncSession, wkts: List[str], crs: str
+async def fetch_zonal_sums_for_regions(
+    db_session: AsyncSession, wkts: List[str], crs: str, pixel_buffer: float
 ):
+    """
+    Compute the zonal statistics of each geometry in PostGIS, so that only the
+    sums are transferred instead of the rasters. Each pixel is weighted by the
+    share of its area covered by the geometry. Returns one row per geometry, in
+    the order of the WKTs, with the segment ids and their summed weights, and
+    the weighted bio carbon and ground carbon sums (NULL if the layer has no
+    data for the geometry).
+    """
     crs_int = int(crs)
 
     try:
-        # Prepare the WKT geometries as a string to use in the SQL query
         wkt_list_str = ",".join([f"('{wkt}')" for wkt in wkts])
 
+        # The pixels touching the geometry with their covered share, nodata
+        # pixels are left out by ST_PixelAsPolygons
+        layer_pixels = ",\n".join(
+            [
+                f"""
+            {layer}_pixels AS (
+                SELECT
+                    geoms.order_num,
+                    pixel.val,
+                    CASE
+                        WHEN ST_Within(pixel.geom, geoms.geom) THEN 1.0
+                        ELSE ST_Area(ST_Intersection(pixel.geom, geoms.geom))
+                            / ST_Area(pixel.geom)
+                    END as weight
+                FROM geoms
+                JOIN {table} ON ST_Intersects({table}.rast, geoms.geom)
+                CROSS JOIN LATERAL ST_PixelAsPolygons(
+                    ST_Clip({table}.rast, ST_Buffer(geoms.geom, :pixel_buffer))
+                ) as pixel
+                WHERE ST_Intersects(pixel.geom, geoms.geom)
+            )"""
+                for layer, table in [
+                    ("segment", segment_table),
+                    ("bio_carbon", bio_carbon_table),
+                    ("ground_carbon", ground_carbon_table),
+                ]
+            ]
+        )
+
         statement = text(
             f"""
-            WITH rasters AS (
-                SELECT 
-                    wkt,
-                    ST_Union(rast) as union_rast,
-                    ST_SetSRID(
-                        ST_GeomFromText(wkt), 
-                        :crs
-                    ) as geom,
+            WITH geoms AS (
+                SELECT
+                    ST_SetSRID(ST_GeomFromText(wkt), :crs) as geom,
                     idx as order_num
-                FROM hiilikartta_maaperanhiili_2023_tcha,
-                    unnest(array[{wkt_list_str}]) WITH ORDINALITY as indexed_wkt(wkt, idx)
-                WHERE ST_Intersects(
-                    rast, 
-                    ST_SetSRID(
-                        ST_GeomFromText(wkt), 
-                        :crs
-                    )
-                )
-                GROUP BY wkt, idx
+                FROM unnest(array[{wkt_list_str}]) WITH ORDINALITY as indexed_wkt(wkt, idx)
+            ),
+            {layer_pixels},
+            segment_histograms AS (
+                SELECT
+                    order_num,
+                    array_agg(val ORDER BY val) as segment_ids,
+                    array_agg(weight ORDER BY val) as segment_weights
+                FROM (
+                    SELECT order_num, val::bigint as val, SUM(weight) as weight
+                    FROM segment_pixels
+                    GROUP BY order_num, val::bigint
+                ) as segment_id_weights
+                GROUP BY order_num
+            ),
+            bio_carbon_sums AS (
+                SELECT order_num, SUM(val * weight) as bio_carbon_sum
+                FROM bio_carbon_pixels
+                GROUP BY order_num
+            ),
+            ground_carbon_sums AS (
+                SELECT order_num, SUM(val * weight) as ground_carbon_sum
+                FROM ground_carbon_pixels
+                GROUP BY order_num
             )
-            SELECT 
-                array_agg(ST_AsTIFF(ST_Clip(union_rast, geom), 'DEFLATE9')) as tiffs,
-                order_num
-            FROM rasters
-            GROUP BY wkt, order_num;
+            SELECT
+                segment_histograms.segment_ids,
+                segment_histograms.segment_weights,
+                bio_carbon_sums.bio_carbon_sum,
+                ground_carbon_sums.ground_carbon_sum,
+                geoms.order_num
+            FROM geoms
+            LEFT JOIN segment_histograms USING (order_num)
+            LEFT JOIN bio_carbon_sums USING (order_num)
+            LEFT JOIN ground_carbon_sums USING (order_num)
+            ORDER BY geoms.order_num;
             """
         )
 
-        result = await db_session.execute(statement, {"crs": crs_int})
+        result = await db_session.execute(
+            statement, {"crs": crs_int, "pixel_buffer": pixel_buffer}
+        )
 
         return result.fetchall()
-
     except SQLAlchemyError as ex:
         logger.exception(ex)
+        raise
@@ -54,17 +54,26 @@ class Plan(Base):
         nullable=True,
     )
     last_area_calculation_retries = mapped_column(Integer, default=0, nullable=True)
+    # After a failed batch, the features up to this index are calculated one
+    # at a time
+    solo_until_index: Mapped[int] = mapped_column(Integer, default=-1, nullable=True)
     calculated_ts: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     calculation_updated_ts: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     calculation_status = mapped_column(
         ENUM(CalculationStatus, name="calculation_status_enum"),
         nullable=True,
     )
-    report_areas: Mapped[dict] = mapped_column(
+    report_totals: Mapped[dict] = mapped_column(
         JSONB,
         nullable=True,
     )
-    report_totals: Mapped[dict] = mapped_column(
+    # Running sums of the result columns of the plan areas
+    report_sums: Mapped[dict] = mapped_column(
+        JSONB,
+        nullable=True,
+    )
+    # GeoJSON of the union of the plan geometries in EPSG:3067
+    total_geometry: Mapped[dict] = mapped_column(
         JSONB,
         nullable=True,
     )
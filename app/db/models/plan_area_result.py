@@ -0,0 +1,23 @@
+from sqlalchemy import ForeignKey, Integer, String
+from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+from typing import Any
+
+from app.db.models.base import Base
+
+
+# The calculated area of a plan feature, one row per feature of the plan data
+class PlanAreaResult(Base):
+    __tablename__ = "plan_area_result"
+
+    plan_id: Mapped[str] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("plan.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    feature_index: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # The GeoJSON feature with the results as its properties
+    feature: Mapped[dict[str, Any]] = mapped_column(JSONB, nullable=False)
+    # Hash of the plan feature the area was calculated from, so that the result
+    # is only reused for the same feature even if the plan data is saved again
+    feature_hash: Mapped[str] = mapped_column(String, nullable=True)
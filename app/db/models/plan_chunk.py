@@ -0,0 +1,18 @@
+from sqlalchemy import ForeignKey, Integer
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.db.models.base import Base
+
+
+# A calculated chunk of the plan features, so that a chunk job that is run
+# again doesn't add its results to the plan a second time
+class PlanChunk(Base):
+    __tablename__ = "plan_chunk"
+
+    plan_id: Mapped[str] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("plan.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    start_index: Mapped[int] = mapped_column(Integer, primary_key=True)
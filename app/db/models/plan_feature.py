@@ -0,0 +1,41 @@
+from sqlalchemy import ForeignKey, Index, Integer, String
+from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.types import UserDefinedType
+from typing import Any
+
+from app.db.models.base import Base
+
+
+# A PostGIS geometry column. The state db only needs the column type, so it is
+# declared here instead of adding a dependency for it.
+class Geometry(UserDefinedType):
+    cache_ok = True
+
+    def __init__(self, geometry_type: str = "Geometry", srid: int = 3067):
+        self.geometry_type = geometry_type
+        self.srid = srid
+
+    def get_col_spec(self, **kw):
+        return f"geometry({self.geometry_type}, {self.srid})"
+
+
+# A feature of the plan data, with its geometry transformed to EPSG:3067, so
+# that single features and bbox subsets can be read without the whole data
+class PlanFeature(Base):
+    __tablename__ = "plan_feature"
+    __table_args__ = (
+        Index("ix_plan_feature_geometry", "geometry", postgresql_using="gist"),
+    )
+
+    plan_id: Mapped[str] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("plan.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    feature_index: Mapped[int] = mapped_column(Integer, primary_key=True)
+    properties: Mapped[dict[str, Any]] = mapped_column(JSONB, nullable=True)
+    geometry = mapped_column(Geometry(srid=3067), nullable=False)
+    # Hash of the GeoJSON feature in the plan data, given when the plan is
+    # calculated
+    feature_hash: Mapped[str] = mapped_column(String, nullable=True)
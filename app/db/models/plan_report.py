@@ -0,0 +1,26 @@
+from datetime import datetime
+from sqlalchemy import ForeignKey, LargeBinary, String, text
+from sqlalchemy.dialects.postgresql import UUID, TIMESTAMP
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.db.models.base import Base
+
+
+# A gzipped report response of a finished plan, served as is until the plan
+# changes
+class PlanReport(Base):
+    __tablename__ = "plan_report"
+
+    plan_id: Mapped[str] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("plan.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    kind: Mapped[str] = mapped_column(String, primary_key=True)
+    content: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # Hash of the uncompressed content
+    etag: Mapped[str] = mapped_column(String, nullable=False)
+    created_ts: Mapped[datetime] = mapped_column(
+        TIMESTAMP,
+        server_default=text("current_timestamp(0)"),
+    )
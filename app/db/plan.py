@@ -3,7 +3,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import delete, text
 from sqlalchemy.future import select
 from app.db.models.plan import Plan
-from typing import Sequence, List, Dict, Optional, Any
+from app.db.models.plan_report import PlanReport
+from typing import Sequence, List, Dict, Optional, Any, Tuple
 from uuid import UUID
 from sqlalchemy.orm import load_only
 
@@ -34,6 +35,7 @@ async def get_plan_without_data_by_ui_id(
         Plan.last_index,
         Plan.last_area_calculation_status,
         Plan.last_area_calculation_retries,
+        Plan.solo_until_index,
         Plan.calculated_ts,
         Plan.calculation_updated_ts,
         Plan.calculation_status,
@@ -47,7 +49,7 @@ async def get_plan_without_data_by_ui_id(
     return plan if plan else None
 
 
-async def get_plan_with_report_areas_by_ui_id(
+async def get_plan_with_report_sums_by_ui_id(
     db_session: AsyncSession, ui_id: UUID
 ) -> Optional[Plan]:
     cols = [
@@ -64,11 +66,12 @@ async def get_plan_with_report_areas_by_ui_id(
         Plan.last_index,
         Plan.last_area_calculation_status,
         Plan.last_area_calculation_retries,
+        Plan.solo_until_index,
         Plan.calculated_ts,
         Plan.calculation_updated_ts,
         Plan.calculation_status,
-        Plan.report_areas,
-        Plan.report_totals,
+        Plan.report_sums,
+        Plan.total_geometry,
     ]
 
     result = await db_session.execute(
@@ -79,6 +82,14 @@ async def get_plan_with_report_areas_by_ui_id(
     return plan if plan else None
 
 
+async def get_plan_report_totals(
+    db_session: AsyncSession, plan_id: UUID
+) -> Optional[Any]:
+    result = await db_session.execute(select(Plan.report_totals).filter_by(id=plan_id))
+
+    return result.scalar_one_or_none()
+
+
 async def get_plan_by_ui_id(db_session: AsyncSession, ui_id: UUID) -> Optional[Plan]:
     result = await db_session.execute(select(Plan).filter_by(ui_id=ui_id))
     plan = result.scalars().first()
@@ -157,7 +168,6 @@ async def update_plan(db_session: AsyncSession, plan: Plan) -> bool:
 #     return target_plan
 
 
-
 async def delete_plan(db_session: AsyncSession, id: str) -> bool:
     await db_session.execute(delete(Plan).filter_by(id=id))
     await db_session.commit()
@@ -186,22 +196,237 @@ async def get_feature_from_plan_by_ui_id(
     return features[0][0] if len(features) else None
 
 
-async def get_feature_from_plan_by_ui_id_and_index(
-    db_session: AsyncSession, ui_id: UUID, feature_index: int
-) -> Optional[Any]:
+# The features are read with their geometries in EPSG:3067, as stored
+plan_feature_sql = """
+    jsonb_build_object(
+        'type', 'Feature',
+        'properties', properties,
+        'geometry', CAST(ST_AsGeoJSON(geometry) AS jsonb)
+    )
+    """
+
+
+async def replace_plan_features(
+    db_session: AsyncSession,
+    plan_id: UUID,
+    feature_hashes: Optional[List[str]] = None,
+    commit: bool = True,
+) -> None:
+    """
+    Replace the features of the plan with the ones in its saved data, in the
+    same order. The hashes of the features are stored with them, for the
+    results calculated from them.
+    """
+    await db_session.execute(
+        text("DELETE FROM plan_feature WHERE plan_id = :plan_id"),
+        {"plan_id": plan_id},
+    )
+
+    # The data is split in SQL, so it isn't sent to the db a second time
     raw_sql = """
-        SELECT (data->'features'->CAST(:feature_index as INTEGER)) AS feature
-        FROM plan
-        WHERE ui_id = :plan_id
+        INSERT INTO plan_feature
+            (plan_id, feature_index, properties, geometry, feature_hash)
+        SELECT plan.id, features.idx - 1, features.feature->'properties',
+            ST_Transform(
+                ST_SetSRID(ST_GeomFromGeoJSON(features.feature->'geometry'), 4326),
+                3067
+            ),
+            hashes.feature_hash
+        FROM plan,
+            jsonb_array_elements(plan.data->'features')
+                WITH ORDINALITY AS features(feature, idx)
+            LEFT JOIN jsonb_array_elements_text(CAST(:feature_hashes AS jsonb))
+                WITH ORDINALITY AS hashes(feature_hash, idx)
+                ON hashes.idx = features.idx
+        WHERE plan.id = :plan_id
+            AND jsonb_typeof(features.feature->'geometry') = 'object'
+        """
+
+    await db_session.execute(
+        text(raw_sql),
+        {"plan_id": plan_id, "feature_hashes": json.dumps(feature_hashes or [])},
+    )
+
+    if commit:
+        await db_session.commit()
+
+
+async def get_plan_feature_by_index(
+    db_session: AsyncSession, plan_id: UUID, feature_index: int
+) -> Optional[Dict[str, Any]]:
+    raw_sql = f"""
+        SELECT {plan_feature_sql}
+        FROM plan_feature
+        WHERE plan_id = :plan_id AND feature_index = :feature_index
         """
 
     result = await db_session.execute(
-        text(raw_sql), {"plan_id": ui_id, "feature_index": feature_index}
+        text(raw_sql), {"plan_id": plan_id, "feature_index": feature_index}
     )
-    features = result.fetchall()
 
-    # Return the first matching feature or None
-    return features[0][0] if len(features) else None
+    return result.scalar_one_or_none()
+
+
+async def get_uncalculated_plan_features(
+    db_session: AsyncSession, plan_id: UUID, start_index: int, count: int
+) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    The features in the index range that don't have a calculated area yet, as
+    (feature index, feature) pairs. The areas carried over from an earlier
+    calculation of the plan are left out.
+    """
+    raw_sql = f"""
+        SELECT feature_index, {plan_feature_sql}
+        FROM plan_feature
+        WHERE plan_id = :plan_id
+            AND feature_index >= :start_index
+            AND feature_index < :start_index + :count
+            AND NOT EXISTS (
+                SELECT 1
+                FROM plan_area_result
+                WHERE plan_area_result.plan_id = plan_feature.plan_id
+                    AND plan_area_result.feature_index = plan_feature.feature_index
+            )
+        ORDER BY feature_index
+        """
+
+    result = await db_session.execute(
+        text(raw_sql),
+        {"plan_id": plan_id, "start_index": start_index, "count": count},
+    )
+
+    return [(row[0], row[1]) for row in result.fetchall()]
+
+
+async def get_plan_features_in_bbox(
+    db_session: AsyncSession,
+    plan_id: UUID,
+    bbox: Tuple[float, float, float, float],
+) -> Dict[str, Any]:
+    """
+    The features of the plan that intersect the EPSG:4326 bbox, as a feature
+    collection in EPSG:4326.
+    """
+    raw_sql = """
+        SELECT jsonb_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(
+                jsonb_agg(
+                    jsonb_build_object(
+                        'type', 'Feature',
+                        'properties', properties,
+                        'geometry',
+                            CAST(ST_AsGeoJSON(ST_Transform(geometry, 4326)) AS jsonb)
+                    )
+                    ORDER BY feature_index
+                ),
+                '[]'::jsonb
+            )
+        )
+        FROM plan_feature
+        WHERE plan_id = :plan_id
+            AND ST_Intersects(
+                geometry,
+                ST_Transform(
+                    ST_MakeEnvelope(:min_x, :min_y, :max_x, :max_y, 4326), 3067
+                )
+            )
+        """
+
+    min_x, min_y, max_x, max_y = bbox
+    result = await db_session.execute(
+        text(raw_sql),
+        {
+            "plan_id": plan_id,
+            "min_x": min_x,
+            "min_y": min_y,
+            "max_x": max_x,
+            "max_y": max_y,
+        },
+    )
+
+    return result.scalar_one()
+
+
+async def advance_plan_last_index(
+    db_session: AsyncSession, plan_id: UUID, count: int
+) -> Tuple[int, int]:
+    # The increment is done in SQL so that concurrent jobs can't overwrite
+    # each other's progress
+    raw_sql = """
+        UPDATE plan
+        SET last_index = last_index + :count,
+            calculation_updated_ts = now()
+        WHERE id = :plan_id
+        RETURNING last_index, total_indices
+        """
+
+    result = await db_session.execute(
+        text(raw_sql), {"plan_id": plan_id, "count": count}
+    )
+    last_index, total_indices = result.fetchone()
+
+    await db_session.commit()
+
+    return last_index, total_indices
+
+
+async def claim_plan_features(
+    db_session: AsyncSession, plan_id: UUID, start_index: int, count: int
+) -> bool:
+    # The index only moves if no other job has moved it since the features were
+    # read, so that a duplicated job can't write its results a second time.
+    # Not committed, the results are committed together with the claim.
+    raw_sql = """
+        UPDATE plan
+        SET last_index = :start_index + :count - 1
+        WHERE id = :plan_id AND last_index = :start_index - 1
+        RETURNING last_index
+        """
+
+    result = await db_session.execute(
+        text(raw_sql),
+        {"plan_id": plan_id, "start_index": start_index, "count": count},
+    )
+
+    return result.fetchone() is not None
+
+
+async def skip_calculated_plan_features(db_session: AsyncSession, plan_id: UUID) -> int:
+    # The index is moved past the features after it that already have an area,
+    # carried over from an earlier calculation, up to the next feature without
+    # one. Done in SQL, like the claim, so that it only moves forward.
+    raw_sql = """
+        UPDATE plan
+        SET last_index = GREATEST(
+            last_index,
+            COALESCE(
+                (
+                    SELECT min(plan_feature.feature_index) - 1
+                    FROM plan_feature
+                    WHERE plan_feature.plan_id = plan.id
+                        AND plan_feature.feature_index > plan.last_index
+                        AND NOT EXISTS (
+                            SELECT 1
+                            FROM plan_area_result
+                            WHERE plan_area_result.plan_id = plan_feature.plan_id
+                                AND plan_area_result.feature_index
+                                    = plan_feature.feature_index
+                        )
+                ),
+                total_indices - 1
+            )
+        )
+        WHERE id = :plan_id
+        RETURNING last_index
+        """
+
+    result = await db_session.execute(text(raw_sql), {"plan_id": plan_id})
+    last_index = result.scalar_one()
+
+    await db_session.commit()
+
+    return last_index
 
 
 async def add_feature_to_plan_areas(
@@ -226,30 +451,202 @@ async def add_feature_to_plan_areas(
     await db_session.commit()
 
 
-async def add_feature_collection_to_plan_areas(
-    db_session: AsyncSession, plan_id: UUID, new_feature_collection_json: str
+async def add_plan_area_results(
+    db_session: AsyncSession,
+    plan_id: UUID,
+    areas: List[Tuple[int, dict]],
+    commit: bool = True,
 ) -> None:
-    # Convert the new feature collection dict to JSON
-    new_features_jsonb = f"'{new_feature_collection_json}'::jsonb->'features'"
+    """
+    Add the calculated areas of the plan features, as (feature index, area
+    feature) pairs. An area already calculated for the index is replaced. The
+    areas get the hashes of their plan features.
+    """
+    if not areas:
+        return
 
-    # SQL to update the 'areas' field by merging the new feature collection
-    raw_sql = f"""
-                UPDATE plan
-                SET report_areas = jsonb_set(
-                    report_areas, 
-                    '{{features}}', 
-                    COALESCE(report_areas->'features', '[]'::jsonb) || COALESCE({new_features_jsonb}, '[]'::jsonb)
+    areas_json = json.dumps(
+        [{"index": index, "feature": feature} for index, feature in areas]
+    )
+
+    # One row is written per feature, the other results are left untouched
+    raw_sql = """
+        INSERT INTO plan_area_result (plan_id, feature_index, feature, feature_hash)
+        SELECT :plan_id, (area->>'index')::int, area->'feature',
+            plan_feature.feature_hash
+        FROM jsonb_array_elements(CAST(:areas AS jsonb)) AS area
+            LEFT JOIN plan_feature
+                ON plan_feature.plan_id = :plan_id
+                AND plan_feature.feature_index = (area->>'index')::int
+        ON CONFLICT (plan_id, feature_index)
+        DO UPDATE SET feature = EXCLUDED.feature,
+            feature_hash = EXCLUDED.feature_hash
+        """
+
+    await db_session.execute(text(raw_sql), {"plan_id": plan_id, "areas": areas_json})
+
+    if commit:
+        await db_session.commit()
+
+
+async def delete_plan_area_results(
+    db_session: AsyncSession, plan_id: UUID, commit: bool = True
+) -> None:
+    await db_session.execute(
+        text("DELETE FROM plan_area_result WHERE plan_id = :plan_id"),
+        {"plan_id": plan_id},
+    )
+
+    if commit:
+        await db_session.commit()
+
+
+async def add_plan_chunk(
+    db_session: AsyncSession, plan_id: UUID, start_index: int
+) -> bool:
+    # False if the chunk was already added. Not committed, the chunk is
+    # committed together with its results.
+    raw_sql = """
+        INSERT INTO plan_chunk (plan_id, start_index)
+        VALUES (:plan_id, :start_index)
+        ON CONFLICT (plan_id, start_index) DO NOTHING
+        RETURNING start_index
+        """
+
+    result = await db_session.execute(
+        text(raw_sql), {"plan_id": plan_id, "start_index": start_index}
+    )
+
+    return result.fetchone() is not None
+
+
+async def delete_plan_chunks(
+    db_session: AsyncSession, plan_id: UUID, commit: bool = True
+) -> None:
+    await db_session.execute(
+        text("DELETE FROM plan_chunk WHERE plan_id = :plan_id"),
+        {"plan_id": plan_id},
+    )
+
+    if commit:
+        await db_session.commit()
+
+
+async def get_plan_report_areas(db_session: AsyncSession, plan_id: UUID) -> dict:
+    """
+    The calculated areas of the plan as a feature collection, in the order of
+    the plan features.
+    """
+    raw_sql = """
+        SELECT jsonb_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(jsonb_agg(feature ORDER BY feature_index), '[]'::jsonb)
+        )
+        FROM plan_area_result
+        WHERE plan_id = :plan_id
+        """
+
+    result = await db_session.execute(text(raw_sql), {"plan_id": plan_id})
+
+    return result.scalar_one()
+
+
+async def count_plan_area_results(db_session: AsyncSession, plan_id: UUID) -> int:
+    result = await db_session.execute(
+        text("SELECT count(*) FROM plan_area_result WHERE plan_id = :plan_id"),
+        {"plan_id": plan_id},
+    )
+
+    return result.scalar_one()
+
+
+async def get_plan_area_results_with_hashes(
+    db_session: AsyncSession, plan_id: UUID
+) -> List[Tuple[dict, Optional[str]]]:
+    """
+    The calculated areas of the plan, in the order of the plan features, with
+    the hashes of the features they were calculated from.
+    """
+    raw_sql = """
+        SELECT feature, feature_hash
+        FROM plan_area_result
+        WHERE plan_id = :plan_id
+        ORDER BY feature_index
+        """
+
+    result = await db_session.execute(text(raw_sql), {"plan_id": plan_id})
+
+    return [(row[0], row[1]) for row in result.fetchall()]
+
+
+async def add_to_plan_report_sums(
+    db_session: AsyncSession,
+    plan_id: UUID,
+    sums: Dict[str, float],
+    commit: bool = True,
+) -> None:
+    # The sums are added in SQL so that concurrent jobs can't overwrite each
+    # other's sums
+    raw_sql = """
+        UPDATE plan
+        SET report_sums = COALESCE(report_sums, '{}'::jsonb) || COALESCE(
+            (
+                SELECT jsonb_object_agg(
+                    new_sums.key,
+                    COALESCE((plan.report_sums->>new_sums.key)::float8, 0)
+                        + new_sums.value::float8
                 )
-                WHERE id = :plan_id
-                """
+                FROM jsonb_each_text(CAST(:sums AS jsonb)) AS new_sums
+            ),
+            '{}'::jsonb
+        )
+        WHERE id = :plan_id
+        """
 
-    # Execute the SQL command
     await db_session.execute(
-        text(raw_sql),
-        {
-            "plan_id": plan_id,
-        },
+        text(raw_sql), {"plan_id": plan_id, "sums": json.dumps(sums)}
     )
 
-    # Commit the changes
+    if commit:
+        await db_session.commit()
+
+
+async def get_plan_report(
+    db_session: AsyncSession, plan_id: UUID, kind: str
+) -> Optional[PlanReport]:
+    result = await db_session.execute(
+        select(PlanReport).filter_by(plan_id=plan_id, kind=kind)
+    )
+
+    return result.scalars().first()
+
+
+async def save_plan_report(
+    db_session: AsyncSession, plan_id: UUID, kind: str, content: bytes, etag: str
+) -> None:
+    raw_sql = """
+        INSERT INTO plan_report (plan_id, kind, content, etag)
+        VALUES (:plan_id, :kind, :content, :etag)
+        ON CONFLICT (plan_id, kind)
+        DO UPDATE SET content = EXCLUDED.content,
+            etag = EXCLUDED.etag,
+            created_ts = current_timestamp(0)
+        """
+
+    await db_session.execute(
+        text(raw_sql),
+        {"plan_id": plan_id, "kind": kind, "content": content, "etag": etag},
+    )
     await db_session.commit()
+
+
+async def delete_plan_reports(
+    db_session: AsyncSession, plan_id: UUID, commit: bool = True
+) -> None:
+    await db_session.execute(
+        text("DELETE FROM plan_report WHERE plan_id = :plan_id"),
+        {"plan_id": plan_id},
+    )
+
+    if commit:
+        await db_session.commit()
@@ -1,5 +1,3 @@
-import shutil
-import tempfile
 from fastapi import (
     FastAPI,
     Depends,
@@ -14,20 +12,38 @@ from fastapi import (
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.ext.asyncio import AsyncSession
-import gzip
+from redis.exceptions import RedisError
 import json
 from uuid import UUID
 from contextlib import asynccontextmanager
-import geopandas as gpd
 from typing import Dict, Any
 import datetime
 
-from app.types.general import CalculationStatus
-from app.db.connection import get_async_context_gis_db, get_async_state_db
+from app import config
+from app.types.general import (
+    CalculationBackend,
+    CalculationStatus,
+    ExportFormat,
+    ReportKind,
+)
+from app.db.connection import (
+    get_async_context_gis_db,
+    get_async_state_db,
+    get_pool_stats,
+)
 from app.db.plan import (
+    add_plan_area_results,
+    delete_plan_area_results,
+    delete_plan_chunks,
+    delete_plan_reports,
+    get_plan_features_in_bbox,
+    get_plan_report_areas,
+    get_plan_area_results_with_hashes,
     get_plan_stats_by_user_id,
     get_plan_without_data_by_ui_id,
+    replace_plan_features,
     update_plan,
     get_plan_by_ui_id,
     create_plan,
@@ -35,12 +51,34 @@ from app.db.plan import (
 )  # Import the methods from plan.py
 from app.db.models.plan import Plan
 from app.utils.logger import get_logger
+from app.calculator.calculator import get_area_sums
+from app.calculator.result_cache import get_cache_stats
+from app.utils.plan_diff import get_plan_data_hashes, merge_unchanged_plan_data
+from app.utils.plan_file import PlanFileError, read_plan_file
+from app.utils.report import (
+    compress_content,
+    export_file_extensions,
+    export_media_types,
+    export_report_areas,
+    get_or_create_plan_report,
+    is_etag_match,
+)
+from app.utils.ttl_cache import TTLCache
 from app.utils.data_loader import load_area_multipliers, load_bm_curves, unload_files
-from app.saq_worker import queue
-from app.auth.validator import ZitadelIntrospectTokenValidator, ValidatorError
+from app.saq_worker import enqueue_plan_calculation
+from app.auth.validator import (
+    ZitadelIntrospectTokenValidator,
+    ValidatorError,
+    close_http_client,
+)
 
 logger = get_logger(__name__)
 
+global_settings = config.get_settings()
+
+# The status responses of the unfinished calculations, by plan ui_id
+calculation_status_cache = TTLCache(global_settings.calc_status_cache_ttl)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -51,6 +89,7 @@ async def lifespan(app: FastAPI):
     yield
 
     unload_files()
+    await close_http_client()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -78,7 +117,7 @@ async def get_current_user(token: str = Security(oauth2_scheme)):
     user_id = None
 
     try:
-        data = validator.introspect_token(token)
+        data = await validator.introspect_token(token)
         validator.validate_token(data, "")
         user_id = data.get("sub")
     except ValidatorError as ex:
@@ -103,74 +142,76 @@ async def get_current_user_optional(token: str = Security(oauth2_scheme_optional
         return None
 
 
-def process_and_create_plan(file, ui_id, visible_ui_id, name, user_id=None, plan=None):
-    # Use a temporary file to process the data
-    temp_file_path = None
-    with tempfile.NamedTemporaryFile(
-        delete=True, suffix=f"{ui_id}.zip", dir="/tmp"
-    ) as temp_file:
-        shutil.copyfileobj(file.file, temp_file)
-        temp_file_path = temp_file.name
-        temp_file.flush()
-        data = gpd.read_file(temp_file_path, index_col="id")
-        data.set_crs("EPSG:4326", inplace=True, allow_override=True)
-
-        data = data[
-            data.geometry.notna()
-            & data.geometry.apply(
-                lambda geom: geom.geom_type in ["Polygon", "MultiPolygon"]
-            )
-        ]
-        data["is_valid"] = data["geometry"].is_valid
-        # Fixing invalid geometries with buffer(0)
-        data.loc[~data["is_valid"], "geometry"] = data.loc[
-            ~data["is_valid"], "geometry"
-        ].apply(lambda geom: geom.buffer(0))
-        data = data[data.geometry.is_valid]
-        data.drop(columns=["is_valid"], inplace=True)
-
-        total_indices = len(data)
-        data = data.to_json()
-
-        if plan:
-            plan.data = data
-            plan.total_indices = total_indices
-            plan.saved_ts = datetime.datetime.utcnow()
-
-            if plan.user_id is None and user_id:
-                plan.user_id = user_id
-
-            return plan
-
-        else:
-            new_plan = Plan(
-                ui_id=ui_id,
-                visible_ui_id=visible_ui_id,
-                name=name,
-                calculation_status=CalculationStatus.NOT_STARTED.value,
-                data=data,
-                total_indices=total_indices,
-                last_index=-1,
-                last_area_calculation_retries=0,
-                report_areas=json.dumps({"type": "FeatureCollection", "features": []}),
-                report_totals=None,
-                calculated_ts=None,
-                last_area_calculation_status=None,
-                saved_ts=datetime.datetime.now(),
-                user_id=user_id,
-            )
+async def process_and_create_plan(
+    file, ui_id, visible_ui_id, name, user_id=None, plan=None
+):
+    if file.size is not None and file.size > global_settings.max_upload_size:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"The file is larger than {global_settings.max_upload_size} bytes.",
+        )
+
+    # The upload is read in a thread, so that it doesn't block other requests
+    try:
+        data, total_indices, total_geometry = await run_in_threadpool(
+            read_plan_file, file.file, ui_id
+        )
+    except PlanFileError as ex:
+        raise HTTPException(status_code=ex.status_code, detail=ex.detail)
+
+    if plan:
+        plan.data = data
+        plan.total_indices = total_indices
+        plan.total_geometry = total_geometry
+        plan.saved_ts = datetime.datetime.utcnow()
+
+        if plan.user_id is None and user_id:
+            plan.user_id = user_id
+
+        return plan
+
+    else:
+        new_plan = Plan(
+            ui_id=ui_id,
+            visible_ui_id=visible_ui_id,
+            name=name,
+            calculation_status=CalculationStatus.NOT_STARTED.value,
+            data=data,
+            total_indices=total_indices,
+            last_index=-1,
+            last_area_calculation_retries=0,
+            solo_until_index=-1,
+            report_totals=None,
+            report_sums=json.dumps({}),
+            total_geometry=total_geometry,
+            calculated_ts=None,
+            last_area_calculation_status=None,
+            saved_ts=datetime.datetime.now(),
+            user_id=user_id,
+        )
 
-            return new_plan
+        return new_plan
 
 
 async def zip_response_data(data):
-    json_str = json.dumps(data)
-    json_bytes = json_str.encode("utf-8")
-    gzipped_json = gzip.compress(json_bytes)
+    # Serialized and compressed in a thread, so large plans don't block the loop
+    gzipped_json, _ = await run_in_threadpool(compress_content, data)
 
     return gzipped_json
 
 
+def get_report_response(request: Request, content: bytes, etag: str) -> Response:
+    headers = {"ETag": etag}
+    if is_etag_match(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(
+        content=content,
+        status_code=status.HTTP_200_OK,
+        headers={"Content-Encoding": "gzip", **headers},
+    )
+
+
 @app.post("/calculation")
 async def calculate(
     request: Request,
@@ -200,6 +241,16 @@ async def calculate(
             detail="Name parameter is missing.",
         )
 
+    backend = request.query_params.get("backend")
+    if backend:
+        try:
+            backend = CalculationBackend(backend.lower()).value
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="The provided backend is not valid.",
+            )
+
     plan = await get_plan_without_data_by_ui_id(state_db_session, ui_id)
 
     if plan and plan.calculation_status.value == CalculationStatus.PROCESSING.value:
@@ -209,29 +260,66 @@ async def calculate(
         )
 
     if plan:
-        plan = process_and_create_plan(file, ui_id, visible_ui_id, name, plan=plan)
+        # The results of a finished calculation can be reused for the features
+        # that are unchanged, as long as they were calculated this year. The
+        # features are compared to the ones the results were calculated from,
+        # as the plan data may have been saved again since.
+        old_results = None
+        if (
+            plan.calculation_status.value == CalculationStatus.FINISHED.value
+            and plan.calculated_ts
+            and plan.calculated_ts.year == datetime.datetime.utcnow().year
+        ):
+            old_results = await get_plan_area_results_with_hashes(
+                state_db_session, plan.id
+            )
+
+        plan = await process_and_create_plan(
+            file, ui_id, visible_ui_id, name, plan=plan
+        )
+        report_areas, feature_hashes = await run_in_threadpool(
+            merge_unchanged_plan_data, old_results, plan.data
+        )
+
+        # The data keeps the uploaded order, and the worker skips the features
+        # that have a carried over area
         plan.calculation_status = CalculationStatus.PROCESSING
         plan.last_index = -1
         plan.last_area_calculation_retries = 0
-        plan.report_areas = json.dumps({"type": "FeatureCollection", "features": []})
+        plan.solo_until_index = -1
+        plan.report_sums = json.dumps(
+            get_area_sums({"features": [area for _, area in report_areas]})
+        )
         plan.report_totals = None
         plan.calculated_ts = None
         plan.calculation_updated_ts = None
         plan.last_area_calculation_retries = 0
 
+        # The carried over results replace the old ones. They are added after
+        # the features, from which they get their hashes.
+        await delete_plan_area_results(state_db_session, plan.id, commit=False)
+        await delete_plan_chunks(state_db_session, plan.id, commit=False)
+        await delete_plan_reports(state_db_session, plan.id, commit=False)
         await update_plan(state_db_session, plan)
+        await replace_plan_features(
+            state_db_session, plan.id, feature_hashes, commit=False
+        )
+        await add_plan_area_results(state_db_session, plan.id, report_areas)
     else:
         user_id = None
         if current_user:
             user_id = current_user.get("user_id")
-        plan = process_and_create_plan(file, ui_id, visible_ui_id, name, user_id)
+        plan = await process_and_create_plan(file, ui_id, visible_ui_id, name, user_id)
         plan.calculation_status = CalculationStatus.PROCESSING
+        feature_hashes = await run_in_threadpool(get_plan_data_hashes, plan.data)
 
         await create_plan(
             state_db_session, plan
         )  # Pass the new plan to create_plan function
+        await replace_plan_features(state_db_session, plan.id, feature_hashes)
 
-    await queue.enqueue("calculate_piece", ui_id=str(ui_id), retries=3, timeout=172800)
+    await enqueue_plan_calculation(plan, backend)
+    calculation_status_cache.delete(ui_id)
 
     return {
         "status": CalculationStatus.PROCESSING.value,
@@ -252,10 +340,18 @@ async def get_calculation_status(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="The provided ID is not a valid UUID.",
         )
-    plan = await get_plan_by_ui_id(state_db_session, ui_id)
 
     headers = {"Content-Encoding": "gzip"}
 
+    # Polls of an unfinished calculation get the same status for a while
+    cached = calculation_status_cache.get(ui_id)
+    if cached:
+        content, status_code = cached
+        return Response(content=content, headers=headers, status_code=status_code)
+
+    # The data and reports aren't loaded for the status
+    plan = await get_plan_without_data_by_ui_id(state_db_session, ui_id)
+
     if not plan:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Calculation not found."
@@ -274,35 +370,30 @@ async def get_calculation_status(
     }
 
     if plan.calculation_status.value == CalculationStatus.PROCESSING.value:
+        zipped_content = await zip_response_data(content)
+        calculation_status_cache.set(ui_id, (zipped_content, status.HTTP_202_ACCEPTED))
         return Response(
-            content=await zip_response_data(content),
+            content=zipped_content,
             headers=headers,
             status_code=status.HTTP_202_ACCEPTED,
         )
 
     if plan.calculation_status.value == CalculationStatus.ERROR.value:
+        zipped_content = await zip_response_data(content)
+        calculation_status_cache.set(
+            ui_id, (zipped_content, status.HTTP_206_PARTIAL_CONTENT)
+        )
         return Response(
-            content=await zip_response_data(content),
+            content=zipped_content,
             headers=headers,
             status_code=status.HTTP_206_PARTIAL_CONTENT,
         )
 
     if plan.calculation_status.value == CalculationStatus.FINISHED.value:
-        content["data"] = {
-            "totals": plan.report_totals,
-            "areas": plan.report_areas,
-            "metadata": {
-                "report_name": plan.name,
-                "calculated_ts": (
-                    int(plan.calculated_ts.timestamp()) if plan.calculated_ts else None
-                ),
-            },
-        }
-        return Response(
-            content=await zip_response_data(content),
-            status_code=status.HTTP_200_OK,
-            headers=headers,
+        report, etag = await get_or_create_plan_report(
+            state_db_session, plan, ReportKind.CALCULATION.value
         )
+        return get_report_response(request, report, etag)
 
     raise HTTPException(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -310,6 +401,63 @@ async def get_calculation_status(
     )
 
 
+@app.get("/calculation/export")
+async def export_calculation(
+    request: Request, state_db_session: AsyncSession = Depends(get_async_state_db)
+):
+    try:
+        ui_id: UUID = UUID(request.query_params.get("id"))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The provided ID is not a valid UUID.",
+        )
+
+    try:
+        export_format = ExportFormat(
+            request.query_params.get("format", ExportFormat.GEOPARQUET.value).lower()
+        ).value
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The provided format is not valid.",
+        )
+
+    # Glob patterns of the result columns to export, e.g. "*_ha_*,*planned*"
+    columns = request.query_params.get("columns")
+    column_patterns = (
+        [pattern.strip() for pattern in columns.split(",") if pattern.strip()]
+        if columns
+        else None
+    )
+
+    plan = await get_plan_without_data_by_ui_id(state_db_session, ui_id)
+
+    if not plan:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Calculation not found."
+        )
+
+    if plan.calculation_status.value != CalculationStatus.FINISHED.value:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The calculation is not finished.",
+        )
+
+    areas = await get_plan_report_areas(state_db_session, plan.id)
+    content = await run_in_threadpool(
+        export_report_areas, areas, export_format, column_patterns
+    )
+
+    file_name = f"{ui_id}.{export_file_extensions[export_format]}"
+
+    return Response(
+        content=content,
+        media_type=export_media_types[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
+
+
 @app.get("/plan/external")
 async def get_plan_external(
     request: Request, state_db_session: AsyncSession = Depends(get_async_state_db)
@@ -321,7 +469,7 @@ async def get_plan_external(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="The provided ID is not a valid UUID.",
         )
-    plan = await get_plan_by_ui_id(state_db_session, ui_id)
+    plan = await get_plan_without_data_by_ui_id(state_db_session, ui_id)
 
     headers = {"Content-Encoding": "gzip"}
 
@@ -330,22 +478,17 @@ async def get_plan_external(
             status_code=status.HTTP_404_NOT_FOUND, detail="Calculation not found."
         )
 
+    if plan.calculation_status.value == CalculationStatus.FINISHED.value:
+        report, etag = await get_or_create_plan_report(
+            state_db_session, plan, ReportKind.EXTERNAL.value
+        )
+        return get_report_response(request, report, etag)
+
     content: Dict[str, Any] = {
         "id": str(ui_id),
         "name": plan.name,
     }
 
-    if plan.calculation_status.value == CalculationStatus.FINISHED.value:
-        content["report_data"] = {
-            "totals": plan.report_totals,
-            "areas": plan.report_areas,
-            "metadata": {
-                "calculated_ts": (
-                    int(plan.calculated_ts.timestamp()) if plan.calculated_ts else None
-                ),
-            },
-        }
-
     return Response(
         content=await zip_response_data(content),
         status_code=status.HTTP_200_OK,
@@ -394,9 +537,14 @@ async def create_update_plan(
     plan = await get_plan_without_data_by_ui_id(state_db_session, ui_id)
 
     if plan:
-        plan = process_and_create_plan(file, ui_id, visible_ui_id, name, plan=plan)
+        plan = await process_and_create_plan(
+            file, ui_id, visible_ui_id, name, plan=plan
+        )
 
+        # The stored reports have the old name of the plan
+        await delete_plan_reports(state_db_session, plan.id, commit=False)
         await update_plan(state_db_session, plan)
+        await replace_plan_features(state_db_session, plan.id)
 
         return JSONResponse(
             content={
@@ -407,11 +555,14 @@ async def create_update_plan(
             status_code=status.HTTP_200_OK,
         )
     else:
-        new_plan = process_and_create_plan(file, ui_id, visible_ui_id, name, user_id)
+        new_plan = await process_and_create_plan(
+            file, ui_id, visible_ui_id, name, user_id
+        )
 
         await create_plan(
             state_db_session, new_plan
         )  # Pass the new plan to create_plan function
+        await replace_plan_features(state_db_session, new_plan.id)
 
         return JSONResponse(
             content={
@@ -482,7 +633,7 @@ async def get_plan(
     if plan.calculated_ts is not None and plan.report_totals is not None:
         content["report_data"] = {
             "totals": plan.report_totals,
-            "areas": plan.report_areas,
+            "areas": await get_plan_report_areas(state_db_session, plan.id),
             "metadata": {
                 "calculated_ts": (
                     int(plan.calculated_ts.timestamp()) if plan.calculated_ts else None
@@ -497,6 +648,67 @@ async def get_plan(
     )
 
 
+@app.get("/plan/features")
+async def get_plan_features(
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    state_db_session: AsyncSession = Depends(get_async_state_db),
+):
+    user_id = current_user.get("user_id")
+
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    try:
+        ui_id: UUID = UUID(request.query_params.get("id"))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The provided ID is not a valid UUID.",
+        )
+
+    # The bbox is given in EPSG:4326 as min_x,min_y,max_x,max_y
+    try:
+        bbox = [float(coord) for coord in request.query_params["bbox"].split(",")]
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError()
+    except (KeyError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The provided bbox is not valid.",
+        )
+
+    plan = await get_plan_without_data_by_ui_id(state_db_session, ui_id)
+
+    if not plan:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Plan not found."
+        )
+
+    if plan.user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Plan does not belong to the user.",
+        )
+
+    headers = {"Content-Encoding": "gzip"}
+
+    content = {
+        "id": str(ui_id),
+        "data": await get_plan_features_in_bbox(state_db_session, plan.id, tuple(bbox)),
+    }
+
+    return Response(
+        content=await zip_response_data(content),
+        status_code=status.HTTP_200_OK,
+        headers=headers,
+    )
+
+
 @app.delete("/plan")
 async def del_plan(
     request: Request,
@@ -535,6 +747,7 @@ async def del_plan(
             )
 
     was_deleted = await delete_plan(state_db_session, plan.id)
+    calculation_status_cache.delete(ui_id)
 
     if not was_deleted:
         raise HTTPException(
@@ -572,3 +785,16 @@ async def get_user_plans(
         )
 
     return {"stats": parsed_stats}
+
+
+@app.get("/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    # The pool metrics are of this API process, the cache is shared. Only for
+    # signed in users, like the other routes, as they show the internals.
+    calc_cache = None
+    try:
+        calc_cache = await get_cache_stats()
+    except RedisError as ex:
+        logger.exception(ex)
+
+    return {"db_pools": get_pool_stats(), "calc_cache": calc_cache}
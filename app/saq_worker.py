@@ -1,31 +1,250 @@
 from saq import Queue, CronJob
 from uuid import UUID
+from typing import Any, Dict, List, Optional, Tuple
+from contextlib import asynccontextmanager
+from shapely.geometry import shape
+import geopandas as gpd
+import numpy as np
 import redis
+import asyncio
+import functools
 import json
 import time
 import uuid
 import traceback
 
-from app.calculator.calculator import CarbonCalculator
-from app.types.general import CalculationStatus
-from app.db.connection import get_async_context_gis_db, get_async_context_state_db
-from app.calculator.calculator import CarbonCalculator
+from app.calculator.calculator import (
+    CarbonCalculator,
+    crs,
+    get_area_sums,
+    get_totals_from_sums,
+)
+from app.calculator.result_cache import calculate_with_cache
+from app.types.general import CalculationStatus, ReportKind
+from app.db.connection import get_async_context_state_db
 from app.db.plan import (
-    add_feature_collection_to_plan_areas,
-    get_feature_from_plan_by_ui_id_and_index,
-    get_plan_with_report_areas_by_ui_id,
+    add_to_plan_report_sums,
+    add_plan_area_results,
+    add_plan_chunk,
+    delete_plan_area_results,
+    advance_plan_last_index,
+    claim_plan_features,
+    count_plan_area_results,
+    get_plan_feature_by_index,
+    get_plan_report_areas,
+    get_uncalculated_plan_features,
+    get_plan_with_report_sums_by_ui_id,
     get_plan_without_data_by_ui_id,
+    skip_calculated_plan_features,
     update_plan,
     get_plan_by_ui_id,
 )  # Import the methods from plan.py
 from app import config
 from app.utils.logger import get_logger
+from app.utils.process_pool import run_cpu_bound, shutdown_process_pool
+from app.utils.report import get_or_create_plan_report
 
 logger = get_logger(__name__)
 
 global_settings = config.get_settings()
 
 MAX_CALC_RETRIES = 2
+# The running calculation jobs touch their saq job at this interval (s), so
+# that only the jobs not touched within STALE_JOB_AGE (s) are taken to have
+# died with their worker and are enqueued again
+JOB_HEARTBEAT_INTERVAL = 30
+STALE_JOB_AGE = 120
+RESUMABLE_FUNCTIONS = ["calculate_piece", "calculate_chunk"]
+
+
+@asynccontextmanager
+async def job_heartbeat(ctx):
+    job = ctx.get("job") if ctx else None
+    if job is None:
+        yield
+        return
+
+    async def beat():
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                await job.update()
+            except Exception as e:
+                logger.error(f"Error updating the heartbeat of job {job.key}: {e}")
+
+    task = asyncio.create_task(beat())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+def with_heartbeat(func):
+    @functools.wraps(func)
+    async def wrapper(ctx, **kwargs):
+        async with job_heartbeat(ctx):
+            return await func(ctx, **kwargs)
+
+    return wrapper
+
+
+def is_stale_job(data_dict: Dict[str, Any]) -> bool:
+    # saq keeps the job times in milliseconds
+    return (
+        data_dict["function"] in RESUMABLE_FUNCTIONS
+        and data_dict["status"] == "active"
+        and data_dict["touched"] < (time.time() - STALE_JOB_AGE) * 1000
+    )
+
+
+async def get_next_features(state_db_session, plan) -> List[Any]:
+    """
+    Get the next features of the plan to calculate. A fresh job takes a batch of
+    features up to the configured area, a retry, or a job within a failed batch,
+    only the next feature so that a failing feature can't hold back the others.
+    The feature after last_index is expected not to have its area yet.
+    """
+    solo_until_index = plan.solo_until_index
+    if solo_until_index is None:
+        solo_until_index = -1
+
+    if (
+        plan.last_area_calculation_retries > 0
+        or plan.last_index + 1 <= solo_until_index
+        or global_settings.calc_batch_max_features <= 1
+    ):
+        feature = await get_plan_feature_by_index(
+            state_db_session, plan.id, plan.last_index + 1
+        )
+        return [feature] if feature else []
+
+    start_index = plan.last_index + 1
+    indexed_features = await get_uncalculated_plan_features(
+        state_db_session,
+        plan.id,
+        start_index,
+        global_settings.calc_batch_max_features,
+    )
+    # The batch ends before the next feature that already has its area, so that
+    # its features are the range of indices that the job claims
+    features = [
+        feature
+        for position, (index, feature) in enumerate(indexed_features)
+        if index == start_index + position
+    ]
+    if not features:
+        return []
+
+    return features[: get_feature_batch_size(features)]
+
+
+def get_feature_batch_size(features: List[Any]) -> int:
+    # The batch is cut once the area, and so the pixel count, of its features
+    # exceeds the target. The first feature is always included.
+    areas = gpd.GeoDataFrame.from_features(features, crs=f"EPSG:{crs}").area.to_numpy()
+
+    return max(
+        1, int(np.sum(np.cumsum(areas) <= global_settings.calc_batch_target_area))
+    )
+
+
+async def get_plan_totals(state_db_session, plan) -> Dict[str, Any]:
+    """
+    The plan totals from its running sums and total geometry. Plans that were
+    started without them, or that have features that failed to calculate, are
+    aggregated from all of their areas.
+    """
+    # The total geometry covers all of the features, also the ones that were
+    # left out of the sums, which would make the per hectare totals too low
+    if (
+        plan.report_sums is not None
+        and plan.total_geometry is not None
+        and await count_plan_area_results(state_db_session, plan.id)
+        >= plan.total_indices
+    ):
+        return await run_cpu_bound(
+            get_totals_from_sums, plan.report_sums, shape(plan.total_geometry)
+        )
+
+    report_areas = await get_plan_report_areas(state_db_session, plan.id)
+    cc = CarbonCalculator(report_areas, sort_col="none")
+
+    return await cc.calculate_totals()
+
+
+async def enqueue_plan_calculation(plan, backend: Optional[str] = None):
+    """
+    Start the calculation of the plan areas. With a chunk size set, the features
+    are split into chunks that the workers calculate in parallel, otherwise
+    calculate_piece goes through them one job after another.
+    """
+    chunk_size = global_settings.calc_chunk_size
+    if chunk_size <= 0:
+        await queue.enqueue(
+            "calculate_piece",
+            ui_id=str(plan.ui_id),
+            backend=backend,
+            retries=3,
+            timeout=172800,
+        )
+        return
+
+    # The features up to last_index already have their results
+    first_index = plan.last_index + 1
+    if first_index >= plan.total_indices:
+        await queue.enqueue("calculate_totals", ui_id=str(plan.ui_id), timeout=3600)
+        return
+
+    for start_index in range(first_index, plan.total_indices, chunk_size):
+        await queue.enqueue(
+            "calculate_chunk",
+            ui_id=str(plan.ui_id),
+            start_index=start_index,
+            count=min(chunk_size, plan.total_indices - start_index),
+            backend=backend,
+            retries=MAX_CALC_RETRIES,
+            timeout=172800,
+        )
+
+
+async def calculate_features(
+    features: List[Any], backend: Optional[str] = None
+) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    Calculate the areas of the plan features, in EPSG:3067, in batches. If a
+    batch fails, its features are retried one by one and the ones that keep
+    failing are left out. Returns the area features with the positions of their
+    features.
+    """
+    areas = []
+    position = 0
+    while position < len(features):
+        batch = features[position:]
+        batch = batch[: get_feature_batch_size(batch)]
+
+        try:
+            calc_data = await calculate_with_cache(batch, backend, crs)
+            areas.extend(
+                enumerate(json.loads(calc_data["areas"])["features"], position)
+            )
+            position += len(batch)
+            continue
+        except Exception as e:
+            logger.error(f"Error calculating a batch of {len(batch)} features: {e}")
+
+        for feature in batch:
+            for retry in range(MAX_CALC_RETRIES + 1):
+                try:
+                    calc_data = await calculate_with_cache([feature], backend, crs)
+                    areas.append(
+                        (position, json.loads(calc_data["areas"])["features"][0])
+                    )
+                    break
+                except Exception as e:
+                    logger.error(f"Error calculating feature: {feature}\n{e}")
+            position += 1
+
+    return areas
 
 
 # class CalculationResult(TypedDict):
@@ -34,16 +253,15 @@ MAX_CALC_RETRIES = 2
 #     metadata: str
 
 
-async def calculate(ctx, *, ui_id: str):
+async def calculate(ctx, *, ui_id: str, backend: Optional[str] = None):
     plan = None
     async with get_async_context_state_db() as state_db_session:
         plan = await get_plan_by_ui_id(state_db_session, UUID(ui_id))
 
     calc_data = None
     if plan:
-        async with get_async_context_gis_db() as gis_db_session:
-            cc = CarbonCalculator(plan.data)
-            calc_data = await cc.calculate(gis_db_session)
+        cc = CarbonCalculator(plan.data, backend=backend)
+        calc_data = await cc.calculate()
 
         async with get_async_context_state_db() as state_db_session:
             plan = await get_plan_by_ui_id(state_db_session, UUID(ui_id))
@@ -56,7 +274,13 @@ async def calculate(ctx, *, ui_id: str):
                     {"message": "No data found for polygons."},
                 )
             else:
-                plan.report_areas = calc_data["areas"]
+                await delete_plan_area_results(state_db_session, plan.id, commit=False)
+                await add_plan_area_results(
+                    state_db_session,
+                    plan.id,
+                    list(enumerate(json.loads(calc_data["areas"])["features"])),
+                    commit=False,
+                )
                 plan.report_totals = calc_data["totals"]
                 plan.calculated_ts = calc_data["metadata"].get("timestamp")
                 plan.calculation_status = CalculationStatus.FINISHED.value
@@ -66,9 +290,11 @@ async def calculate(ctx, *, ui_id: str):
                 )
 
 
-async def calculate_piece(ctx, *, ui_id: str):
+@with_heartbeat
+async def calculate_piece(ctx, *, ui_id: str, backend: Optional[str] = None):
     plan = None
-    feature = None
+    features = []
+    start_index = None
     totals = None
 
     try:
@@ -78,16 +304,21 @@ async def calculate_piece(ctx, *, ui_id: str):
             if not plan:
                 raise ValueError("Plan not found or is invalid.")
             if plan:
+                # The areas carried over from the earlier calculation of the
+                # plan aren't calculated again
+                plan.last_index = await skip_calculated_plan_features(
+                    state_db_session, plan.id
+                )
+
                 if plan.last_index + 1 >= plan.total_indices:
-                    plan_report = await get_plan_with_report_areas_by_ui_id(
+                    plan_report = await get_plan_with_report_sums_by_ui_id(
                         state_db_session, UUID(ui_id)
                     )
                     if plan_report:
                         try:
-                            cc = CarbonCalculator(
-                                plan_report.report_areas, sort_col="none"
+                            calc_data = await get_plan_totals(
+                                state_db_session, plan_report
                             )
-                            calc_data = await cc.calculate_totals()
 
                             if calc_data:
                                 plan.calculation_status = (
@@ -122,7 +353,6 @@ async def calculate_piece(ctx, *, ui_id: str):
                             plan,
                         )
                     return
-                
 
                 if plan.last_area_calculation_retries > MAX_CALC_RETRIES:
                     plan.last_area_calculation_retries = 0
@@ -133,11 +363,10 @@ async def calculate_piece(ctx, *, ui_id: str):
                     )
 
                 else:
-                    feature = await get_feature_from_plan_by_ui_id_and_index(
-                        state_db_session, UUID(ui_id), plan.last_index + 1
-                    )
+                    features = await get_next_features(state_db_session, plan)
+                    start_index = plan.last_index + 1
 
-                    if feature:
+                    if features:
                         plan.last_area_calculation_status = (
                             CalculationStatus.PROCESSING.value
                         )
@@ -150,15 +379,14 @@ async def calculate_piece(ctx, *, ui_id: str):
                             plan,
                         )
 
-            if feature:
+            if features:
                 calc_data = None
 
                 try:
-                    async with get_async_context_gis_db() as gis_db_session:
-                        cc = CarbonCalculator(
-                            {"type": "FeatureCollection", "features": [feature]},
-                        )
-                        calc_data = await cc.calculate(gis_db_session)
+                    # Cached results are reused before any GIS query is made.
+                    # The results are in the plan order, in which they are
+                    # appended.
+                    calc_data = await calculate_with_cache(features, backend, crs)
 
                     async with get_async_context_state_db() as state_db_session:
                         plan = await get_plan_without_data_by_ui_id(
@@ -168,8 +396,29 @@ async def calculate_piece(ctx, *, ui_id: str):
                         if calc_data == None:
                             raise ValueError("No data returned by calculator")
                         else:
-                            await add_feature_collection_to_plan_areas(
-                                state_db_session, plan.id, calc_data["areas"]
+                            # Only the job that moves the index past the
+                            # features writes their results, committed together
+                            # with the index by update_plan
+                            if not await claim_plan_features(
+                                state_db_session, plan.id, start_index, len(features)
+                            ):
+                                logger.info(
+                                    f"Features from index {start_index} of plan with ui_id: {ui_id} were already calculated"
+                                )
+                                return
+
+                            areas = json.loads(calc_data["areas"])
+                            await add_plan_area_results(
+                                state_db_session,
+                                plan.id,
+                                list(enumerate(areas["features"], start_index)),
+                                commit=False,
+                            )
+                            await add_to_plan_report_sums(
+                                state_db_session,
+                                plan.id,
+                                get_area_sums(areas),
+                                commit=False,
                             )
 
                             plan.last_area_calculation_status = (
@@ -178,32 +427,41 @@ async def calculate_piece(ctx, *, ui_id: str):
                             plan.calculation_updated_ts = calc_data["metadata"].get(
                                 "timestamp"
                             )
-                            plan.last_index = plan.last_index + 1
+                            plan.last_index = start_index + len(features) - 1
                             plan.last_area_calculation_retries = 0
-                            
+
                             await update_plan(
                                 state_db_session,
                                 plan,
                             )
                 except Exception as e:
-                    tb_str = traceback.format_exception(
-                        etype=type(e), value=e, tb=e.__traceback__
-                    )
+                    tb_str = traceback.format_exception(type(e), e, e.__traceback__)
                     traceback_str = "".join(tb_str)
 
                     logger.error(
-                        f"Error calculating plan with ui_id: {plan.ui_id} on feature: {feature}\n{traceback_str}"
+                        f"Error calculating plan with ui_id: {plan.ui_id} on features: {features}\n{traceback_str}"
                     )
 
                     async with get_async_context_state_db() as state_db_session:
                         plan = await get_plan_without_data_by_ui_id(
                             state_db_session, UUID(ui_id)
                         )
-                        if plan.last_area_calculation_retries > MAX_CALC_RETRIES:
+                        if plan.last_index != start_index - 1:
+                            # Another job has already gone past the features
+                            return
+
+                        if len(features) > 1:
+                            # The rest of the failed batch is calculated one
+                            # feature at a time, so that a failing feature
+                            # can't fail the next batch too
+                            plan.solo_until_index = start_index + len(features) - 1
+                            plan.last_area_calculation_retries = 0
+
+                        elif plan.last_area_calculation_retries > MAX_CALC_RETRIES:
                             plan.last_area_calculation_retries = 0
                             plan.last_index = plan.last_index + 1
 
-                        elif feature:
+                        else:
                             plan.last_area_calculation_status = (
                                 CalculationStatus.PROCESSING.value
                             )
@@ -217,7 +475,11 @@ async def calculate_piece(ctx, *, ui_id: str):
                         )
 
         await queue.enqueue(
-            "calculate_piece", ui_id=str(ui_id), retries=0, timeout=172800
+            "calculate_piece",
+            ui_id=str(ui_id),
+            backend=backend,
+            retries=0,
+            timeout=172800,
         )
 
     except Exception as e:
@@ -236,7 +498,11 @@ async def calculate_piece(ctx, *, ui_id: str):
                 )
 
                 await queue.enqueue(
-                    "calculate_piece", ui_id=str(ui_id), retries=0, timeout=172800
+                    "calculate_piece",
+                    ui_id=str(ui_id),
+                    backend=backend,
+                    retries=0,
+                    timeout=172800,
                 )
             else:
                 plan.last_area_calculation_status = CalculationStatus.ERROR.value
@@ -247,8 +513,93 @@ async def calculate_piece(ctx, *, ui_id: str):
                 )
 
 
+@with_heartbeat
+async def calculate_chunk(
+    ctx,
+    *,
+    ui_id: str,
+    start_index: int,
+    count: int,
+    backend: Optional[str] = None,
+):
+    async with get_async_context_state_db() as state_db_session:
+        plan = await get_plan_without_data_by_ui_id(state_db_session, UUID(ui_id))
+        if not plan:
+            return
+        # The areas carried over from the earlier calculation are left out
+        indexed_features = await get_uncalculated_plan_features(
+            state_db_session, plan.id, start_index, count
+        )
+
+    feature_indices = [index for index, _ in indexed_features]
+    areas = await calculate_features(
+        [feature for _, feature in indexed_features], backend
+    )
+
+    async with get_async_context_state_db() as state_db_session:
+        # The chunk, its results and the count of calculated features are
+        # committed together, so a chunk that is run again is only counted once
+        if not await add_plan_chunk(state_db_session, plan.id, start_index):
+            logger.info(
+                f"Chunk from index {start_index} of plan with ui_id: {ui_id} was already calculated"
+            )
+            return
+
+        await add_plan_area_results(
+            state_db_session,
+            plan.id,
+            [(feature_indices[position], area) for position, area in areas],
+            commit=False,
+        )
+        await add_to_plan_report_sums(
+            state_db_session,
+            plan.id,
+            get_area_sums({"features": [area for _, area in areas]}),
+            commit=False,
+        )
+        last_index, total_indices = await advance_plan_last_index(
+            state_db_session, plan.id, count
+        )
+
+    # Only the chunk that brings the count to the total sees it cross over
+    if last_index + 1 >= total_indices and last_index + 1 - count < total_indices:
+        await queue.enqueue("calculate_totals", ui_id=ui_id, timeout=3600)
+
+
 async def calculate_totals(ctx, *, ui_id: str):
-    pass
+    async with get_async_context_state_db() as state_db_session:
+        plan = await get_plan_with_report_sums_by_ui_id(state_db_session, UUID(ui_id))
+        if not plan:
+            return
+
+        try:
+            calc_data = await get_plan_totals(state_db_session, plan)
+
+            plan.calculation_status = CalculationStatus.FINISHED.value
+            plan.report_totals = calc_data["totals"]
+            plan.calculated_ts = calc_data["metadata"].get("timestamp")
+        except Exception as e:
+            logger.error(f"Error calculating totals of plan with ui_id: {ui_id}\n{e}")
+            plan.calculation_status = CalculationStatus.ERROR.value
+
+        await update_plan(
+            state_db_session,
+            plan,
+        )
+
+        if plan.calculation_status.value == CalculationStatus.FINISHED.value:
+            await create_plan_reports(state_db_session, plan)
+
+
+async def create_plan_reports(state_db_session, plan):
+    # The reports are compressed once here, instead of on every request
+    try:
+        for kind in ReportKind:
+            await get_or_create_plan_report(state_db_session, plan, kind.value)
+    except Exception as e:
+        logger.error(
+            f"Error creating the reports of plan with ui_id: {plan.ui_id}\n{e}"
+        )
 
 
 async def handle_finished_calcs(ctx):
@@ -269,15 +620,15 @@ async def handle_finished_calcs(ctx):
         data_str = value.decode("utf-8")
         data_dict = json.loads(data_str)
 
-        if data_dict["function"] == "calculate_piece":
-            if data_dict["status"] == "active":
-                if data_dict["touched"] < time.time() - 120:
-                    await queue.enqueue(
-                        "calculate_piece",
-                        ui_id=data_dict["kwargs"]["ui_id"],
-                        scheduled=time.time() + 120,
-                    )
-            if data_dict["status"] == "complete":
+        if data_dict["function"] in RESUMABLE_FUNCTIONS:
+            if is_stale_job(data_dict):
+                await queue.enqueue(
+                    data_dict["function"],
+                    **data_dict["kwargs"],
+                    scheduled=time.time() + 120,
+                )
+                r.delete(key)  # The job is only enqueued again once
+            elif data_dict["status"] == "complete":
                 r.delete(key)  # Remove the item from Redis
             elif data_dict["status"] == "failed":
                 async with get_async_context_state_db() as state_db_session:
@@ -306,25 +657,24 @@ async def startup(ctx):
             stats_data = {}
 
             for key in r.scan_iter("saq:job:default:*"):
+                value = r.get(key)
+                decoded_key = key.decode("utf-8")
+                stats_data[decoded_key] = value
+
+            for key, value in stats_data.items():
                 try:
-                    value = r.get(key)
-                    decoded_key = key.decode("utf-8")
-                    stats_data[decoded_key] = value
-
-                    for key, value in stats_data.items():
-                        data_str = value.decode("utf-8")
-                        data_dict = json.loads(data_str)
-
-                        if (
-                            data_dict["status"] == "active"
-                            and data_dict["function"] == "calculate_piece"
-                        ):
-                            await queue.enqueue(
-                                "calculate_piece",
-                                ui_id=data_dict["kwargs"]["ui_id"],
-                                scheduled=time.time() + 120,
-                            )
-                            await r.delete(key)
+                    data_str = value.decode("utf-8")
+                    data_dict = json.loads(data_str)
+
+                    # The jobs of the other workers keep running, only the
+                    # ones that have stopped touching their job are resumed
+                    if is_stale_job(data_dict):
+                        await queue.enqueue(
+                            data_dict["function"],
+                            **data_dict["kwargs"],
+                            scheduled=time.time() + 120,
+                        )
+                        r.delete(key)
                 except Exception as e:
                     # Handle exceptions appropriately
                     pass
@@ -339,7 +689,7 @@ async def startup(ctx):
 
 async def shutdown(ctx):
     # await ctx["db"].disconnect()
-    pass
+    shutdown_process_pool()
 
 
 async def before_process(ctx):
@@ -355,11 +705,11 @@ queue = Queue.from_url(global_settings.redis_url)
 
 settings = {
     "queue": queue,
-    "functions": [calculate, calculate_piece],
-    "concurrency": 10,
+    "functions": [calculate, calculate_piece, calculate_chunk, calculate_totals],
+    "concurrency": global_settings.saq_concurrency,
     "cron_jobs": [CronJob(handle_finished_calcs, cron="* * * * * */120", timeout=300)],
     "startup": startup,
-    # "shutdown": shutdown,
+    "shutdown": shutdown,
     # "before_process": before_process,
     # "after_process": after_process,
 }
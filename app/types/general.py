@@ -6,3 +6,23 @@ class CalculationStatus(Enum):
     FINISHED = "FINISHED"
     ERROR = "ERROR"
     NOT_STARTED = "NOT_STARTED"
+
+
+class CalculationBackend(Enum):
+    # Clipped rasters are fetched and summed by the worker
+    RASTER = "raster"
+    # The sums are computed in PostGIS and only they are fetched
+    ZONAL = "zonal"
+
+
+class ReportKind(Enum):
+    # The finished GET /calculation response
+    CALCULATION = "calculation"
+    # The GET /plan/external response of a finished plan
+    EXTERNAL = "external"
+
+
+class ExportFormat(Enum):
+    GEOPARQUET = "geoparquet"
+    # Arrow IPC stream, with the geometries as WKB
+    ARROW = "arrow"
@@ -1,13 +1,39 @@
+import hashlib
 import pandas as pd
+from typing import Dict, Tuple
 
 data_path = "data"
 bm_curve_df = None
+bm_curve_index = None
 area_multipliers_df = None
+static_inputs_version = None
+
+# The columns that identify a biomass curve, in the order used for the index keys
+bm_curve_key_cols = (
+    "Region",
+    "Maingroup",
+    "Soiltype",
+    "Drainage",
+    "Fertility",
+    "Species",
+    "Structure",
+    "Regime",
+)
+
+
+def build_bm_curve_index(df: pd.DataFrame) -> Dict[Tuple, float]:
+    # If several curves share the same key, the first one is used
+    unique_df = df.drop_duplicates(subset=list(bm_curve_key_cols), keep="first")
+    keys = zip(*[unique_df[col].tolist() for col in bm_curve_key_cols])
+
+    return dict(zip(keys, unique_df["Mabp"].astype(float).tolist()))
 
 
 def load_bm_curves():
     global bm_curve_df
+    global bm_curve_index
     bm_curve_df = pd.read_csv(f"{data_path}/BiomassCurves.txt")
+    bm_curve_index = build_bm_curve_index(bm_curve_df)
 
 
 def load_area_multipliers():
@@ -29,8 +55,34 @@ def get_bm_curve_df() -> pd.DataFrame:
     return bm_curve_df
 
 
+def get_bm_curve_index() -> Dict[Tuple, float]:
+    if (bm_curve_index is None) or (len(bm_curve_index) == 0):
+        load_bm_curves()
+    return bm_curve_index
+
+
+def get_static_inputs_version() -> str:
+    """
+    A hash of the contents of the data files, which changes when the biomass
+    curves or the area multipliers are updated.
+    """
+    global static_inputs_version
+    if static_inputs_version is None:
+        file_hash = hashlib.sha256()
+        for file_name in ["BiomassCurves.txt", "aluekertoimet.csv"]:
+            with open(f"{data_path}/{file_name}", "rb") as file:
+                file_hash.update(file.read())
+        static_inputs_version = file_hash.hexdigest()
+
+    return static_inputs_version
+
+
 def unload_files():
     global bm_curve_df
+    global bm_curve_index
     global area_multipliers_df
+    global static_inputs_version
     bm_curve_df = None
+    bm_curve_index = None
     area_multipliers_df = None
+    static_inputs_version = None
@@ -0,0 +1,81 @@
+import hashlib
+import json
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+FeatureCollection = Dict[str, Any]
+
+
+def get_feature_hash(feature: Dict[str, Any]) -> str:
+    # Keys are sorted, as JSONB doesn't keep the key order of the stored data
+    feature_json = json.dumps(
+        [feature.get("geometry"), feature.get("properties")], sort_keys=True
+    )
+
+    return hashlib.sha256(feature_json.encode("utf-8")).hexdigest()
+
+
+def get_feature_id(feature: Dict[str, Any]) -> Optional[Any]:
+    return (feature.get("properties") or {}).get("id")
+
+
+def get_plan_data_hashes(data_json: str) -> List[str]:
+    features = json.loads(data_json).get("features") or []
+
+    return [get_feature_hash(feature) for feature in features]
+
+
+def merge_unchanged_results(
+    old_results: Optional[List[Tuple[Dict[str, Any], Optional[str]]]],
+    new_data: FeatureCollection,
+) -> Tuple[List[Tuple[int, Dict[str, Any]]], List[str]]:
+    """
+    Carry the area results of the features that are unchanged in the new plan
+    data over from the old calculation. The old results come with the hashes of
+    the features they were calculated from, and a feature is unchanged if it
+    has the same id and hash as one of them.
+
+    Returns the carried over areas with the indices of their features in the
+    new data, which keeps its order, and the hashes of all the new features.
+    The features without an area are left to be calculated.
+    """
+    new_features: List[Dict[str, Any]] = new_data.get("features") or []
+
+    old_areas = {}
+    duplicate_ids = set()
+    for area, feature_hash in old_results or []:
+        feature_id = get_feature_id(area)
+        if feature_id in old_areas:
+            duplicate_ids.add(feature_id)
+        old_areas[feature_id] = (area, feature_hash)
+
+    unchanged_areas = []
+    feature_hashes = []
+    new_ids = [get_feature_id(feature) for feature in new_features]
+    new_id_counts = Counter(new_ids)
+    for index, (feature, feature_id) in enumerate(zip(new_features, new_ids)):
+        feature_hash = get_feature_hash(feature)
+        feature_hashes.append(feature_hash)
+        old_area, old_hash = old_areas.get(feature_id, (None, None))
+        # Without a unique id the result can't be matched to the feature, and
+        # the results without a hash were calculated before the hashes
+        is_unchanged = (
+            feature_id is not None
+            and new_id_counts[feature_id] == 1
+            and feature_id not in duplicate_ids
+            and old_hash is not None
+            and old_hash == feature_hash
+        )
+        if is_unchanged:
+            unchanged_areas.append((index, old_area))
+
+    return unchanged_areas, feature_hashes
+
+
+def merge_unchanged_plan_data(
+    old_results: Optional[List[Tuple[Dict[str, Any], Optional[str]]]],
+    data_json: str,
+) -> Tuple[List[Tuple[int, Dict[str, Any]]], List[str]]:
+    # The same as merge_unchanged_results for the data as JSON, so that the
+    # parsing of a large plan can be run in a thread too
+    return merge_unchanged_results(old_results, json.loads(data_json))
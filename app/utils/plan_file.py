@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+from typing import BinaryIO, Tuple, Union
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+
+from app import config
+from app.calculator.calculator import get_total_geometry
+
+global_settings = config.get_settings()
+
+# pyogrio reads the files into columns at once, fiona feature by feature
+try:
+    import pyogrio  # noqa: F401
+
+    read_engine = "pyogrio"
+except ImportError:
+    read_engine = "fiona"
+
+try:
+    import pyarrow  # noqa: F401
+
+    has_arrow = True
+except ImportError:
+    has_arrow = False
+
+polygon_types = ["Polygon", "MultiPolygon"]
+copy_chunk_size = 1024 * 1024
+
+parquet_magic = b"PAR1"
+flatgeobuf_magic = b"fgb\x03"
+
+
+class PlanFileError(Exception):
+    def __init__(self, detail: str, status_code: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+def copy_upload(src: BinaryIO, dst: BinaryIO):
+    # Copied in chunks, so that an oversized upload is rejected without
+    # reading all of it
+    size = 0
+    while chunk := src.read(copy_chunk_size):
+        size += len(chunk)
+        if size > global_settings.max_upload_size:
+            raise PlanFileError(
+                f"The file is larger than {global_settings.max_upload_size} bytes.",
+                413,
+            )
+        dst.write(chunk)
+    dst.flush()
+
+
+def read_file(path_or_file: Union[str, BinaryIO]) -> gpd.GeoDataFrame:
+    if read_engine == "pyogrio":
+        data = gpd.read_file(path_or_file, engine="pyogrio", use_arrow=has_arrow)
+    else:
+        data = gpd.read_file(path_or_file, engine="fiona")
+
+    # The same index from either engine, the features numbered in the file
+    # order. The ids of the features are kept in their "id" property.
+    return data.reset_index(drop=True)
+
+
+def get_polygonal_part(geometry: shapely.Geometry) -> shapely.Geometry:
+    polygons = [
+        part for part in shapely.get_parts(geometry) if part.geom_type in polygon_types
+    ]
+    return shapely.union_all(polygons)
+
+
+def clean_plan_data(data: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Keep the polygon features of the data, with their invalid geometries made
+    valid.
+    """
+    data = data[data.geometry.notna() & data.geom_type.isin(polygon_types)]
+
+    invalid = ~data.geometry.is_valid.to_numpy()
+    if invalid.any():
+        data = data.copy()
+        geometries = data.geometry.to_numpy()
+        repaired = shapely.make_valid(geometries[invalid])
+        # A repaired geometry can also have lines or points, which are dropped
+        for idx in np.flatnonzero(~np.isin(shapely.get_type_id(repaired), [3, 6])):
+            repaired[idx] = get_polygonal_part(repaired[idx])
+        geometries[invalid] = repaired
+        data[data.geometry.name] = gpd.GeoSeries(
+            geometries, index=data.index, crs=data.crs
+        )
+
+    return data[~data.geometry.is_empty & data.geometry.is_valid]
+
+
+def get_file_format(file: BinaryIO) -> str:
+    # The format is told by the magic bytes, as the file names can't be trusted
+    magic = file.read(8)
+    file.seek(0)
+
+    if magic.startswith(parquet_magic):
+        return "geoparquet"
+    if magic.startswith(flatgeobuf_magic):
+        return "flatgeobuf"
+    return "zip"
+
+
+def read_geoparquet(file: BinaryIO) -> gpd.GeoDataFrame:
+    if not has_arrow:
+        raise PlanFileError("GeoParquet uploads are not supported.", 415)
+
+    return gpd.read_parquet(file)
+
+
+def read_zip(file: BinaryIO, ui_id) -> gpd.GeoDataFrame:
+    with tempfile.NamedTemporaryFile(
+        delete=True, suffix=f"{ui_id}.zip", dir="/tmp"
+    ) as temp_file:
+        copy_upload(file, temp_file)
+        data = read_file(temp_file.name)
+
+    # The zipped shapefiles are always taken to be in EPSG:4326
+    data.set_crs("EPSG:4326", inplace=True, allow_override=True)
+
+    return data
+
+
+def read_plan_file(file: BinaryIO, ui_id) -> Tuple[str, int, str]:
+    """
+    Read the uploaded plan file, a zipped shapefile, GeoParquet or FlatGeobuf.
+    Returns the plan data as GeoJSON, its feature count and the GeoJSON of its
+    total geometry.
+    """
+    file_format = get_file_format(file)
+    if file_format == "zip":
+        data = read_zip(file, ui_id)
+    else:
+        # The columnar formats are read straight from the upload
+        file.seek(0, os.SEEK_END)
+        if file.tell() > global_settings.max_upload_size:
+            raise PlanFileError(
+                f"The file is larger than {global_settings.max_upload_size} bytes.",
+                413,
+            )
+        file.seek(0)
+
+        if file_format == "geoparquet":
+            data = read_geoparquet(file)
+        else:
+            data = read_file(file)
+
+        if data.crs is None:
+            data.set_crs("EPSG:4326", inplace=True)
+        else:
+            data = data.to_crs("EPSG:4326")
+
+    data = clean_plan_data(data)
+
+    # The union for the plan totals is made once here, instead of from all
+    # the areas when the calculation finishes
+    total_geometry = json.dumps(mapping(get_total_geometry(data)))
+
+    return data.to_json(), len(data), total_geometry
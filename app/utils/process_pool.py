@@ -0,0 +1,50 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+from app import config
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+global_settings = config.get_settings()
+
+process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
+    global process_pool
+    if process_pool is None and global_settings.calc_process_workers > 0:
+        logger.info(
+            f"Starting a process pool with {global_settings.calc_process_workers} workers"
+        )
+        # Spawned instead of forked, since forking a process that runs an event
+        # loop and client threads can copy their locks in a locked state
+        process_pool = ProcessPoolExecutor(
+            max_workers=global_settings.calc_process_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return process_pool
+
+
+async def run_cpu_bound(func: Callable[..., Any], *args) -> Any:
+    """
+    Run a CPU bound function in the process pool, so that it doesn't block the
+    event loop. The function and its arguments have to be picklable. With
+    CALC_PROCESS_WORKERS=0 the function is run inline instead.
+    """
+    pool = get_process_pool()
+    if pool is None:
+        return func(*args)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, partial(func, *args))
+
+
+def shutdown_process_pool():
+    global process_pool
+    if process_pool is not None:
+        process_pool.shutdown(wait=True, cancel_futures=True)
+        process_pool = None
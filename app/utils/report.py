@@ -0,0 +1,186 @@
+import gzip
+import hashlib
+import io
+import json
+from fnmatch import fnmatch
+from typing import Any, Dict, List, Optional, Tuple
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import shapely
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from app.calculator.calculator import is_sum_col
+from app.db.models.plan import Plan
+from app.db.plan import (
+    get_plan_report,
+    get_plan_report_areas,
+    get_plan_report_totals,
+    save_plan_report,
+)
+from app.types.general import CalculationStatus, ExportFormat, ReportKind
+
+export_media_types = {
+    ExportFormat.GEOPARQUET.value: "application/vnd.apache.parquet",
+    ExportFormat.ARROW.value: "application/vnd.apache.arrow.stream",
+}
+export_file_extensions = {
+    ExportFormat.GEOPARQUET.value: "parquet",
+    ExportFormat.ARROW.value: "arrows",
+}
+
+
+def get_calculated_ts(plan: Plan) -> Optional[int]:
+    return int(plan.calculated_ts.timestamp()) if plan.calculated_ts else None
+
+
+def get_calculation_report_content(
+    plan: Plan, totals: Any, areas: Dict[str, Any]
+) -> Dict[str, Any]:
+    return {
+        "id": str(plan.ui_id),
+        "calculation_status": CalculationStatus.FINISHED.value,
+        "calculation_updated_ts": (
+            plan.calculation_updated_ts.timestamp()
+            if plan.calculation_updated_ts
+            else None
+        ),
+        "total_indices": plan.total_indices,
+        "last_index": plan.last_index,
+        "data": {
+            "totals": totals,
+            "areas": areas,
+            "metadata": {
+                "report_name": plan.name,
+                "calculated_ts": get_calculated_ts(plan),
+            },
+        },
+    }
+
+
+def get_external_report_content(
+    plan: Plan, totals: Any, areas: Dict[str, Any]
+) -> Dict[str, Any]:
+    return {
+        "id": str(plan.ui_id),
+        "name": plan.name,
+        "report_data": {
+            "totals": totals,
+            "areas": areas,
+            "metadata": {
+                "calculated_ts": get_calculated_ts(plan),
+            },
+        },
+    }
+
+
+report_content_getters = {
+    ReportKind.CALCULATION.value: get_calculation_report_content,
+    ReportKind.EXTERNAL.value: get_external_report_content,
+}
+
+
+def compress_content(content: Any) -> Tuple[bytes, str]:
+    """
+    Gzip the content as JSON. Returns it with its ETag, a hash of the JSON.
+    """
+    json_bytes = json.dumps(content).encode("utf-8")
+    etag = f'"{hashlib.sha256(json_bytes).hexdigest()}"'
+
+    return gzip.compress(json_bytes), etag
+
+
+def is_etag_match(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak tags match too, as the comparison for If-None-Match is weak
+    return "*" in tags or etag in [tag.removeprefix("W/") for tag in tags]
+
+
+async def get_or_create_plan_report(
+    db_session: AsyncSession, plan: Plan, kind: str
+) -> Tuple[bytes, str]:
+    """
+    The gzipped report of a finished plan and its ETag. The report is built
+    and stored on first use, later requests get the stored bytes.
+    """
+    report = await get_plan_report(db_session, plan.id, kind)
+    if report:
+        return report.content, report.etag
+
+    content = report_content_getters[kind](
+        plan,
+        await get_plan_report_totals(db_session, plan.id),
+        await get_plan_report_areas(db_session, plan.id),
+    )
+    content, etag = await run_in_threadpool(compress_content, content)
+    await save_plan_report(db_session, plan.id, kind, content, etag)
+
+    return content, etag
+
+
+def get_report_areas_frame(
+    areas: Dict[str, Any], column_patterns: Optional[List[str]] = None
+) -> gpd.GeoDataFrame:
+    """
+    The report areas as a GeoDataFrame with float result columns. With column
+    patterns, only the result columns matching one of the glob patterns are
+    kept, e.g. "*_ha_*" or "*planned*". The other properties are always kept.
+    """
+    zone = gpd.GeoDataFrame.from_features(areas["features"], crs="EPSG:4326")
+
+    result_cols = [col for col in zone.columns if is_sum_col(col)]
+    other_cols = [
+        col for col in zone.columns if col not in result_cols and col != "geometry"
+    ]
+    if column_patterns:
+        result_cols = [
+            col
+            for col in result_cols
+            if any(fnmatch(col, pattern) for pattern in column_patterns)
+        ]
+
+    zone = zone[other_cols + result_cols + ["geometry"]]
+
+    return zone.astype({col: "float64" for col in result_cols})
+
+
+def export_report_areas(
+    areas: Dict[str, Any],
+    export_format: str,
+    column_patterns: Optional[List[str]] = None,
+) -> bytes:
+    zone = get_report_areas_frame(areas, column_patterns)
+
+    if export_format == ExportFormat.GEOPARQUET.value:
+        output = io.BytesIO()
+        zone.to_parquet(output, index=False)
+        return output.getvalue()
+
+    table = pa.Table.from_pandas(
+        pd.DataFrame(zone.drop(columns="geometry")), preserve_index=False
+    )
+    # The geometries are WKB, marked as GeoArrow for the readers that know it
+    geometry_field = pa.field(
+        "geometry",
+        pa.binary(),
+        metadata={
+            "ARROW:extension:name": "geoarrow.wkb",
+            "ARROW:extension:metadata": json.dumps({"crs": zone.crs.to_json_dict()}),
+        },
+    )
+    table = table.append_column(
+        geometry_field,
+        pa.array(shapely.to_wkb(zone.geometry.to_numpy()), type=pa.binary()),
+    )
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
@@ -1,6 +1,7 @@
 import asyncio
 from functools import wraps
 
+
 def retry_async(
     retries: int = 3,
     exceptions: tuple = (Exception,),
@@ -13,6 +14,7 @@ def retry_async(
         exceptions: Exceptions that trigger a retry.
         delay: Delay between retries.
     """
+
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
@@ -23,5 +25,7 @@ def retry_async(
                     if _ == retries - 1:  # On the last retry, raise the exception
                         raise e
                     await asyncio.sleep(delay)  # Wait for some time before retrying
+
         return wrapper
-    return decorator
\ No newline at end of file
+
+    return decorator
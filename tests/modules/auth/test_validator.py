@@ -0,0 +1,85 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import pytest_asyncio
+
+from app.auth import validator
+from app.auth.validator import ZitadelIntrospectTokenValidator
+
+
+class IntrospectionHandler(BaseHTTPRequestHandler):
+    # A stand-in for the Zitadel introspection endpoint
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        token = parse_qs(body.decode("utf-8"))["token"][0]
+        self.server.tokens.append(token)
+        # Slow enough for the concurrent requests to overlap
+        time.sleep(0.2)
+
+        content = json.dumps(
+            {"active": True, "sub": f"user-{token}", "exp": int(time.time()) + 600}
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def introspection_server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), IntrospectionHandler)
+    server.tokens = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(
+        validator, "zitadel_domain", f"http://127.0.0.1:{server.server_port}"
+    )
+    validator.token_cache.clear()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest_asyncio.fixture
+async def http_client():
+    yield
+    await validator.close_http_client()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_introspections_are_collapsed(
+    introspection_server, http_client
+):
+    token_validator = ZitadelIntrospectTokenValidator()
+
+    tokens = await asyncio.gather(
+        *[token_validator.introspect_token("a") for _ in range(5)]
+    )
+
+    assert [token["sub"] for token in tokens] == ["user-a"] * 5
+    assert introspection_server.tokens == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_introspections_are_cached(introspection_server, http_client):
+    token_validator = ZitadelIntrospectTokenValidator()
+
+    await token_validator.introspect_token("a")
+    await token_validator.introspect_token("b")
+    token = await token_validator.introspect_token("a")
+
+    token_validator.validate_token(token, "")
+    assert token["sub"] == "user-a"
+    assert introspection_server.tokens == ["a", "b"]
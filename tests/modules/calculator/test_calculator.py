@@ -0,0 +1,62 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+from shapely import affinity, wkt
+
+from app.calculator.calculator import (
+    CarbonCalculator,
+    get_area_sums,
+    get_total_geometry,
+    get_totals_from_sums,
+)
+
+# Constants
+TEST_WKT = "POLYGON ((323383.0893000001 6823223.647, 323394.52799999993 6823222.464000002, 323405.9667999996 6823221.2809000015, 323412.03610000014 6823279.966600001, 323475.19799999986 6823273.434300002, 323469.12849999964 6823214.748599999, 323430.8428999996 6823218.7082, 323428.0423999997 6823191.629799999, 323399.5087000001 6823186.453400001, 323399.9550000001 6823183.9936, 323356.17059999984 6823176.0506, 323283.85250000004 6823162.931200001, 323275.90950000007 6823206.715599999, 323314.7742999997 6823213.766199999, 323314.1496000001 6823217.209899999, 323322.0208999999 6823218.637800001, 323321.2742999997 6823222.753400002, 323318.0575000001 6823241.262600001, 323322.8071999997 6823287.1844, 323323.01300000027 6823289.173700001, 323389.1588000003 6823282.332699999, 323383.0893000001 6823223.647))"
+TEST_CRS = "3067"
+
+
+def make_areas(count=3):
+    geometry = wkt.loads(TEST_WKT)
+    areas = gpd.GeoDataFrame(
+        {
+            "id": [str(idx) for idx in range(count)],
+            "zoning_code": ["A"] * count,
+            "bio_carbon_total_nochange_2030": np.arange(count) * 10.0,
+            "bio_carbon_ha_nochange_2030": np.arange(count) * 1.0,
+            "ground_carbon_total_planned_2030": np.arange(count) * 5.0,
+            "ground_carbon_ha_planned_2030": np.arange(count) * 0.5,
+        },
+        # Overlapping geometries, which the totals area counts once
+        geometry=[affinity.translate(geometry, idx * 50, 0) for idx in range(count)],
+        crs=f"EPSG:{TEST_CRS}",
+    )
+
+    return areas.to_crs("EPSG:4326")
+
+
+def test_totals_from_sums_match_totals_from_areas():
+    areas = make_areas()
+    areas_json = json.loads(areas.to_json())
+
+    expected = json.loads(
+        CarbonCalculator(areas_json, sort_col="none").get_totals()["totals"]
+    )
+    totals = json.loads(
+        get_totals_from_sums(get_area_sums(areas_json), get_total_geometry(areas))[
+            "totals"
+        ]
+    )
+
+    expected_props = expected["features"][0]["properties"]
+    props = totals["features"][0]["properties"]
+    assert expected_props.keys() == props.keys()
+    for key, val in expected_props.items():
+        assert np.isclose(props[key], val)
+
+    # The per hectare values are derived from the totals
+    area_ha = props["area"] / 10_000
+    assert np.isclose(
+        props["bio_carbon_ha_nochange_2030"],
+        props["bio_carbon_total_nochange_2030"] / area_ha,
+    )
@@ -0,0 +1,148 @@
+import json
+
+import geopandas as gpd
+import pytest
+import shapely
+from shapely import affinity, wkt
+
+from app.calculator import result_cache
+from app.calculator.result_cache import get_feature_cache_keys
+
+# Constants
+TEST_WKT = "POLYGON ((323383.0893000001 6823223.647, 323394.52799999993 6823222.464000002, 323405.9667999996 6823221.2809000015, 323412.03610000014 6823279.966600001, 323475.19799999986 6823273.434300002, 323469.12849999964 6823214.748599999, 323430.8428999996 6823218.7082, 323428.0423999997 6823191.629799999, 323399.5087000001 6823186.453400001, 323399.9550000001 6823183.9936, 323356.17059999984 6823176.0506, 323283.85250000004 6823162.931200001, 323275.90950000007 6823206.715599999, 323314.7742999997 6823213.766199999, 323314.1496000001 6823217.209899999, 323322.0208999999 6823218.637800001, 323321.2742999997 6823222.753400002, 323318.0575000001 6823241.262600001, 323322.8071999997 6823287.1844, 323323.01300000027 6823289.173700001, 323389.1588000003 6823282.332699999, 323383.0893000001 6823223.647))"
+TEST_CRS = "3067"
+
+
+@pytest.fixture(autouse=True)
+def static_inputs_version(monkeypatch):
+    monkeypatch.setattr(result_cache, "get_static_inputs_version", lambda: "test")
+
+
+def make_feature(geometry, feature_id="1", zoning_code="A"):
+    geometry = gpd.GeoSeries([geometry], crs=f"EPSG:{TEST_CRS}").to_crs("EPSG:4326")
+
+    return {
+        "type": "Feature",
+        "properties": {"id": feature_id, "zoning_code": zoning_code},
+        "geometry": shapely.geometry.mapping(geometry.iloc[0]),
+    }
+
+
+def test_cache_keys_ignore_vertex_order_and_id():
+    geometry = wkt.loads(TEST_WKT)
+    # The same ring starting from another vertex and in the other direction
+    coords = list(geometry.exterior.coords)[:-1]
+    coords = coords[5:] + coords[:5]
+    reordered = shapely.Polygon(coords[::-1])
+
+    keys = get_feature_cache_keys(
+        [make_feature(geometry), make_feature(reordered, feature_id="2")]
+    )
+
+    assert keys[0] == keys[1]
+
+
+def test_cache_keys_depend_on_geometry_and_zoning_code():
+    geometry = wkt.loads(TEST_WKT)
+    moved = affinity.translate(geometry, 1, 0)
+
+    keys = get_feature_cache_keys(
+        [
+            make_feature(geometry),
+            make_feature(moved),
+            make_feature(geometry, zoning_code="V"),
+        ]
+    )
+
+    assert len(set(keys)) == 3
+
+
+def test_cache_keys_match_across_input_crs():
+    geometry = wkt.loads(TEST_WKT)
+    feature = {
+        "type": "Feature",
+        "properties": {"id": "1", "zoning_code": "A"},
+        "geometry": shapely.geometry.mapping(geometry),
+    }
+
+    keys = get_feature_cache_keys([make_feature(geometry)])
+    keys_3067 = get_feature_cache_keys([feature], input_crs=TEST_CRS)
+
+    assert keys == keys_3067
+
+
+@pytest.mark.parametrize(
+    "setting,value",
+    [
+        ("calc_large_area_mode", "simplified"),
+        ("calc_tile_size", 1024.0),
+        ("calc_backend", "zonal"),
+        ("gis_data_version", "2"),
+    ],
+)
+def test_cache_keys_depend_on_calculation_settings(monkeypatch, setting, value):
+    features = [make_feature(wkt.loads(TEST_WKT))]
+    keys = get_feature_cache_keys(features)
+
+    monkeypatch.setattr(result_cache.global_settings, setting, value)
+
+    assert get_feature_cache_keys(features) != keys
+
+
+def test_simplified_cache_keys_depend_on_feature_area(monkeypatch):
+    monkeypatch.setattr(
+        result_cache.global_settings, "calc_large_area_mode", "simplified"
+    )
+    geometry = wkt.loads(TEST_WKT)
+    feature = make_feature(geometry)
+    monkeypatch.setattr(
+        result_cache.global_settings, "calc_large_area_threshold", geometry.area * 1.5
+    )
+
+    # The features are under the threshold by themselves, in any batch
+    keys = get_feature_cache_keys([feature])
+    assert get_feature_cache_keys([feature, feature]) == keys * 2
+
+    monkeypatch.setattr(
+        result_cache.global_settings, "calc_large_area_threshold", geometry.area / 2
+    )
+    assert get_feature_cache_keys([feature]) != keys
+
+
+@pytest.mark.asyncio
+async def test_features_are_simplified_by_their_own_area(monkeypatch):
+    monkeypatch.setattr(
+        result_cache.global_settings, "calc_large_area_mode", "simplified"
+    )
+    monkeypatch.setattr(result_cache.global_settings, "calc_cache_max_entries", 0)
+    geometry = wkt.loads(TEST_WKT)
+    monkeypatch.setattr(
+        result_cache.global_settings, "calc_large_area_threshold", geometry.area * 2
+    )
+    large = affinity.scale(geometry, 2, 2)
+    features = [
+        make_feature(geometry, feature_id="1"),
+        make_feature(large, feature_id="2"),
+        make_feature(geometry, feature_id="3"),
+    ]
+
+    calculations = []
+
+    class RecordingCalculator:
+        def __init__(self, data, simplify_calcs=None, **kwargs):
+            self.features = data["features"]
+            calculations.append(
+                ([f["properties"]["id"] for f in self.features], simplify_calcs)
+            )
+
+        async def calculate(self):
+            return {"areas": json.dumps({"features": self.features})}
+
+    monkeypatch.setattr(result_cache, "CarbonCalculator", RecordingCalculator)
+
+    calc_data = await result_cache.calculate_with_cache(features)
+
+    assert calculations == [(["1", "3"], False), (["2"], True)]
+    assert [
+        f["properties"]["id"] for f in json.loads(calc_data["areas"])["features"]
+    ] == ["1", "2", "3"]
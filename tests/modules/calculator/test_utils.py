@@ -0,0 +1,337 @@
+import struct
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import rioxarray as rxr
+import xarray as xr
+from rasterio.io import MemoryFile
+from shapely import wkt
+from shapely.geometry import box
+
+from app.calculator.utils import (
+    current_year,
+    get_bm_curve_mabp_sum,
+    get_overlap_mask,
+    get_shared_overlap_masks,
+    read_raster_from_bytes,
+    split_into_tiles,
+    year_offset,
+)
+from app.utils.data_loader import bm_curve_key_cols, build_bm_curve_index
+
+# Constants
+TEST_WKT = "POLYGON ((323383.0893000001 6823223.647, 323394.52799999993 6823222.464000002, 323405.9667999996 6823221.2809000015, 323412.03610000014 6823279.966600001, 323475.19799999986 6823273.434300002, 323469.12849999964 6823214.748599999, 323430.8428999996 6823218.7082, 323428.0423999997 6823191.629799999, 323399.5087000001 6823186.453400001, 323399.9550000001 6823183.9936, 323356.17059999984 6823176.0506, 323283.85250000004 6823162.931200001, 323275.90950000007 6823206.715599999, 323314.7742999997 6823213.766199999, 323314.1496000001 6823217.209899999, 323322.0208999999 6823218.637800001, 323321.2742999997 6823222.753400002, 323318.0575000001 6823241.262600001, 323322.8071999997 6823287.1844, 323323.01300000027 6823289.173700001, 323389.1588000003 6823282.332699999, 323383.0893000001 6823223.647))"
+TEST_CRS = "3067"
+PIXEL_SIZE = 16
+
+
+def make_raster(geometry, buffer=22.7, nan_share=0.1, seed=0) -> xr.DataArray:
+    minx, miny, maxx, maxy = geometry.buffer(buffer).bounds
+    x0 = np.floor(minx / PIXEL_SIZE) * PIXEL_SIZE
+    y0 = np.ceil(maxy / PIXEL_SIZE) * PIXEL_SIZE
+    width = int(np.ceil((maxx - x0) / PIXEL_SIZE))
+    height = int(np.ceil((y0 - miny) / PIXEL_SIZE))
+
+    rng = np.random.default_rng(seed)
+    values = rng.integers(1, 1000, size=(height, width)).astype(np.float32)
+    values[rng.random((height, width)) < nan_share] = np.nan
+
+    data_array = xr.DataArray(
+        values,
+        dims=("y", "x"),
+        coords={
+            "x": x0 + PIXEL_SIZE * (np.arange(width) + 0.5),
+            "y": y0 - PIXEL_SIZE * (np.arange(height) + 0.5),
+        },
+    )
+    data_array.rio.write_crs(f"EPSG:{TEST_CRS}", inplace=True)
+
+    return data_array
+
+
+def reference_overlap_mask(data_array: xr.DataArray, geometry) -> xr.DataArray:
+    """The original per-pixel implementation of get_overlap_mask."""
+    affine_transform = rio.transform.from_bounds(
+        *data_array.rio.bounds(), data_array.rio.width, data_array.rio.height
+    )
+    pixel_width = affine_transform.a
+    pixel_height = -affine_transform.e
+
+    overlap_percentages = xr.DataArray(
+        np.zeros_like(data_array.values),
+        dims=data_array.dims,
+        coords=data_array.coords,
+    )
+
+    for row in range(data_array.rio.height):
+        for col in range(data_array.rio.width):
+            if not np.isnan(data_array.values[row, col]):
+                geo_x, geo_y = rio.transform.xy(
+                    affine_transform, row, col, offset="center"
+                )
+                pixel_box = box(
+                    geo_x - pixel_width / 2,
+                    geo_y - pixel_height / 2,
+                    geo_x + pixel_width / 2,
+                    geo_y + pixel_height / 2,
+                )
+                intersection = pixel_box.intersection(geometry)
+                if not intersection.is_empty:
+                    overlap_percentages[row, col] = intersection.area / pixel_box.area
+
+    return overlap_percentages
+
+
+def test_overlap_mask_matches_reference():
+    geometry = wkt.loads(TEST_WKT)
+    rast = make_raster(geometry)
+
+    result = get_overlap_mask(rast, geometry)
+    expected = reference_overlap_mask(rast, geometry)
+
+    assert result.dims == expected.dims
+    assert np.allclose(result.values, expected.values, rtol=1e-6, atol=1e-9)
+    assert np.array_equal(result.x.values, expected.x.values)
+    assert np.array_equal(result.y.values, expected.y.values)
+
+
+def test_overlap_mask_matches_reference_with_hole():
+    outer = wkt.loads(TEST_WKT).buffer(40)
+    geometry = outer.difference(outer.centroid.buffer(30))
+    rast = make_raster(geometry, nan_share=0.3, seed=1)
+
+    result = get_overlap_mask(rast, geometry)
+    expected = reference_overlap_mask(rast, geometry)
+
+    assert np.allclose(result.values, expected.values, rtol=1e-6, atol=1e-9)
+
+
+def test_overlap_mask_is_zero_for_nan_pixels():
+    geometry = wkt.loads(TEST_WKT)
+    rast = make_raster(geometry, nan_share=0.5, seed=2)
+
+    result = get_overlap_mask(rast, geometry)
+
+    assert np.all(result.values[np.isnan(rast.values)] == 0)
+    assert np.all((result.values >= 0) & (result.values <= 1))
+
+
+def make_bm_curve_df() -> pd.DataFrame:
+    rows = []
+    for region in range(1, 4):
+        for species in range(1, 4):
+            row = {col: 1 for col in bm_curve_key_cols}
+            row["Region"] = region
+            row["Species"] = species
+            row["Mabp"] = region * 1.5 + species
+            rows.append(row)
+    # A duplicate key, the first curve should win
+    rows.append({**rows[0], "Mabp": 100.0})
+
+    return pd.DataFrame(rows)
+
+
+def make_variables_dict():
+    variables_dict = {}
+    for kuvio in range(1, 12):
+        variables = {col: 1 for col in bm_curve_key_cols}
+        variables["kuvio"] = kuvio
+        variables["Region"] = kuvio % 4  # Region 0 has no curve
+        variables["Species"] = kuvio % 3 + 1
+        variables_dict[kuvio] = variables
+
+    return variables_dict
+
+
+def reference_bm_curve_values(rast, years, bm_curve_df, variables_dict, overlap):
+    """The original row-by-row biomass curve search for a single raster."""
+    year_dict = {year: 0 for year in years}
+    was_found = False
+    for (x, y), value in np.ndenumerate(rast.values):
+        if np.isnan(value):
+            continue
+        variables = variables_dict.get(int(value))
+        if variables is None:
+            continue
+        condition = pd.Series([True] * len(bm_curve_df))
+        for key in bm_curve_key_cols:
+            condition = condition & (bm_curve_df[key] == variables[key])
+        matching_row = bm_curve_df[condition]
+        if len(matching_row) > 0:
+            was_found = True
+            mabp = float(matching_row.iloc[0]["Mabp"])
+            for year in years:
+                year_diff = int(year) - current_year + year_offset
+                year_dict[year] += overlap.values[x, y] * mabp * year_diff
+
+    return year_dict if was_found else None
+
+
+def test_bm_curve_values_match_reference():
+    geometry = wkt.loads(TEST_WKT)
+    rast = make_raster(geometry, nan_share=0.2, seed=3)
+    rast = (rast % 14).where(~np.isnan(rast))  # Ids 12 and 13 have no variables
+    overlap = get_overlap_mask(rast, geometry)
+
+    years = [str(current_year), "2030", "2050"]
+    bm_curve_df = make_bm_curve_df()
+    variables_dict = make_variables_dict()
+
+    mabp_sum, was_found = get_bm_curve_mabp_sum(
+        rast.values,
+        build_bm_curve_index(bm_curve_df),
+        variables_dict,
+        overlap.values,
+    )
+    expected = reference_bm_curve_values(
+        rast, years, bm_curve_df, variables_dict, overlap
+    )
+
+    assert was_found
+    for year in years:
+        year_diff = int(year) - current_year + year_offset
+        assert np.isclose(mabp_sum * year_diff, expected[year], rtol=1e-6)
+
+
+def test_bm_curve_values_without_matches():
+    geometry = wkt.loads(TEST_WKT)
+    rast = make_raster(geometry, seed=4) * 0 + 12  # No variables for id 12
+
+    mabp_sum, was_found = get_bm_curve_mabp_sum(
+        rast.values,
+        build_bm_curve_index(make_bm_curve_df()),
+        make_variables_dict(),
+    )
+
+    assert not was_found
+    assert mabp_sum == 0.0
+
+
+def test_shared_overlap_masks_match_individual_masks():
+    geometry = wkt.loads(TEST_WKT)
+    segment_rast = make_raster(geometry, nan_share=0.5, seed=5)
+    carbon_rast = make_raster(geometry, nan_share=0.1, seed=6)
+    # A layer on a grid shifted by half a pixel can't share the mask
+    shifted_rast = make_raster(geometry, seed=7)
+    shifted_rast = shifted_rast.assign_coords(
+        x=shifted_rast.x + PIXEL_SIZE / 2, y=shifted_rast.y + PIXEL_SIZE / 2
+    )
+
+    masks = get_shared_overlap_masks(
+        [segment_rast, carbon_rast, shifted_rast], geometry
+    )
+
+    for rast, mask in zip([segment_rast, carbon_rast, shifted_rast], masks):
+        expected = get_overlap_mask(rast, geometry)
+        masked_sum = (rast * mask).sum().values.item()
+        expected_sum = (rast * expected).sum().values.item()
+        assert np.isclose(masked_sum, expected_sum, rtol=1e-6)
+        assert np.array_equal(mask.x.values, rast.x.values)
+
+
+def test_tiled_overlap_sums_match_whole_geometry():
+    geometry = wkt.loads(TEST_WKT)
+    rast = make_raster(geometry, seed=8)
+    expected_sum = (rast * get_overlap_mask(rast, geometry)).sum().values.item()
+
+    tiles = split_into_tiles(geometry, 64)
+    assert len(tiles) > 1
+    assert np.isclose(sum(tile.area for tile in tiles), geometry.area)
+
+    # The tiles split the coverage of the pixels on their edges between them
+    tiled_sum = sum(
+        (rast * get_overlap_mask(rast, tile)).sum().values.item() for tile in tiles
+    )
+    assert np.isclose(tiled_sum, expected_sum, rtol=1e-6)
+
+
+def make_test_band(dtype="int16", nodata=-1):
+    values = np.arange(12, dtype=dtype).reshape(3, 4)
+    values[0, 0] = nodata
+    transform = rio.transform.from_origin(323280, 6823290, PIXEL_SIZE, PIXEL_SIZE)
+
+    return values, transform
+
+
+def make_tiff(values, transform, nodata=-1) -> bytes:
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="GTiff",
+            width=values.shape[1],
+            height=values.shape[0],
+            count=1,
+            dtype=values.dtype,
+            crs=f"EPSG:{TEST_CRS}",
+            transform=transform,
+            nodata=nodata,
+            compress="deflate",
+        ) as dataset:
+            dataset.write(values, 1)
+        return memfile.read()
+
+
+def make_wkb(values, transform, pixel_type=5, nodata=-1, endian="<") -> bytes:
+    """Encode a single band raster like PostGIS ST_AsBinary."""
+    header = struct.pack(
+        f"{endian}BHHddddddiHH",
+        1 if endian == "<" else 0,
+        0,
+        1,
+        transform.a,
+        transform.e,
+        transform.c,
+        transform.f,
+        transform.b,
+        transform.d,
+        int(TEST_CRS),
+        values.shape[1],
+        values.shape[0],
+    )
+    dtype = values.dtype.newbyteorder(endian)
+    band = (
+        struct.pack("B", 0x40 | pixel_type)
+        + np.array([nodata], dtype=dtype).tobytes()
+        + values.astype(dtype).tobytes()
+    )
+
+    return header + band
+
+
+def test_read_raster_from_bytes():
+    values, transform = make_test_band()
+
+    rast = read_raster_from_bytes(make_tiff(values, transform))
+
+    assert rast.dims == ("y", "x")
+    assert rast.rio.transform() == transform
+    assert rast.rio.crs.to_epsg() == int(TEST_CRS)
+    assert np.isnan(rast.values[0, 0])
+    assert np.array_equal(rast.values[1:], values[1:])
+
+
+def test_read_raster_from_wkb_matches_tiff():
+    values, transform = make_test_band()
+    tiff_rast = read_raster_from_bytes(make_tiff(values, transform))
+
+    for endian in ["<", ">"]:
+        wkb_rast = read_raster_from_bytes(make_wkb(values, transform, endian=endian))
+
+        assert wkb_rast.dims == tiff_rast.dims
+        assert wkb_rast.dtype == tiff_rast.dtype
+        assert wkb_rast.rio.transform() == tiff_rast.rio.transform()
+        assert wkb_rast.rio.crs == tiff_rast.rio.crs
+        assert np.array_equal(wkb_rast.x.values, tiff_rast.x.values)
+        assert np.array_equal(wkb_rast.y.values, tiff_rast.y.values)
+        assert np.array_equal(wkb_rast.values, tiff_rast.values, equal_nan=True)
+
+
+def test_read_raster_from_wkb_float_band():
+    values, transform = make_test_band(dtype="float32", nodata=-9999)
+
+    rast = read_raster_from_bytes(
+        make_wkb(values, transform, pixel_type=10, nodata=-9999)
+    )
+
+    assert rast.dtype == np.float32
+    assert np.isnan(rast.values[0, 0])
+    assert np.array_equal(rast.values[1:], values[1:])
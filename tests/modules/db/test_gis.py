@@ -3,11 +3,14 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 import pytest_asyncio
 import asyncio
+import numpy as np
+import json
+import geopandas as gpd
+from app.calculator.calculator import CarbonCalculator, pixel_buffer
 from app.db.gis import (
     fetch_variables_for_ids,
-    fetch_rasters_for_regions,
-    fetch_bio_carbon_for_regions,
-    fetch_ground_carbon_for_regions,
+    fetch_layers_for_regions,
+    fetch_zonal_sums_for_regions,
 )
 from app.db.connection import get_async_context_gis_db
 
@@ -33,26 +36,44 @@ async def test_fetch_variables_for_ids():
 
 
 @pytest.mark.asyncio
-async def test_fetch_rasters_for_regions():
+async def test_fetch_layers_for_regions():
     async with get_async_context_gis_db() as session:
-        rows = await fetch_rasters_for_regions(session, [TEST_WKT, TEST_WKT], TEST_CRS)
+        rows = await fetch_layers_for_regions(session, [TEST_WKT, TEST_WKT], TEST_CRS)
         assert rows is not None
+        assert len(rows) == 2
+        assert [row[-1] for row in rows] == [1, 2]
+        # The segment, bio carbon and ground carbon rasters of each geometry
+        for row in rows:
+            assert all(rast is not None for rast in row[:3])
 
 
 @pytest.mark.asyncio
-async def test_fetch_bio_carbon_for_regions():
+async def test_fetch_zonal_sums_for_regions():
     async with get_async_context_gis_db() as session:
-        result = await fetch_bio_carbon_for_regions(session, [TEST_WKT, TEST_WKT], TEST_CRS)
-        assert result is not None
-    # Add more assertions based on expected results
+        rows = await fetch_zonal_sums_for_regions(
+            session, [TEST_WKT, TEST_WKT], TEST_CRS, pixel_buffer
+        )
+        assert rows is not None
+        assert len(rows) == 2
+        assert [row[-1] for row in rows] == [1, 2]
+        assert len(rows[0][0]) == len(rows[0][1])
 
 
-# # Test for fetch_ground_carbon_for_region
 @pytest.mark.asyncio
-async def test_fetch_ground_carbon_for_regions():
-    async with get_async_context_gis_db() as session:
-        result = await fetch_ground_carbon_for_regions(session, [TEST_WKT, TEST_WKT], TEST_CRS)
-        assert result is not None
+async def test_zonal_sums_match_raster_sums():
+    # The same geometry in 4326, as the calculator expects it
+    geometry = gpd.GeoSeries.from_wkt([TEST_WKT], crs=f"EPSG:{TEST_CRS}").to_crs(
+        "EPSG:4326"
+    )
+    data = json.loads(geometry.to_json())
+
+    raster_sums = await CarbonCalculator(data, backend="raster").get_feature_sums()
+    zonal_sums = await CarbonCalculator(data, backend="zonal").get_feature_sums()
+
+    for raster_sum, zonal_sum in zip(raster_sums, zonal_sums):
+        assert raster_sum["bm_curve_found"] == zonal_sum["bm_curve_found"]
+        for key in ["bio_carbon", "ground_carbon", "bm_curve_mabp"]:
+            assert np.isclose(raster_sum[key], zonal_sum[key], rtol=1e-4)
 
 
 # Add more test cases as needed to cover different scenarios,
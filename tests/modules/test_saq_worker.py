@@ -0,0 +1,295 @@
+import asyncio
+import copy
+import json
+import time
+import uuid
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+import shapely
+from shapely.geometry import box
+
+from app import saq_worker
+
+
+def make_feature(idx, size=10.0):
+    return {
+        "type": "Feature",
+        "properties": {"id": str(idx)},
+        "geometry": shapely.geometry.mapping(box(0, 0, size, size)),
+    }
+
+
+def make_area(feature):
+    return {**feature, "properties": {**feature["properties"], "area_ha": 1.0}}
+
+
+class FakeStateDb:
+    """
+    The plan, its features and results that the worker reads and writes, in
+    place of the state db.
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self.plan = SimpleNamespace(
+            id=uuid.uuid4(),
+            ui_id=uuid.uuid4(),
+            last_index=-1,
+            total_indices=len(features),
+            last_area_calculation_retries=0,
+            last_area_calculation_status=None,
+            solo_until_index=-1,
+            calculation_updated_ts=None,
+        )
+        self.chunks = set()
+        self.results = []
+        self.sums = []
+        self.enqueued = []
+
+    async def get_plan(self, db_session, ui_id):
+        return copy.copy(self.plan)
+
+    async def update_plan(self, db_session, plan):
+        self.plan.__dict__.update(plan.__dict__)
+        return plan
+
+    async def get_feature(self, db_session, plan_id, idx):
+        return self.features[idx] if idx < len(self.features) else None
+
+    async def get_uncalculated_features(self, db_session, plan_id, start_index, count):
+        calculated = {idx for idx, _ in self.results}
+        return [
+            (idx, self.features[idx])
+            for idx in range(start_index, min(start_index + count, len(self.features)))
+            if idx not in calculated
+        ]
+
+    async def skip_calculated(self, db_session, plan_id):
+        calculated = {idx for idx, _ in self.results}
+        while (
+            self.plan.last_index + 1 < self.plan.total_indices
+            and self.plan.last_index + 1 in calculated
+        ):
+            self.plan.last_index += 1
+        return self.plan.last_index
+
+    async def claim_features(self, db_session, plan_id, start_index, count):
+        if self.plan.last_index != start_index - 1:
+            return False
+        self.plan.last_index = start_index + count - 1
+        return True
+
+    async def add_chunk(self, db_session, plan_id, start_index):
+        if start_index in self.chunks:
+            return False
+        self.chunks.add(start_index)
+        return True
+
+    async def advance_last_index(self, db_session, plan_id, count):
+        self.plan.last_index += count
+        return self.plan.last_index, self.plan.total_indices
+
+    async def add_results(self, db_session, plan_id, results, commit=True):
+        self.results.extend(results)
+
+    async def add_sums(self, db_session, plan_id, sums, commit=True):
+        self.sums.append(sums)
+
+    async def enqueue(self, function, **kwargs):
+        self.enqueued.append((function, kwargs))
+
+
+@pytest.fixture
+def state_db(monkeypatch):
+    db = FakeStateDb([make_feature(idx) for idx in range(6)])
+
+    @asynccontextmanager
+    async def get_session():
+        yield None
+
+    for name, value in {
+        "get_async_context_state_db": get_session,
+        "get_plan_without_data_by_ui_id": db.get_plan,
+        "update_plan": db.update_plan,
+        "get_plan_feature_by_index": db.get_feature,
+        "get_uncalculated_plan_features": db.get_uncalculated_features,
+        "skip_calculated_plan_features": db.skip_calculated,
+        "claim_plan_features": db.claim_features,
+        "add_plan_chunk": db.add_chunk,
+        "advance_plan_last_index": db.advance_last_index,
+        "add_plan_area_results": db.add_results,
+        "add_to_plan_report_sums": db.add_sums,
+        "get_area_sums": lambda areas: len(areas["features"]),
+        "queue": SimpleNamespace(enqueue=db.enqueue),
+    }.items():
+        monkeypatch.setattr(saq_worker, name, value)
+    monkeypatch.setattr(saq_worker.global_settings, "calc_batch_max_features", 3)
+    monkeypatch.setattr(saq_worker.global_settings, "calc_batch_target_area", 1e6)
+
+    return db
+
+
+def mock_calculation(monkeypatch, failing_ids=(), started=None, release=None):
+    calls = []
+
+    async def calculate_with_cache(features, backend=None, input_crs="4326"):
+        calls.append([int(f["properties"]["id"]) for f in features])
+        if started is not None:
+            started.set()
+            await release.wait()
+        if any(f["properties"]["id"] in failing_ids for f in features):
+            raise ValueError("No data found for polygons.")
+        return {
+            "areas": json.dumps(
+                {
+                    "type": "FeatureCollection",
+                    "features": [make_area(f) for f in features],
+                }
+            ),
+            "metadata": {"timestamp": None},
+        }
+
+    monkeypatch.setattr(saq_worker, "calculate_with_cache", calculate_with_cache)
+
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_calculated_feature_by_feature(state_db, monkeypatch):
+    calls = mock_calculation(monkeypatch, failing_ids=["1"])
+    ui_id = str(state_db.plan.ui_id)
+
+    while state_db.plan.last_index + 1 < state_db.plan.total_indices:
+        await saq_worker.calculate_piece({}, ui_id=ui_id)
+
+    # The failing feature is retried alone and left out, the other features of
+    # the failed batch are calculated alone, and the batches continue after it
+    assert calls[0] == [0, 1, 2]
+    assert calls[1] == [0]
+    assert all(call == [1] for call in calls[2:-2])
+    assert calls[-2:] == [[2], [3, 4, 5]]
+    assert [idx for idx, _ in state_db.results] == [0, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_carried_over_areas_are_skipped(state_db, monkeypatch):
+    calls = mock_calculation(monkeypatch)
+    ui_id = str(state_db.plan.ui_id)
+    state_db.results = [(0, make_area(state_db.features[0]))]
+    state_db.results.append((2, make_area(state_db.features[2])))
+
+    while state_db.plan.last_index + 1 < state_db.plan.total_indices:
+        await saq_worker.calculate_piece({}, ui_id=ui_id)
+
+    # The batches end before the features that have their areas
+    assert calls == [[1], [3, 4, 5]]
+    assert sorted(idx for idx, _ in state_db.results) == list(range(6))
+
+
+@pytest.mark.asyncio
+async def test_carried_over_areas_are_skipped_in_chunks(state_db, monkeypatch):
+    calls = mock_calculation(monkeypatch)
+    ui_id = str(state_db.plan.ui_id)
+    state_db.results = [(4, make_area(state_db.features[4]))]
+
+    await saq_worker.calculate_chunk({}, ui_id=ui_id, start_index=0, count=3)
+    await saq_worker.calculate_chunk({}, ui_id=ui_id, start_index=3, count=3)
+
+    assert calls == [[0, 1, 2], [3, 5]]
+    assert [idx for idx, _ in state_db.results] == [4, 0, 1, 2, 3, 5]
+    assert state_db.plan.last_index == 5
+    assert [function for function, _ in state_db.enqueued] == ["calculate_totals"]
+
+
+@pytest.mark.asyncio
+async def test_duplicate_piece_writes_results_once(state_db, monkeypatch):
+    started = asyncio.Event()
+    release = asyncio.Event()
+    calls = mock_calculation(monkeypatch, started=started, release=release)
+    ui_id = str(state_db.plan.ui_id)
+
+    # Both jobs read the plan before either of them has written its results
+    first = asyncio.create_task(saq_worker.calculate_piece({}, ui_id=ui_id))
+    await started.wait()
+    second = asyncio.create_task(saq_worker.calculate_piece({}, ui_id=ui_id))
+    while len(calls) < 2:
+        await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(first, second)
+
+    assert [idx for idx, _ in state_db.results] == [0, 1, 2]
+    assert state_db.sums == [3]
+    assert state_db.plan.last_index == 2
+    assert len(state_db.enqueued) == 1
+
+
+@pytest.mark.asyncio
+async def test_chunk_run_twice_is_counted_once(state_db, monkeypatch):
+    mock_calculation(monkeypatch)
+    ui_id = str(state_db.plan.ui_id)
+
+    await saq_worker.calculate_chunk({}, ui_id=ui_id, start_index=3, count=3)
+    await saq_worker.calculate_chunk({}, ui_id=ui_id, start_index=3, count=3)
+
+    assert [idx for idx, _ in state_db.results] == [3, 4, 5]
+    assert state_db.sums == [3]
+    assert state_db.plan.last_index == 2
+    assert state_db.enqueued == []
+
+    # The totals are calculated once, after the last of the chunks
+    await saq_worker.calculate_chunk({}, ui_id=ui_id, start_index=0, count=3)
+    await saq_worker.calculate_chunk({}, ui_id=ui_id, start_index=0, count=3)
+
+    assert state_db.plan.last_index == 5
+    assert [function for function, _ in state_db.enqueued] == ["calculate_totals"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("result_count,expected", [(6, "sums"), (5, "areas")])
+async def test_totals_of_a_plan_with_failed_features_are_from_its_areas(
+    monkeypatch, result_count, expected
+):
+    plan = SimpleNamespace(
+        id=uuid.uuid4(),
+        total_indices=6,
+        report_sums={"bio_carbon_total_nochange_2030": 1.0},
+        total_geometry=shapely.geometry.mapping(box(0, 0, 10, 10)),
+    )
+
+    async def count_plan_area_results(db_session, plan_id):
+        return result_count
+
+    async def get_plan_report_areas(db_session, plan_id):
+        return {"type": "FeatureCollection", "features": []}
+
+    async def run_cpu_bound(func, *args):
+        return "sums"
+
+    class AreaCalculator:
+        def __init__(self, data, **kwargs):
+            pass
+
+        async def calculate_totals(self):
+            return "areas"
+
+    monkeypatch.setattr(saq_worker, "count_plan_area_results", count_plan_area_results)
+    monkeypatch.setattr(saq_worker, "get_plan_report_areas", get_plan_report_areas)
+    monkeypatch.setattr(saq_worker, "run_cpu_bound", run_cpu_bound)
+    monkeypatch.setattr(saq_worker, "CarbonCalculator", AreaCalculator)
+
+    assert await saq_worker.get_plan_totals(None, plan) == expected
+
+
+def test_stale_jobs_are_told_by_their_touched_time():
+    now = time.time() * 1000
+    job = {"function": "calculate_piece", "status": "active", "touched": now}
+
+    assert not saq_worker.is_stale_job(job)
+    assert saq_worker.is_stale_job(
+        {**job, "touched": now - (saq_worker.STALE_JOB_AGE + 1) * 1000}
+    )
+    assert not saq_worker.is_stale_job(
+        {**job, "status": "complete", "touched": now - 10**7}
+    )
@@ -0,0 +1,94 @@
+import json
+
+from app.utils.plan_diff import (
+    get_feature_hash,
+    merge_unchanged_plan_data,
+    merge_unchanged_results,
+)
+
+
+def make_feature(feature_id, x=0, zoning_code="A"):
+    return {
+        "type": "Feature",
+        "properties": {"id": feature_id, "zoning_code": zoning_code},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[x, 0], [x + 1, 0], [x + 1, 1], [x, 1], [x, 0]]],
+        },
+    }
+
+
+def make_area(feature_id):
+    return {
+        "type": "Feature",
+        "properties": {"id": feature_id, "bio_carbon_total_nochange_2030": 1.0},
+        "geometry": None,
+    }
+
+
+def make_collection(features):
+    return {"type": "FeatureCollection", "features": features}
+
+
+def make_results(features, areas):
+    # The areas with the hashes of the features they were calculated from
+    return [(area, get_feature_hash(feature)) for feature, area in zip(features, areas)]
+
+
+def test_unchanged_features_are_carried_over_in_order():
+    old_results = make_results(
+        [make_feature(1), make_feature(2), make_feature(3)],
+        [make_area(1), make_area(2), make_area(3)],
+    )
+    new_data = make_collection(
+        [
+            make_feature(1, x=5),  # moved
+            make_feature(4),  # new
+            make_feature(3),
+            make_feature(2, zoning_code="V"),  # rezoned
+        ]
+    )
+
+    report_areas, hashes = merge_unchanged_results(old_results, new_data)
+
+    # The carried over area is at the index of its feature in the new data
+    assert report_areas == [(2, make_area(3))]
+    assert hashes == [get_feature_hash(f) for f in new_data["features"]]
+    assert [f["properties"]["id"] for f in new_data["features"]] == [1, 4, 3, 2]
+
+
+def test_features_without_results_or_unique_ids_are_recalculated():
+    old_results = make_results(
+        [make_feature(1), make_feature(None)], [make_area(1), make_area(None)]
+    )
+    new_data = make_collection(
+        [make_feature(1), make_feature(1), make_feature(2), make_feature(None)]
+    )
+
+    report_areas, hashes = merge_unchanged_results(old_results, new_data)
+
+    assert report_areas == []
+    assert len(hashes) == 4
+
+
+def test_without_old_calculation_everything_is_recalculated():
+    new_data = make_collection([make_feature(1), make_feature(2)])
+
+    report_areas, hashes = merge_unchanged_results(None, new_data)
+
+    assert report_areas == []
+    assert hashes == [get_feature_hash(f) for f in new_data["features"]]
+
+
+def test_features_are_compared_to_the_calculated_ones():
+    # The plan data was saved again with a moved feature after the calculation,
+    # so its result is no longer for the feature in the data
+    old_results = make_results(
+        [make_feature(1), make_feature(2)], [make_area(1), make_area(2)]
+    )
+    old_results.append((make_area(3), None))  # Calculated before the hashes
+    new_data = make_collection([make_feature(1, x=5), make_feature(2), make_feature(3)])
+
+    report_areas, _ = merge_unchanged_plan_data(old_results, json.dumps(new_data))
+
+    assert report_areas == [(1, make_area(2))]
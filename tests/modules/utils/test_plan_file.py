@@ -0,0 +1,138 @@
+import io
+import json
+import tempfile
+import zipfile
+from pathlib import Path
+
+import geopandas as gpd
+import pytest
+import shapely
+
+from app.utils import plan_file
+from app.utils.plan_file import PlanFileError, clean_plan_data, read_plan_file
+
+# A valid square, a self-intersecting bowtie and a line
+TEST_GEOMETRIES = [
+    "POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))",
+    "POLYGON ((2 0, 3 1, 3 0, 2 1, 2 0))",
+    "LINESTRING (0 0, 1 1)",
+]
+
+
+def make_data():
+    return gpd.GeoDataFrame(
+        {"id": ["1", "2", "3"], "zoning_code": ["A", "V", "A"]},
+        geometry=[shapely.from_wkt(geom) for geom in TEST_GEOMETRIES],
+        crs="EPSG:4326",
+    )
+
+
+def make_shapefile_zip(tmp_path: Path) -> io.BytesIO:
+    # A shapefile has one geometry type, and field names of up to 10 characters
+    data = make_data().iloc[:2].rename(columns={"zoning_code": "zoning"})
+    data.to_file(tmp_path / "plan.shp")
+
+    zip_file = io.BytesIO()
+    with zipfile.ZipFile(zip_file, "w") as archive:
+        for path in tmp_path.glob("plan.*"):
+            archive.write(path, path.name)
+    zip_file.seek(0)
+
+    return zip_file
+
+
+def test_clean_plan_data_repairs_and_filters_geometries():
+    data = clean_plan_data(make_data())
+
+    assert data["id"].tolist() == ["1", "2"]
+    assert data.geometry.is_valid.all()
+    # Both triangles of the bowtie are kept
+    assert data.geometry.iloc[1].geom_type == "MultiPolygon"
+    assert data.geometry.iloc[1].area == pytest.approx(0.5)
+
+
+def test_read_plan_file(tmp_path):
+    data, total_indices, total_geometry = read_plan_file(
+        make_shapefile_zip(tmp_path), "test"
+    )
+
+    assert total_indices == 2
+    assert [
+        feature["properties"]["zoning"] for feature in json.loads(data)["features"]
+    ] == ["A", "V"]
+    assert json.loads(total_geometry)["type"] == "MultiPolygon"
+
+
+@pytest.mark.parametrize("engine", ["pyogrio", "fiona"])
+def test_read_plan_file_engines(tmp_path, monkeypatch, engine):
+    monkeypatch.setattr(plan_file, "read_engine", engine)
+
+    data, _, _ = read_plan_file(make_shapefile_zip(tmp_path), "test")
+
+    features = json.loads(data)["features"]
+    assert [feature["id"] for feature in features] == ["0", "1"]
+    assert [feature["properties"]["id"] for feature in features] == ["1", "2"]
+
+
+def test_read_plan_file_rejects_large_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(plan_file.global_settings, "max_upload_size", 10)
+
+    with pytest.raises(PlanFileError) as ex:
+        read_plan_file(make_shapefile_zip(tmp_path), "test")
+
+    assert ex.value.status_code == 413
+
+
+def test_read_plan_file_flatgeobuf(tmp_path):
+    # Written in another crs, which is transformed to EPSG:4326
+    make_data().iloc[:2].to_crs("EPSG:3857").to_file(
+        tmp_path / "plan.fgb", driver="FlatGeobuf"
+    )
+
+    data, total_indices, _ = read_plan_file(
+        io.BytesIO((tmp_path / "plan.fgb").read_bytes()), "test"
+    )
+
+    # The features are in the order of the spatial index of the file
+    features = sorted(
+        json.loads(data)["features"], key=lambda feature: feature["properties"]["id"]
+    )
+    assert total_indices == 2
+    assert [feature["properties"]["zoning_code"] for feature in features] == [
+        "A",
+        "V",
+    ]
+    assert shapely.geometry.shape(features[0]["geometry"]).bounds == pytest.approx(
+        (0, 0, 1, 1)
+    )
+
+
+def test_read_plan_file_geoparquet(tmp_path):
+    # Written in another crs, which is transformed to EPSG:4326
+    make_data().iloc[:2].to_crs("EPSG:3857").to_parquet(tmp_path / "plan.parquet")
+
+    # Uploads are spooled to a temporary file, as with the FastAPI UploadFile
+    with tempfile.SpooledTemporaryFile() as upload:
+        upload.write((tmp_path / "plan.parquet").read_bytes())
+        upload.seek(0)
+        data, total_indices, total_geometry = read_plan_file(upload, "test")
+
+    features = json.loads(data)["features"]
+    assert total_indices == 2
+    assert [feature["properties"]["zoning_code"] for feature in features] == [
+        "A",
+        "V",
+    ]
+    assert shapely.geometry.shape(features[0]["geometry"]).bounds == pytest.approx(
+        (0, 0, 1, 1)
+    )
+    assert json.loads(total_geometry)["type"] == "MultiPolygon"
+
+
+def test_read_plan_file_geoparquet_without_pyarrow(monkeypatch):
+    monkeypatch.setattr(plan_file, "has_arrow", False)
+
+    with pytest.raises(PlanFileError) as ex:
+        read_plan_file(io.BytesIO(b"PAR1" + b"\0" * 16), "test")
+
+    assert ex.value.status_code == 415
@@ -0,0 +1,103 @@
+import gzip
+import io
+import json
+
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.ipc
+import pytest
+
+from app.utils.report import (
+    compress_content,
+    export_report_areas,
+    get_report_areas_frame,
+    is_etag_match,
+)
+
+
+def test_compressed_content_and_etag():
+    content = {"id": "1", "report_data": {"totals": None}}
+
+    compressed, etag = compress_content(content)
+
+    assert json.loads(gzip.decompress(compressed)) == content
+    assert compress_content(dict(content))[1] == etag
+    assert compress_content({**content, "id": "2"})[1] != etag
+
+
+def test_etag_match():
+    etag = '"abc"'
+
+    assert is_etag_match('"abc"', etag)
+    assert is_etag_match('"def", W/"abc"', etag)
+    assert is_etag_match("*", etag)
+    assert not is_etag_match('"def"', etag)
+    assert not is_etag_match(None, etag)
+
+
+def make_areas():
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": {
+                    "id": "1",
+                    "zoning_code": "A",
+                    "bio_carbon_total_nochange_2030": 1,
+                    "bio_carbon_ha_nochange_2030": 0.5,
+                    "bio_carbon_total_planned_2030": 2,
+                    "bio_carbon_ha_planned_2030": 1.0,
+                },
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]],
+                },
+            }
+        ],
+    }
+
+
+def test_report_areas_frame_projection():
+    zone = get_report_areas_frame(make_areas(), ["*_ha_*"])
+
+    assert zone.columns.tolist() == [
+        "id",
+        "zoning_code",
+        "bio_carbon_ha_nochange_2030",
+        "bio_carbon_ha_planned_2030",
+        "geometry",
+    ]
+
+    zone = get_report_areas_frame(make_areas(), ["*planned*"])
+
+    assert zone["bio_carbon_total_planned_2030"].dtype == "float64"
+    assert "bio_carbon_total_nochange_2030" not in zone.columns
+
+
+def test_export_report_areas_geoparquet():
+    content = export_report_areas(make_areas(), "geoparquet", ["*_total_*"])
+
+    zone = gpd.read_parquet(io.BytesIO(content))
+    assert zone.crs.to_epsg() == 4326
+    assert zone.columns.tolist() == [
+        "id",
+        "zoning_code",
+        "bio_carbon_total_nochange_2030",
+        "bio_carbon_total_planned_2030",
+        "geometry",
+    ]
+
+
+def test_export_report_areas_arrow():
+    content = export_report_areas(make_areas(), "arrow", ["*_total_*"])
+
+    table = pa.ipc.open_stream(content).read_all()
+    assert table.column_names == [
+        "id",
+        "zoning_code",
+        "bio_carbon_total_nochange_2030",
+        "bio_carbon_total_planned_2030",
+        "geometry",
+    ]
+    assert table.schema.field("bio_carbon_total_planned_2030").type == pa.float64()